@@ -6,6 +6,29 @@ from PIL import Image, ImageTk
 from ultralytics.models.sam import SAM2VideoPredictor
 import json
 import os
+import threading
+import time
+from sam2_engine import SAM2FrameEngine
+from label_map import build_label_luts, blend_label_map, render_label_map
+from video_source import LiveFrameSource, LatencyTracker, realtime_frames, DEFAULT_REALTIME_CONFIG
+from video_source import (PrefetchFrameReader, DEFAULT_FRAME_SOURCE_CONFIG, resolve_frame_source,
+                          probe_source)
+from memory_monitor import MemoryMonitor, SessionHistory, DEFAULT_MEMORY_CONFIG
+from model_optimization import DEFAULT_OPTIMIZATION_CONFIG
+from box_preview import BoxMaskPreviewer, DEFAULT_PREVIEW_CONFIG
+from tracking_service import TrackingClient, DEFAULT_SERVICE_CONFIG, service_url
+from frame_display import FrameDisplay, DEFAULT_DISPLAY_CONFIG
+from motion_gate import MotionGate, gated_track, DEFAULT_MOTION_GATE_CONFIG
+from yoloe_auto_prompt import YOLOEAutoPrompter, DEFAULT_AUTO_PROMPT_CONFIG, filter_new_prompts, box_iou_matrix
+from mask_archive import label_map_boxes, MaskArchiveWriter
+from machine_profile import load_machine_profile, apply_machine_profile
+from object_sharding import ObjectShardedEngine, DEFAULT_OBJECT_SHARDING_CONFIG, use_object_sharding
+from feature_store import FeatureStore, DEFAULT_FEATURE_STORE_CONFIG
+from segmented_writer import open_video_writer, DEFAULT_SEGMENTED_OUTPUT_CONFIG
+from track_health import TrackHealthMonitor, DEFAULT_TRACK_HEALTH_CONFIG
+from encoder_lookahead import EncoderLookahead, lookahead_track, use_lookahead, DEFAULT_ENCODER_LOOKAHEAD_CONFIG
+from mask_postprocess import MaskPostprocessor, DEFAULT_MASK_POSTPROCESS_CONFIG
+from review_player import ReviewWindow, DEFAULT_REVIEW_CONFIG
 
 class SAM2TrackerApp:
     def __init__(self, root):
@@ -24,43 +47,67 @@ class SAM2TrackerApp:
         self.color_map = {}  # 類別顏色映射 (存儲(R, G, B, Alpha)元組)
         self.alpha_map = {}  # 類別透明度映射
         self.generate_color_map()  # 生成初始顏色映射
+        self.auto_prompt_config = dict(DEFAULT_AUTO_PROMPT_CONFIG)  # YOLOE自動框選配置
+        self.auto_prompter = None  # YOLOE自動框選器 (首次使用時才載入模型)
+        self.realtime_config = dict(DEFAULT_REALTIME_CONFIG)  # 即時影像模式配置
+        self.live_source_spec = None  # 即時影像來源 (攝影機編號/串流URL)，None表示一般視頻檔案
+        self.frame_source_config = dict(DEFAULT_FRAME_SOURCE_CONFIG)  # 幀解碼配置
+        self.memory_config = dict(DEFAULT_MEMORY_CONFIG)  # 記憶體監控配置
+        self.memory_sessions = SessionHistory()  # 跨多次追蹤的記憶體記錄
+        self.optimization_config = dict(DEFAULT_OPTIMIZATION_CONFIG)  # SAM2量化/編譯最佳化配置
+        self.preview_config = dict(DEFAULT_PREVIEW_CONFIG)  # 框選mask預覽配置
+        self.box_previewer = None  # 框選mask預覽器 (快取框選畫面的圖像嵌入)
+        self.preview_masks = {}  # 框 (tuple) -> 預覽mask (CroppedMask)，只在更換框選畫面時清除
+        self.service_config = dict(DEFAULT_SERVICE_CONFIG)  # 本機追蹤服務配置 (GUI作為客戶端提交工作)
+        self.service_job = None  # 最近一次提交到服務的工作狀態 (由背景執行緒更新)
+        self.display_config = dict(DEFAULT_DISPLAY_CONFIG)  # 追蹤視窗顯示配置
+        self.motion_gate_config = dict(DEFAULT_MOTION_GATE_CONFIG)  # 靜止幀略過推論配置
+        self.object_sharding_config = dict(DEFAULT_OBJECT_SHARDING_CONFIG)  # 物件分組平行追蹤配置
+        self.feature_store_config = dict(DEFAULT_FEATURE_STORE_CONFIG)  # 圖像編碼器特徵存放區配置
+        self.segmented_output_config = dict(DEFAULT_SEGMENTED_OUTPUT_CONFIG)  # 分段輸出視頻配置
+        self.track_health_config = dict(DEFAULT_TRACK_HEALTH_CONFIG)  # 追蹤健康監測配置
+        self.encoder_lookahead_config = dict(DEFAULT_ENCODER_LOOKAHEAD_CONFIG)  # 圖像編碼器批次預讀配置
+        self.mask_postprocess_config = dict(DEFAULT_MASK_POSTPROCESS_CONFIG)  # 輸出mask後處理配置
+        self.review_config = dict(DEFAULT_REVIEW_CONFIG)  # 追蹤結果檢視配置
+        self.last_archive_path = None  # 最近一次追蹤的mask存檔 (結果檢視視窗的資料來源)
+        self.review_window = None
 
         # 設定配置文件路徑
         self.config_path = "./sam2_config.json"
 
-        # 選擇影片檔案
-        self.video_path = filedialog.askopenfilename(
-            title="選擇影片檔案",
-            initialdir="./test_data/",
-            filetypes=[
-                ("Video files", "*.mp4 *.avi *.mov *.mkv *.wmv *.flv *.m4v"),
-                ("All files", "*.*")
-            ]
-        )
+        # 解碼配置 (縮放) 需要在讀取第一幀前加載
+        self.load_frame_source_config()
+
+        # 選擇影片檔案 (選擇影像檔案時使用其所在目錄作為影像序列)
+        self.video_path = resolve_frame_source(self.ask_video_path())
 
         if not self.video_path:
             print("未選擇視頻檔案")
             return
 
-        # 加載視頻和第一幀
-        self.cap = cv2.VideoCapture(self.video_path)
-        success, self.frame_orig = self.cap.read()
+        # 探測來源 (FPS、幀數、尺寸只讀取一次並快取) 並取得第一幀
+        self.source_info = probe_source(self.video_path)
+        self.frame_orig = None
+        if self.source_info is not None:
+            self.frame_orig = self.source_info.first_frame(self.frame_source_config['max_side'])
 
-        if not success:
+        if self.frame_orig is None:
             print("無法讀取視頻檔案")
             return
 
         self.orig_h, self.orig_w = self.frame_orig.shape[:2]
+        print(self.source_info.format())
 
-        # 創建SAM2VideoPredictor
-        overrides = dict(
+        # 創建SAM2VideoPredictor (device/imgsz/執行緒數由校準工具寫入的本機硬體設定覆寫)
+        self.machine_profile = load_machine_profile(self.config_path)
+        overrides = apply_machine_profile(dict(
             conf=0.25,
             device='cuda',
             task="segment",
             mode="predict",
             imgsz=1024,
             model="./models/sam2.1_t.pt"
-        )
+        ), self.machine_profile)
         self.predictor = SAM2VideoPredictor(overrides=overrides)
 
         # 保存基本配置，以便稍後根據需要創建不同配置的predictor
@@ -79,6 +126,32 @@ class SAM2TrackerApp:
             # 更新UI控件以顯示當前類別的顏色和透明度值
             self.on_class_selected()
 
+        # 在背景計算框選畫面的圖像嵌入，供框選時即時預覽mask
+        if self.preview_config.get('enabled'):
+            self.box_previewer = BoxMaskPreviewer(self.base_overrides, self.optimization_config)
+            self.reset_preview()
+
+    def ask_video_path(self):
+        """選擇影片檔案或影像序列中的任一幀"""
+        return filedialog.askopenfilename(
+            title="選擇影片檔案或影像序列",
+            initialdir="./test_data/",
+            filetypes=[
+                ("Video files", "*.mp4 *.avi *.mov *.mkv *.wmv *.flv *.m4v"),
+                ("Image sequence", "*.jpg *.jpeg *.png *.bmp *.tif *.tiff *.webp"),
+                ("All files", "*.*")
+            ]
+        )
+
+    def load_frame_source_config(self):
+        """加載幀解碼配置"""
+        if os.path.exists(self.config_path):
+            try:
+                with open(self.config_path, 'r', encoding='utf-8') as f:
+                    self.frame_source_config.update(json.load(f).get('frame_source', {}))
+            except Exception as e:
+                print(f"加載解碼配置時出錯: {e}")
+
     def load_config(self):
         """加載配置檔案"""
         if os.path.exists(self.config_path):
@@ -102,6 +175,66 @@ class SAM2TrackerApp:
                 if 'alpha_map' in config:
                     self.alpha_map = config['alpha_map']
 
+                # 加載YOLOE自動框選配置
+                if 'auto_prompt' in config:
+                    self.auto_prompt_config.update(config['auto_prompt'])
+
+                # 加載即時影像模式配置
+                if 'realtime' in config:
+                    self.realtime_config.update(config['realtime'])
+
+                # 加載記憶體監控配置
+                if 'memory' in config:
+                    self.memory_config.update(config['memory'])
+
+                # 加載SAM2最佳化配置
+                if 'optimization' in config:
+                    self.optimization_config.update(config['optimization'])
+
+                # 加載框選預覽配置
+                if 'preview' in config:
+                    self.preview_config.update(config['preview'])
+
+                # 加載追蹤服務配置
+                if 'service' in config:
+                    self.service_config.update(config['service'])
+
+                # 加載追蹤視窗顯示配置
+                if 'display' in config:
+                    self.display_config.update(config['display'])
+
+                # 加載靜止幀略過推論配置
+                if 'motion_gate' in config:
+                    self.motion_gate_config.update(config['motion_gate'])
+
+                # 加載物件分組平行追蹤配置
+                if 'object_sharding' in config:
+                    self.object_sharding_config.update(config['object_sharding'])
+
+                # 加載圖像編碼器特徵存放區配置
+                if 'feature_store' in config:
+                    self.feature_store_config.update(config['feature_store'])
+
+                # 加載分段輸出視頻配置
+                if 'segmented_output' in config:
+                    self.segmented_output_config.update(config['segmented_output'])
+
+                # 加載追蹤健康監測配置
+                if 'track_health' in config:
+                    self.track_health_config.update(config['track_health'])
+
+                # 加載圖像編碼器批次預讀配置
+                if 'encoder_lookahead' in config:
+                    self.encoder_lookahead_config.update(config['encoder_lookahead'])
+
+                # 加載輸出mask後處理配置
+                if 'mask_postprocess' in config:
+                    self.mask_postprocess_config.update(config['mask_postprocess'])
+
+                # 加載追蹤結果檢視配置
+                if 'review' in config:
+                    self.review_config.update(config['review'])
+
                 # 生成缺失的顏色和透明度映射
                 self.generate_color_map()
 
@@ -180,6 +313,10 @@ class SAM2TrackerApp:
         self.reselect_btn = ttk.Button(button_frame, text="重新選擇檔案", command=self.reselect_video)
         self.reselect_btn.pack(side=tk.LEFT, padx=(0, 10))
 
+        # 即時影像來源按鈕 (攝影機/串流)
+        self.live_source_btn = ttk.Button(button_frame, text="即時影像來源", command=self.select_live_source)
+        self.live_source_btn.pack(side=tk.LEFT, padx=(0, 10))
+
         # 重置按鈕
         self.reset_btn = ttk.Button(button_frame, text="重置選擇", command=self.reset_selections)
         self.reset_btn.pack(side=tk.LEFT, padx=(0, 10))
@@ -192,6 +329,20 @@ class SAM2TrackerApp:
         self.save_masks_only_btn = ttk.Button(button_frame, text="儲存Mask影片: 否", command=self.toggle_save_masks_only)
         self.save_masks_only_btn.pack(side=tk.LEFT, padx=(0, 10))
 
+        # YOLOE自動框選按鈕
+        self.auto_prompt_btn = ttk.Button(button_frame, text="YOLOE自動框選", command=self.auto_detect_prompts)
+        self.auto_prompt_btn.pack(side=tk.LEFT, padx=(0, 10))
+
+        # 提交到本機追蹤服務按鈕 (由服務中常駐的模型執行追蹤)
+        self.submit_service_btn = ttk.Button(button_frame, text="提交到追蹤服務", command=self.submit_to_service)
+        self.submit_service_btn.pack(side=tk.LEFT, padx=(0, 10))
+        self.service_status_var = tk.StringVar(value="")
+        ttk.Label(button_frame, textvariable=self.service_status_var).pack(side=tk.LEFT)
+
+        # 檢視追蹤結果按鈕 (從mask存檔重播，不重新推論)
+        self.review_btn = ttk.Button(button_frame, text="檢視追蹤結果", command=self.open_review)
+        self.review_btn.pack(side=tk.LEFT, padx=(10, 0))
+
         # 類別控制框架
         class_control_frame = ttk.Frame(left_control_frame)
         class_control_frame.pack(fill=tk.X, pady=(5, 0))
@@ -300,6 +451,9 @@ class SAM2TrackerApp:
         # 調整圖像大小
         resized_image = cv2.resize(image_rgb, (new_w, new_h))
 
+        # 疊加框選的預覽mask
+        self.blend_previews(resized_image)
+
         # 轉換為PIL Image
         pil_image = Image.fromarray(resized_image)
         self.photo = ImageTk.PhotoImage(pil_image)
@@ -318,6 +472,46 @@ class SAM2TrackerApp:
         # 重新繪製已有的矩形框
         self.redraw_existing_boxes()
 
+    def reset_preview(self):
+        """框選畫面已更換: 清除預覽mask並在背景重新計算圖像嵌入"""
+        self.preview_masks = {}
+        if self.box_previewer is not None:
+            self.box_previewer.set_frame(self.frame_orig)
+
+    def refresh_previews(self):
+        """為尚未預覽的框預測mask，圖像嵌入尚未完成時稍後再試"""
+        if self.box_previewer is None:
+            return
+        pending = [tuple(prompt['bbox']) for prompt in self.prompts
+                   if tuple(prompt['bbox']) not in self.preview_masks]
+        if not pending:
+            return
+        if not self.box_previewer.ready:
+            self.root.after(self.preview_config.get('poll_ms', 50), self.refresh_previews)
+            return
+        for box in pending:
+            mask = self.box_previewer.predict(box)
+            if mask is None:
+                self.root.after(self.preview_config.get('poll_ms', 50), self.refresh_previews)
+                break
+            self.preview_masks[box] = mask
+            print(f"框 {list(box)} 的預覽mask: {self.box_previewer.decode_ms:.1f} ms "
+                  f"(圖像嵌入 {self.box_previewer.embed_ms:.0f} ms，已快取)")
+        self.display_image(self.frame_orig)
+
+    def blend_previews(self, resized_image):
+        """把已預測的預覽mask依類別顏色混合到縮放後的RGB畫面上 (原地修改)"""
+        previewed = [prompt for prompt in self.prompts if tuple(prompt['bbox']) in self.preview_masks]
+        if not previewed:
+            return
+        # 後畫的框覆蓋先畫的框
+        label_map = np.zeros(self.frame_orig.shape[:2], dtype=np.uint8)
+        for label, prompt in enumerate(previewed[:254], start=1):
+            self.preview_masks[tuple(prompt['bbox'])].paint(label_map, label)  # 只寫入物件框內的像素
+        label_map = cv2.resize(label_map, resized_image.shape[1::-1], interpolation=cv2.INTER_NEAREST)
+        colors, alphas = self.build_label_colors(previewed, range(len(previewed)))
+        blend_label_map(resized_image, label_map, colors[:, ::-1], alphas)
+
     def redraw_existing_boxes(self):
         # 重新繪製已選擇的框
         for prompt in self.prompts:
@@ -438,21 +632,59 @@ class SAM2TrackerApp:
             # 重新繪製所有邊界框以更新顏色和標籤
             self.redraw_existing_boxes()
 
+            # 以快取的圖像嵌入預覽新框的mask
+            self.refresh_previews()
+
+    def get_auto_prompter(self):
+        """取得YOLOE自動框選器，必要時載入模型並同步類別"""
+        if self.auto_prompter is None:
+            try:
+                self.auto_prompter = YOLOEAutoPrompter(
+                    self.classes,
+                    model_path=self.auto_prompt_config['model'],
+                    conf=self.auto_prompt_config['conf'],
+                    device=self.auto_prompt_config.get('device') or self.base_overrides['device']
+                )
+            except Exception as e:
+                print(f"載入YOLOE模型時出錯: {e}")
+                self.auto_prompter = None
+        elif self.auto_prompter.classes != self.classes:
+            self.auto_prompter.set_classes(self.classes)
+        return self.auto_prompter
+
+    def auto_detect_prompts(self):
+        """使用YOLOE文字提示 (類別名稱) 在第一幀自動產生框提示"""
+        auto_prompter = self.get_auto_prompter()
+        if auto_prompter is None:
+            return
+
+        detections = auto_prompter.detect(self.frame_orig)
+        # 略過與已有框重疊的偵測結果，避免重複按下時產生重複的提示
+        existing_boxes = [prompt['bbox'] for prompt in self.prompts]
+        new_prompts = filter_new_prompts(detections, existing_boxes, self.auto_prompt_config['iou_threshold'])
+        if not new_prompts:
+            print("YOLOE未偵測到新的物件")
+            return
+
+        for prompt in new_prompts:
+            self.prompts.append({
+                'bbox': prompt['bbox'],
+                'class': prompt['class']
+            })
+        print(f"YOLOE自動產生 {len(new_prompts)} 個框提示")
+
+        # 重新顯示圖像以繪製新的框
+        self.display_image(self.frame_orig)
+        self.refresh_previews()
+
     def reset_selections(self):
         self.prompts = []
         self.display_image(self.frame_orig)
 
     def reselect_video(self):
         """重新選擇視頻檔案"""
-        # 選擇新的影片檔案
-        new_video_path = filedialog.askopenfilename(
-            title="選擇影片檔案",
-            initialdir="./test_data/",
-            filetypes=[
-                ("Video files", "*.mp4 *.avi *.mov *.mkv *.wmv *.flv *.m4v"),
-                ("All files", "*.*")
-            ]
-        )
+        # 選擇新的影片檔案或影像序列
+        new_video_path = resolve_frame_source(self.ask_video_path())
 
         if not new_video_path:
             print("未選擇新的視頻檔案")
@@ -460,17 +692,22 @@ class SAM2TrackerApp:
 
         # 更新視頻路徑
         self.video_path = new_video_path
+        self.live_source_spec = None
 
-        # 重新加載視頻和第一幀
-        self.cap.release()  # 釋放當前視頻捕獲對象
-        self.cap = cv2.VideoCapture(self.video_path)
-        success, self.frame_orig = self.cap.read()
+        # 重新探測來源並加載第一幀
+        self.source_info = probe_source(self.video_path)
+        frame = None
+        if self.source_info is not None:
+            frame = self.source_info.first_frame(self.frame_source_config['max_side'])
 
-        if not success:
+        if frame is None:
             print("無法讀取新的視頻檔案")
             return
+        self.frame_orig = frame
+        print(self.source_info.format())
 
         self.orig_h, self.orig_w = self.frame_orig.shape[:2]
+        self.reset_preview()
 
         # 重置所有選擇和狀態
         self.prompts = []
@@ -482,6 +719,53 @@ class SAM2TrackerApp:
         self.display_image(self.frame_orig)
         print(f"已更換視頻檔案: {self.video_path}")
 
+    def select_live_source(self):
+        """選擇即時影像來源 (攝影機編號、RTSP等串流URL，或以實際時間重播的視頻檔案)"""
+        import tkinter.simpledialog
+
+        spec = tkinter.simpledialog.askstring(
+            "即時影像來源",
+            "請輸入攝影機編號 (例如 0) 或串流URL\n輸入視頻檔案路徑則以實際時間重播:",
+            initialvalue=self.live_source_spec or "0"
+        )
+        if spec is None or not spec.strip():
+            return
+
+        # 讀取一幀作為框選畫面
+        try:
+            frame = LiveFrameSource(spec.strip()).snapshot()
+        except Exception as e:
+            print(f"開啟即時影像來源時出錯: {e}")
+            return
+        if frame is None:
+            print("無法從即時影像來源讀取畫面")
+            return
+
+        self.live_source_spec = spec.strip()
+        self.video_path = self.live_source_spec
+        self.source_info = None
+        self.frame_orig = frame
+        self.orig_h, self.orig_w = self.frame_orig.shape[:2]
+        self.reset_preview()
+
+        # 重置所有選擇和狀態
+        self.prompts = []
+        self.roi_start = None
+        self.drawing = False
+        self.current_rect = None
+
+        self.display_image(self.frame_orig)
+        print(f"已切換到即時影像來源: {self.live_source_spec}")
+
+    def get_video_info(self, live_source=None):
+        """獲取輸出視頻所需的 (fps, width, height)"""
+        if live_source is not None:
+            return int(round(live_source.fps)), self.orig_w, self.orig_h
+
+        # 輸出尺寸與載入 (可能已縮放) 的幀相同，FPS使用探測時取得的精確分數 (例如30000/1001)
+        fps = float(self.source_info.output_fps(self.frame_source_config['sequence_fps']))
+        return fps, self.orig_w, self.orig_h
+
     def toggle_save_video(self):
         """切換是否儲存影片的狀態"""
         self.save_video = not self.save_video
@@ -645,6 +929,8 @@ class SAM2TrackerApp:
 
             # 立即刷新顯示，更新所有相同類別的框的顏色
             self.display_image(self.frame_orig)
+            if self.review_window is not None:
+                self.review_window.refresh()
 
             # 立即儲存配置
             self.save_config()
@@ -656,11 +942,33 @@ class SAM2TrackerApp:
     def save_config(self):
         """儲存配置檔案"""
         try:
-            config = {
+            # 保留配置檔案中其他區段的設定
+            config = {}
+            if os.path.exists(self.config_path):
+                with open(self.config_path, 'r', encoding='utf-8') as f:
+                    config = json.load(f)
+
+            config.update({
                 'classes': self.classes,
                 'color_map': {class_name: list(color) for class_name, color in self.color_map.items()},
-                'alpha_map': self.alpha_map
-            }
+                'alpha_map': self.alpha_map,
+                'auto_prompt': self.auto_prompt_config,
+                'realtime': self.realtime_config,
+                'frame_source': self.frame_source_config,
+                'memory': self.memory_config,
+                'optimization': self.optimization_config,
+                'preview': self.preview_config,
+                'service': self.service_config,
+                'display': self.display_config,
+                'motion_gate': self.motion_gate_config,
+                'object_sharding': self.object_sharding_config,
+                'feature_store': self.feature_store_config,
+                'segmented_output': self.segmented_output_config,
+                'track_health': self.track_health_config,
+                'encoder_lookahead': self.encoder_lookahead_config,
+                'mask_postprocess': self.mask_postprocess_config,
+                'review': self.review_config
+            })
 
             with open(self.config_path, 'w', encoding='utf-8') as f:
                 json.dump(config, f, ensure_ascii=False, indent=2)
@@ -718,6 +1026,160 @@ class SAM2TrackerApp:
             # 重新顯示圖像以更新顯示
             self.display_image(self.frame_orig)
 
+    def open_review(self, archive_path=None):
+        """開啟追蹤結果檢視視窗 (預設為最近一次追蹤的mask存檔，沒有時選擇存檔目錄)"""
+        archive_path = archive_path or self.last_archive_path
+        if not archive_path:
+            archive_path = filedialog.askdirectory(title="選擇mask存檔目錄", initialdir="./output")
+            if not archive_path:
+                return
+        if self.review_window is not None:
+            self.review_window.close()
+
+        def on_close():
+            self.review_window = None
+
+        try:
+            # 類別顏色在每次繪製時讀取，設置顏色後檢視視窗立即更新
+            self.review_window = ReviewWindow(self.root, archive_path, lambda: (self.color_map, self.alpha_map),
+                                              config=self.review_config, display_config=self.display_config,
+                                              on_close=on_close)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"無法開啟追蹤結果: {e}")
+
+    def submit_to_service(self):
+        """把目前的框提示作為追蹤工作提交到本機追蹤服務，並在背景跟隨進度"""
+        if not self.prompts:
+            print("請至少選擇一個區域")
+            return
+        if self.live_source_spec is not None:
+            print("追蹤服務只支援視頻檔案和影像序列")
+            return
+        if self.service_job is not None and self.service_job.get('status') in ('queued', 'running'):
+            print(f"工作 {self.service_job['id']} 尚未結束")
+            return
+
+        client = TrackingClient(service_url(self.service_config))
+        try:
+            job = client.submit(
+                os.path.abspath(self.video_path),
+                [dict(prompt) for prompt in self.prompts],
+                save_video=self.save_video,
+                save_masks_only=self.save_masks_only,
+                max_side=self.frame_source_config['max_side']
+            )
+        except Exception as e:
+            print(f"提交到追蹤服務時出錯: {e}")
+            self.service_status_var.set("服務無法連線")
+            return
+        print(f"已提交工作 {job['id']} 到 {client.url} (排隊位置: {job.get('position')})")
+        self.service_job = job
+
+        # 背景執行緒讀取事件串流，GUI以root.after輪詢最新狀態 (Tk元件只在主執行緒中更新)
+        threading.Thread(target=self.follow_service_job, args=(client, job['id']), daemon=True).start()
+        self.poll_service_job()
+
+    def follow_service_job(self, client, job_id):
+        """讀取服務的事件串流並更新最新的工作狀態"""
+        try:
+            for event in client.events(job_id):
+                job = dict(self.service_job)
+                if event['type'] == 'status':
+                    job['status'] = event['status']
+                    job['outputs'] = event.get('outputs', job.get('outputs'))
+                    job['error'] = event.get('error')
+                elif event['type'] == 'frame':
+                    job.update(frame=event['frame'] + 1, total=event['total'], fps=event['fps'])
+                self.service_job = job
+        except Exception as e:
+            self.service_job = dict(self.service_job, status='failed', error=f"事件串流中斷: {e}")
+
+    def poll_service_job(self):
+        """在GUI上顯示服務工作的進度，直到工作結束"""
+        job = self.service_job
+        if job is None:
+            return
+        status = job.get('status')
+        if status == 'queued':
+            self.service_status_var.set(f"{job['id']}: 排隊中 (前面 {job.get('position') or 0} 個)")
+        elif status == 'running':
+            total = f"/{job['total']}" if job.get('total') else ""
+            self.service_status_var.set(f"{job['id']}: {job.get('frame', 0)}{total} 幀, {job.get('fps', 0):.1f} FPS")
+        else:
+            self.service_status_var.set(f"{job['id']}: {status}")
+            if status == 'done':
+                print(f"服務工作 {job['id']} 完成，輸出: {job.get('outputs')}")
+            elif job.get('error'):
+                print(f"服務工作 {job['id']} {status}: {job['error']}")
+            return
+        self.root.after(200, self.poll_service_job)
+
+    def build_label_colors(self, track_prompts, obj_ids):
+        """建立標籤圖的BGR顏色和透明度查找表 (標籤i+1對應obj_ids[i])"""
+        labels_to_colors = []
+        for obj_id in obj_ids:
+            if obj_id >= len(track_prompts):
+                labels_to_colors.append((None, None))
+                continue
+            class_name = track_prompts[obj_id]['class']
+
+            # 獲取該類別的顏色，將RGB轉換為BGR (OpenCV使用BGR順序)
+            color = self.color_map.get(class_name, (255, 0, 0))  # 默認為紅色
+            if isinstance(color, tuple) and len(color) == 3:
+                color_bgr = (color[2], color[1], color[0])
+            else:
+                color_bgr = (0, 0, 255)  # 默認為紅色 (BGR)
+
+            # 獲取該類別的透明度
+            alpha = self.alpha_map.get(class_name, 0.5)  # 默認透明度為0.5
+            labels_to_colors.append((color_bgr, alpha))
+        return build_label_luts(labels_to_colors)
+
+    def merge_redetections(self, auto_prompter, engine, track_prompts, frame_idx):
+        """將背景YOLOE偵測到的新物件加入追蹤 (從下一幀開始)
+
+        偵測的幀距離目前超過一個重新偵測間隔時，物件可能已移動，捨棄該結果。
+        """
+        max_age = int(self.auto_prompt_config.get('redetect_interval') or 0)
+        for det_frame_idx, detections, tracked_boxes in auto_prompter.poll():
+            if frame_idx - det_frame_idx > max_age:
+                print(f"第 {det_frame_idx} 幀的偵測結果已過時 (目前第 {frame_idx} 幀)，略過")
+                continue
+            new_prompts = filter_new_prompts(detections, tracked_boxes, self.auto_prompt_config['iou_threshold'])
+            if not new_prompts:
+                continue
+
+            engine.add_objects([prompt['bbox'] for prompt in new_prompts], frame_idx=frame_idx + 1)
+            for prompt in new_prompts:
+                track_prompts.append({
+                    'bbox': prompt['bbox'],
+                    'class': prompt['class']
+                })
+            print(f"第 {det_frame_idx} 幀偵測到 {len(new_prompts)} 個新物件，已加入追蹤")
+
+    def create_engine(self, overrides, num_frames, source_name, feature_store=None):
+        """建立追蹤引擎，提示數量達到門檻時依配置把物件分組到多個工作行程追蹤"""
+        if use_object_sharding(self.object_sharding_config, len(self.prompts)):
+            workers = self.object_sharding_config['workers']
+            print(f"{len(self.prompts)} 個物件分組到 {workers} 個工作行程追蹤")
+            if feature_store is not None:
+                print("物件分組模式不使用特徵存放區")
+            return ObjectShardedEngine(overrides, workers, num_frames=num_frames, source_name=source_name,
+                                       optimization=self.optimization_config)
+        return SAM2FrameEngine(overrides, num_frames=num_frames, source_name=source_name,
+                               optimization=self.optimization_config, feature_store=feature_store)
+
+    def open_feature_store(self, overrides):
+        """依來源、模型和imgsz開啟圖像編碼器特徵存放區 (未啟用或即時影像時回傳None)"""
+        if not self.feature_store_config.get('enabled') or self.live_source_spec is not None:
+            return None
+        store = FeatureStore.for_source(self.feature_store_config['root'], self.video_path, overrides['model'],
+                                        overrides['imgsz'], self.frame_source_config['max_side'],
+                                        self.optimization_config, writable=self.feature_store_config['write'])
+        cached = "已儲存全部幀" if store.complete else "缺少的幀會在追蹤時計算並儲存"
+        print(f"使用特徵存放區: {store.path} ({cached})")
+        return store
+
     def start_tracking(self):
         if not self.prompts:
             print("請先選擇至少一個區域")
@@ -725,9 +1187,6 @@ class SAM2TrackerApp:
 
         print(f"已選擇 {len(self.prompts)} 個區域: {self.prompts}")
 
-        # 釋放視頻捕獲對象
-        self.cap.release()
-
         # 隱藏主窗口
         self.root.withdraw()
 
@@ -749,12 +1208,33 @@ class SAM2TrackerApp:
         stop_btn = ttk.Button(button_frame, text="停止追蹤", command=lambda: stop_tracking())
         stop_btn.pack(side=tk.LEFT, padx=5, pady=5)
 
+        # 暫停並修正按鈕 (在目前的幀上新增或取代框，從這一幀繼續傳播)
+        pause_btn = ttk.Button(button_frame, text="暫停並修正", command=lambda: toggle_pause())
+        pause_btn.pack(side=tk.LEFT, padx=5, pady=5)
+
+        # 即時影像模式的延遲和丟棄統計
+        live_source = None
+        frame_reader = None
+        lookahead = None  # 圖像編碼器批次預讀 (只用於視頻檔案和影像序列)
+        track_seconds = [0.0]  # 取幀加推論的累計時間，用於計算推論吞吐量
+        latency_tracker = None
+        latency_var = tk.StringVar(value="")
+        latency_reported = [False]
+        if self.live_source_spec is not None:
+            live_source = LiveFrameSource(self.live_source_spec, self.realtime_config['replay_realtime'])
+            latency_tracker = LatencyTracker(self.realtime_config['max_latency_ms'])
+            ttk.Label(button_frame, textvariable=latency_var).pack(side=tk.LEFT, padx=5)
+
         tracking_canvas = tk.Canvas(tracking_window, bg='black')
         tracking_canvas.pack(fill=tk.BOTH, expand=True)
 
         # 保存對象引用以避免被垃圾回收
         self.tracking_canvas = tracking_canvas
 
+        # 顯示以固定幀率只繪製最新的結果，與追蹤速度脫鉤
+        frame_display = FrameDisplay(tracking_canvas, self.display_config['fps'],
+                                     self.display_config['interpolation'])
+
         # 追蹤是否停止的標誌
         self.tracking_stopped = False
 
@@ -770,20 +1250,14 @@ class SAM2TrackerApp:
             os.makedirs(output_dir, exist_ok=True)
 
             # 獲取視頻的基本信息
-            cap_info = cv2.VideoCapture(self.video_path)
-            fps = int(cap_info.get(cv2.CAP_PROP_FPS))
-            width = int(cap_info.get(cv2.CAP_PROP_FRAME_WIDTH))
-            height = int(cap_info.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            cap_info.release()
+            fps, width, height = self.get_video_info(live_source)
 
             # 生成輸出視頻路徑
-            import time
             timestamp = time.strftime("%Y%m%d_%H%M%S")
             self.output_path = os.path.join(output_dir, f"tracking_result_{timestamp}.mp4")
 
-            # 初始化視頻寫入器
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-            video_writer = cv2.VideoWriter(self.output_path, fourcc, fps, (width, height))
+            # 初始化視頻寫入器 (分段寫入，當機時已完成的分段仍可播放)
+            video_writer = open_video_writer(self.output_path, fps, (width, height), self.segmented_output_config)
 
             print(f"開始儲存視頻到: {self.output_path}")
 
@@ -793,24 +1267,19 @@ class SAM2TrackerApp:
             os.makedirs(output_dir, exist_ok=True)
 
             # 獲取視頻的基本信息
-            cap_info = cv2.VideoCapture(self.video_path)
-            fps = int(cap_info.get(cv2.CAP_PROP_FPS))
-            width = int(cap_info.get(cv2.CAP_PROP_FRAME_WIDTH))
-            height = int(cap_info.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            cap_info.release()
+            fps, width, height = self.get_video_info(live_source)
 
             # 生成輸出Mask視頻路徑
-            import time
             timestamp = time.strftime("%Y%m%d_%H%M%S")
             self.mask_output_path = os.path.join(output_dir, f"mask_result_{timestamp}.mp4")
 
             # 初始化Mask視頻寫入器
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-            mask_video_writer = cv2.VideoWriter(self.mask_output_path, fourcc, fps, (width, height))
+            mask_video_writer = open_video_writer(self.mask_output_path, fps, (width, height),
+                                                  self.segmented_output_config)
 
             print(f"開始儲存Mask視頻到: {self.mask_output_path}")
 
-        # 創建新的predictor實例以確保每次都能正確開始
+        # 創建新的追蹤引擎實例以確保每次都能正確開始
         overrides = self.base_overrides.copy()
         # 移除原本的儲存設置，因為我們將手動處理
         if 'save' in overrides:
@@ -818,26 +1287,361 @@ class SAM2TrackerApp:
         if 'project' in overrides:
             del overrides['project']
 
-        fresh_predictor = SAM2VideoPredictor(overrides=overrides)
+        # 本次追蹤使用的提示，自動重新偵測到的新物件會依物件編號追加在後面
+        track_prompts = [dict(prompt) for prompt in self.prompts]
+
+        # YOLOE自動重新偵測 (在背景執行緒中與SAM2傳播並行)
+        redetect_interval = int(self.auto_prompt_config.get('redetect_interval') or 0)
+        auto_prompter = self.get_auto_prompter() if redetect_interval > 0 else None
+        if auto_prompter is not None:
+            auto_prompter.new_session()  # 上一次追蹤尚未完成的偵測結果不會合併到這次
+            auto_prompter.start()
+
+        # 記憶體監控 (RSS、Python堆積和torch配置器)
+        memory_monitor = None
+        if self.memory_config.get('enabled'):
+            memory_monitor = MemoryMonitor(
+                sample_interval=self.memory_config['sample_interval'],
+                tracemalloc_top=self.memory_config['tracemalloc_top'],
+                growth_threshold_mb=self.memory_config['growth_threshold_mb']
+            )
+            memory_monitor.start()
 
+        feature_store = None  # 圖像編碼器特徵存放區 (重複追蹤同一來源時略過圖像編碼器)
         try:
-            results = fresh_predictor(
-                source=self.video_path,
-                bboxes=bboxes_for_tracking,
-                stream=True
-            )
+            if live_source is not None:
+                # 即時影像: 框選畫面作為第0幀，之後只處理最新的幀
+                live_source.open()
+                engine = self.create_engine(overrides, None, self.live_source_spec)
+                frames = realtime_frames(live_source, latency_tracker, first_frame=self.frame_orig)
+            else:
+                feature_store = self.open_feature_store(overrides)
+                engine = self.create_engine(overrides, self.source_info.frame_count, self.video_path, feature_store)
+                # 解碼在背景執行緒中領先推論進行
+                frame_reader = PrefetchFrameReader(
+                    self.video_path,
+                    prefetch=self.frame_source_config['prefetch'],
+                    workers=self.frame_source_config['decode_workers'],
+                    max_side=self.frame_source_config['max_side']
+                )
+                frames = iter(frame_reader)
+            engine.add_objects(bboxes_for_tracking, frame_idx=0)
+
+            # 靜止幀沿用前一幀的mask，不執行SAM2推論
+            motion_gate = None
+            if self.motion_gate_config.get('enabled'):
+                motion_gate = MotionGate(
+                    size=self.motion_gate_config['size'],
+                    pixel_threshold=self.motion_gate_config['pixel_threshold'],
+                    changed_ratio=self.motion_gate_config['changed_ratio'],
+                    margin=self.motion_gate_config['margin'],
+                    refresh_interval=self.motion_gate_config['refresh_interval']
+                )
+                results = gated_track(engine, frames, motion_gate)
+            elif use_lookahead(self.encoder_lookahead_config, engine, live=live_source is not None):
+                # 圖像編碼器在背景執行緒中批次領先執行 (即時影像只處理最新的幀，不預讀)
+                lookahead = EncoderLookahead(self.encoder_lookahead_config['batch_size'],
+                                             self.encoder_lookahead_config['buffer'])
+                results = lookahead_track(engine, frames, lookahead)
+            else:
+                results = engine.track(frames)
         except Exception as e:
             print(f"初始化追蹤時出錯: {e}")
+            if auto_prompter is not None:
+                auto_prompter.close()
+            if memory_monitor is not None:
+                memory_monitor.stop()
             tracking_window.destroy()
             self.root.deiconify()  # 重新顯示主視窗
             return
 
-        def stop_tracking():
-            """停止追蹤並關閉視窗"""
-            self.tracking_stopped = True
+        def report_latency():
+            """輸出即時影像模式的延遲統計，儲存影片時一併寫入JSON"""
+            if latency_tracker is None or latency_reported[0]:
+                return
+            latency_reported[0] = True
+            summary = latency_tracker.summary(live_source)
+            print(f"即時影像統計: {latency_tracker.format(live_source)}")
+            output_path = self.output_path or self.mask_output_path
+            if output_path:
+                with open(os.path.splitext(output_path)[0] + "_latency.json", 'w', encoding='utf-8') as f:
+                    json.dump(summary, f, ensure_ascii=False, indent=2)
+
+        # 追蹤健康監測: 物件退化時以最後的健康框 (或YOLOE偵測) 自動重新提示
+        track_health = None
+        health_detect = None
+        if self.track_health_config.get('enabled'):
+            track_health = TrackHealthMonitor(self.track_health_config, fps=self.get_video_info(live_source)[0])
+            if self.track_health_config['reseed'] == "yoloe":
+                health_prompter = self.get_auto_prompter()
+                health_detect = health_prompter.detect if health_prompter is not None else None
+        health_reported = [False]
+
+        def report_track_health():
+            """輸出健康事件統計，有事件時把事件記錄寫入JSON (幀編號和時間可直接對應輸出視頻)"""
+            if track_health is None or health_reported[0]:
+                return
+            health_reported[0] = True
+            print(track_health.format())
+            if not track_health.events:
+                return
+            output_path = self.output_path or self.mask_output_path
+            if output_path:
+                log_path = os.path.splitext(output_path)[0] + "_track_health.json"
+            else:
+                os.makedirs("./output", exist_ok=True)
+                log_path = os.path.join("./output", f"track_health_{time.strftime('%Y%m%d_%H%M%S')}.json")
+            track_health.write_log(log_path)
+            print(f"追蹤健康事件記錄已儲存: {log_path}")
+
+        gate_reported = [False]
+
+        def report_motion_gate():
+            """輸出推論/沿用的幀數，儲存影片時把逐幀記錄寫入JSON"""
+            if motion_gate is None or gate_reported[0]:
+                return
+            gate_reported[0] = True
+            print(motion_gate.format())
+            output_path = self.output_path or self.mask_output_path
+            if output_path:
+                with open(os.path.splitext(output_path)[0] + "_motion_gate.json", 'w', encoding='utf-8') as f:
+                    json.dump(motion_gate.summary(), f, ensure_ascii=False, indent=2)
+
+        session_ended = [False]
+        last_frame_idx = [0]
+
+        def end_session():
+            """釋放本次追蹤的模型和狀態，並輸出記憶體報告"""
+            if session_ended[0]:
+                return
+            session_ended[0] = True
+            frame_display.stop()
+            if auto_prompter is not None:
+                auto_prompter.close()  # 停止背景偵測，進行中的偵測結果作廢
+            results.close()
+            engine.close()
+            if feature_store is not None:
+                print(feature_store.format())
+                feature_store.close()
+            if memory_monitor is None:
+                return
+
+            report = memory_monitor.stop(last_frame_idx[0])
+            self.memory_sessions.growth_threshold_mb = self.memory_config['growth_threshold_mb']
+            session = self.memory_sessions.record()
+            report['session_end'] = session
+            report['sessions'] = self.memory_sessions.check()
+            print(MemoryMonitor.format(report))
+            print(f"追蹤結束後RSS: {session['rss_mb']:.1f} MB (第 {len(self.memory_sessions.sessions)} 次追蹤)")
+            for key, result in report['sessions'].items():
+                if result['leak']:
+                    print(f"疑似記憶體洩漏: {key} 在多次追蹤之間持續增長 {result['growth_mb']:.1f} MB")
+
+            output_dir = "./output"
+            os.makedirs(output_dir, exist_ok=True)
+            report_path = os.path.join(output_dir, f"memory_{time.strftime('%Y%m%d_%H%M%S')}.json")
+            with open(report_path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"記憶體報告已儲存: {report_path}")
+
+        pending_output = [None]  # 已顯示但尚未寫入輸出的最新結果 (暫停時仍可修正)
+        composite = [None]  # 覆蓋視頻的混合緩衝區 (解碼的幀為唯讀，與顯示和推論共用)
+
+        # 輸出mask後處理 (移除斑點、填補孔洞、平滑、依類別優先權處理重疊)，在工作執行緒池中
+        # 介於推論和寫入器之間進行；追蹤視窗仍顯示原始的mask
+        # 追蹤結果以解碼解析度存入mask存檔，作為結果檢視視窗和框修正重新追蹤的資料來源
+        # (即時影像沒有可重播的來源，不存檔)
+        archive_writer = [None]
+        save_archive = bool(self.review_config.get('save_archive')) and live_source is None
+        saving_output = video_writer is not None or mask_video_writer is not None or save_archive
+        mask_postprocessor = None
+        if self.mask_postprocess_config.get('enabled') and saving_output:
+            mask_postprocessor = MaskPostprocessor(self.mask_postprocess_config)
+
+        def write_archive(result, label_map):
+            """把一幀的標籤圖存入mask存檔，標籤改為物件編號+1 (中途新增或取代的物件不影響既有的標籤)"""
+            if archive_writer[0] is None:
+                os.makedirs("./output", exist_ok=True)
+                archive_path = os.path.join("./output", f"masks_{time.strftime('%Y%m%d_%H%M%S')}")
+                archive_writer[0] = MaskArchiveWriter(archive_path, *label_map.shape[:2], dtype=np.uint16,
+                                                      meta={'video': os.path.abspath(self.video_path),
+                                                            'fps': self.get_video_info()[0]})
+            lut = np.zeros(len(result.obj_ids) + 1, dtype=np.uint16)
+            lut[1:] = np.asarray(result.obj_ids, dtype=np.int64) + 1
+            archive_writer[0].write(result.frame_idx, lut[label_map])
+
+        def close_archive():
+            """寫入物件類別並關閉mask存檔"""
+            writer = archive_writer[0]
+            if writer is None:
+                return
+            archive_writer[0] = None
+            writer.obj_ids = list(range(len(track_prompts)))
+            writer.meta['classes'] = {str(obj_id): prompt['class'] for obj_id, prompt in enumerate(track_prompts)}
+            writer.close()
+            self.last_archive_path = writer.path
+            print(f"Mask存檔已儲存: {writer.path}")
+
+        def write_output(result, label_map):
+            """把一幀的標籤圖寫入視頻 (覆蓋視頻和Mask視頻) 和mask存檔"""
+            if save_archive:
+                write_archive(result, label_map)
+            label_colors, label_alphas = self.build_label_colors(track_prompts, result.obj_ids)
+
+            # 如果需要保存視頻，將混合後的幀寫入視頻文件
+            if video_writer is not None:
+                if composite[0] is None or composite[0].shape != result.orig_img.shape:
+                    composite[0] = np.empty_like(result.orig_img)
+                blend_label_map(result.orig_img, label_map, label_colors, label_alphas, out=composite[0])
+                video_writer.write(composite[0])
+
+            # 如果需要保存Mask視頻，生成純Mask幀並寫入視頻文件
+            if mask_video_writer is not None:
+                # 創建指定顏色背景的Mask幀 (RGB: 107, 142, 35 -> BGR: 35, 142, 107)
+                # 前景對象使用GUI設定的顏色和透明度混合到背景上
+                background_color = (35, 142, 107)  # BGR format
+                mask_frame = render_label_map(label_map, label_colors, label_alphas, background_color)
+                mask_video_writer.write(mask_frame)
+
+        def write_pending_output():
+            """把尚未寫入的結果寫入視頻 (啟用後處理時先交給工作執行緒池，依順序寫入已完成的幀)"""
+            result = pending_output[0]
+            if result is None:
+                return
+            pending_output[0] = None
+            if not saving_output:
+                return  # 沒有輸出時不建立原始尺寸的標籤圖
+            if mask_postprocessor is None:
+                write_output(result, result.label_map)
+                return
+            classes = [track_prompts[obj_id]['class'] for obj_id in result.obj_ids]
+            for done, label_map in mask_postprocessor.submit(result, result.label_map, classes):
+                write_output(done, label_map)
+
+        def flush_output():
+            """寫入所有尚未寫入的結果 (包含後處理中的幀)，在釋放寫入器之前呼叫"""
+            write_pending_output()
+            if mask_postprocessor is not None:
+                for done, label_map in mask_postprocessor.drain():
+                    write_output(done, label_map)
+                mask_postprocessor.close()
+                if mask_postprocessor.frames:
+                    print(mask_postprocessor.format())
+            close_archive()
+
+        paused = [False]
+        corrections = []  # 暫停期間畫的框: {'bbox', 'class', 'replace'} (replace為被取代的物件編號或None)
+        drag_start = [None]
+
+        def show_result(result):
+            """立即在追蹤視窗上顯示指定的結果"""
+            label_colors, label_alphas = self.build_label_colors(track_prompts, result.obj_ids)
+            frame_display.submit(result.orig_img, result.low_res_label_map, label_colors, label_alphas)
+            frame_display.flush()
+
+        def on_correction_down(event):
+            drag_start[0] = frame_display.canvas_to_image(event.x, event.y)
+
+        def on_correction_drag(event):
+            if drag_start[0] is None:
+                return
+            tracking_canvas.delete("correction_temp")
+            x1, y1 = frame_display.image_to_canvas(*drag_start[0])
+            tracking_canvas.create_rectangle(x1, y1, event.x, event.y, outline='green', width=2,
+                                             tags="correction_temp")
+
+        def on_correction_up(event):
+            """框與目前物件的框重疊時取代該物件 (沿用其類別)，否則以主視窗選擇的類別新增物件"""
+            tracking_canvas.delete("correction_temp")
+            if drag_start[0] is None:
+                return
+            result = pending_output[0]
+            end = frame_display.canvas_to_image(event.x, event.y)
+            h, w = result.orig_img.shape[:2]
+            box = [
+                max(0, min(drag_start[0][0], end[0])), max(0, min(drag_start[0][1], end[1])),
+                min(w, max(drag_start[0][0], end[0])), min(h, max(drag_start[0][1], end[1]))
+            ]
+            drag_start[0] = None
+            if box[2] - box[0] < 2 or box[3] - box[1] < 2:
+                return
+
+            replace = None
+            current_boxes = label_map_boxes(result.label_map, len(result.obj_ids))
+            candidates = [(obj_id, b) for obj_id, b in zip(result.obj_ids, current_boxes)
+                          if b is not None and obj_id not in [c['replace'] for c in corrections]]
+            if candidates:
+                iou = box_iou_matrix([box], [b for _, b in candidates])[0]
+                if iou.max() >= 0.1:
+                    replace = candidates[int(iou.argmax())][0]
+            class_name = track_prompts[replace]['class'] if replace is not None else (self.class_var.get() or "Unknown")
+            corrections.append({'bbox': box, 'class': class_name, 'replace': replace})
+
+            x1, y1 = frame_display.image_to_canvas(box[0], box[1])
+            x2, y2 = frame_display.image_to_canvas(box[2], box[3])
+            color = 'yellow' if replace is not None else 'green'
+            label = f"取代 #{replace} {class_name}" if replace is not None else f"新增 {class_name}"
+            tracking_canvas.create_rectangle(x1, y1, x2, y2, outline=color, width=2, tags="correction")
+            tracking_canvas.create_text(x1, y1 - 4, text=label, fill=color, anchor='sw',
+                                        font=('Arial', 10, 'bold'), tags="correction")
+
+        def toggle_pause():
+            """暫停時可在目前的幀上畫框；繼續時套用修正並從這一幀往後傳播"""
+            if not paused[0]:
+                if pending_output[0] is None or self.tracking_stopped:
+                    return
+                paused[0] = True
+                pause_btn.config(text="套用修正並繼續")
+                show_result(pending_output[0])
+                tracking_canvas.bind("<Button-1>", on_correction_down)
+                tracking_canvas.bind("<B1-Motion>", on_correction_drag)
+                tracking_canvas.bind("<ButtonRelease-1>", on_correction_up)
+                print(f"已暫停於第 {pending_output[0].frame_idx} 幀: 與物件重疊的框會取代該物件，其他框新增為物件")
+                return
+
+            tracking_canvas.unbind("<Button-1>")
+            tracking_canvas.unbind("<B1-Motion>")
+            tracking_canvas.unbind("<ButtonRelease-1>")
+            tracking_canvas.delete("correction")
+            if corrections:
+                result = pending_output[0]
+                try:
+                    corrected, new_ids = engine.correct(
+                        result, [c['bbox'] for c in corrections],
+                        replace_ids=[c['replace'] for c in corrections if c['replace'] is not None]
+                    )
+                except Exception as e:
+                    print(f"套用修正時出錯: {e}")
+                else:
+                    # 新物件編號依序接在track_prompts之後 (與merge_redetections相同)
+                    for correction in corrections[:len(new_ids)]:
+                        track_prompts.append({'bbox': correction['bbox'], 'class': correction['class']})
+                    replaced = sum(1 for c in corrections if c['replace'] is not None)
+                    print(f"第 {result.frame_idx} 幀: 取代 {replaced} 個物件, 新增 {len(corrections) - replaced} 個物件，"
+                          f"從這一幀繼續傳播")
+                    pending_output[0] = corrected
+                    show_result(corrected)
+                corrections.clear()
+            paused[0] = False
+            pause_btn.config(text="暫停並修正")
+            if not self.tracking_stopped:
+                tracking_window.after(1, update_frame)
+
+        outputs_finished = [False]
+
+        def finish_outputs():
+            """所有結束路徑共用: 輸出統計報告、寫入剩餘的結果、釋放寫入器，最後釋放追蹤狀態"""
+            if outputs_finished[0]:
+                return
+            outputs_finished[0] = True
+            report_latency()
+            report_motion_gate()
+            report_track_health()
+            flush_output()
             # 釋放視頻寫入器
             if video_writer is not None:
                 video_writer.release()
+                self.output_path = getattr(video_writer, 'path', self.output_path)  # 分段合併後的實際路徑
                 if self.output_path:
                     print(f"視頻已儲存完成: {self.output_path}")
                 else:
@@ -845,190 +1649,115 @@ class SAM2TrackerApp:
             # 釋放Mask視頻寫入器
             if mask_video_writer is not None:
                 mask_video_writer.release()
+                self.mask_output_path = getattr(mask_video_writer, 'path', self.mask_output_path)
                 if self.mask_output_path:
                     print(f"Mask視頻已儲存完成: {self.mask_output_path}")
                 else:
                     print("Mask視頻已儲存完成")
+            end_session()
+
+        def stop_tracking():
+            """停止追蹤並關閉視窗"""
+            self.tracking_stopped = True
+            if live_source is not None:
+                live_source.stop()
+            finish_outputs()
             tracking_window.destroy()
             self.root.deiconify()  # 重新顯示主視窗
 
         def update_frame():
-            if self.tracking_stopped:
+            if self.tracking_stopped or paused[0]:
                 return
 
             try:
+                step_start = time.perf_counter()
                 result = next(results)
-
-                # 使用原始圖像作為基礎
-                annotated_frame = result.orig_img.copy()
-
-                # 獲取分割結果
-                masks = result.masks
-                boxes = result.boxes
-
-                # 如果有分割結果，則繪製
-                if masks is not None:
-                    # 繪製分割掩碼
-                    for i, mask in enumerate(masks):
-                        # 獲取對應的類別索引
-                        if boxes is not None and i < len(boxes):
-                            cls_id = int(boxes[i].cls[0]) if len(boxes[i].cls) > 0 else 0
-
-                            # 使用我們自定義的類別名稱
-                            if i < len(self.prompts):
-                                class_name = self.prompts[i]['class']
-
-                                # 獲取該類別的顏色
-                                color = self.color_map.get(class_name, (255, 0, 0))  # 默認為紅色 (BGR)
-                                # 直接使用RGB元組，轉換為BGR格式 (OpenCV使用BGR順序)
-                                if isinstance(color, tuple) and len(color) == 3:
-                                    # 將RGB轉換為BGR (r,g,b -> b,g,r)
-                                    color_bgr = (color[2], color[1], color[0])
-                                else:
-                                    color_bgr = (0, 0, 255)  # 默認為紅色 (BGR)
-
-                                # 獲取該類別的透明度
-                                alpha = self.alpha_map.get(class_name, 0.5)  # 默認透明度為0.5
-
-                                # 繪製分割掩碼
-                                mask_np = mask.data.cpu().numpy()[0]  # 轉換為numpy數組
-                                mask_uint8 = (mask_np * 255).astype(np.uint8)  # 轉換為uint8格式
-
-                                # 將掩碼應用到圖像上，使用指定的透明度
-                                colored_mask = np.zeros_like(annotated_frame)
-                                colored_mask[:] = color_bgr
-
-                                # 應用透明度混合
-                                mask_binary = mask_np > 0.5
-                                annotated_frame[mask_binary] = (
-                                    annotated_frame[mask_binary] * (1 - alpha) +
-                                    colored_mask[mask_binary] * alpha
-                                ).astype(np.uint8)
-
-                                # 可選：繪製邊界框（根據需求決定是否顯示）
-                                # 如果只需要顯示mask而不顯示邊界框，可以註釋掉下面的代碼
-                                # if boxes is not None and i < len(boxes):
-                                #     box = boxes[i].xyxy[0].cpu().numpy()
-                                #     x1, y1, x2, y2 = map(int, box)
-
-                                #     # 繪製邊界框
-                                #     cv2.rectangle(annotated_frame, (x1, y1), (x2, y2), color_bgr, 2)
-
-                                #     # 在邊界框上方繪製類別名稱
-                                #     cv2.putText(annotated_frame, class_name, (x1, y1 - 10),
-                                #                cv2.FONT_HERSHEY_SIMPLEX, 0.6, color_bgr, 2)
-
-                # 如果需要保存視頻，將當前幀寫入視頻文件
-                if video_writer is not None:
-                    video_writer.write(annotated_frame)
-
-                # 如果需要保存Mask視頻，生成純Mask幀並寫入視頻文件
-                if mask_video_writer is not None:
-                    # 創建指定顏色背景的Mask幀 (RGB: 107, 142, 35 -> BGR: 35, 142, 107)
-                    background_color = (35, 142, 107)  # BGR format
-                    mask_frame = np.full_like(annotated_frame, background_color)
-
-                    # 繪製分割掩碼到指定背景上
-                    if masks is not None:
-                        for i, mask in enumerate(masks):
-                            if i < len(self.prompts):
-                                class_name = self.prompts[i]['class']
-
-                                # 獲取該類別的顏色
-                                color = self.color_map.get(class_name, (255, 0, 0))  # 默認為紅色 (BGR)
-                                # 直接使用RGB元組，轉換為BGR格式 (OpenCV使用BGR順序)
-                                if isinstance(color, tuple) and len(color) == 3:
-                                    # 將RGB轉換為BGR (r,g,b -> b,g,r)
-                                    color_bgr = (color[2], color[1], color[0])
-                                else:
-                                    color_bgr = (0, 0, 255)  # 默認為紅色 (BGR)
-
-                                # 獲取該類別的透明度
-                                alpha = self.alpha_map.get(class_name, 0.5)  # 默認透明度為0.5
-
-                                # 繪製分割掩碼
-                                mask_np = mask.data.cpu().numpy()[0]  # 轉換為numpy數組
-                                mask_uint8 = (mask_np * 255).astype(np.uint8)  # 轉換為uint8格式
-
-                                # 應用透明度混合到指定背景 (前景對象使用GUI設定的顏色和透明度)
-                                mask_binary = mask_np > 0.5
-                                mask_frame[mask_binary] = (
-                                    mask_frame[mask_binary] * (1 - alpha) +
-                                    np.full_like(mask_frame[mask_binary], color_bgr) * alpha
-                                ).astype(np.uint8)
-
-                    mask_video_writer.write(mask_frame)
-
-                # 轉換BGR到RGB
-                image_rgb = cv2.cvtColor(annotated_frame, cv2.COLOR_BGR2RGB)
-
-                # 獲取當前canvas大小
-                canvas_width = tracking_canvas.winfo_width()
-                canvas_height = tracking_canvas.winfo_height()
-
-                # 如果canvas尺寸未初始化，使用默認值
-                if canvas_width <= 1 or canvas_height <= 1:
-                    canvas_width = 800
-                    canvas_height = 600
-
-                # 計算縮放比例以保持縱橫比
-                h, w = image_rgb.shape[:2]
-                scale = min(canvas_width / w, canvas_height / h)
-                new_w = int(w * scale)
-                new_h = int(h * scale)
-
-                # 調整圖像大小
-                resized_image = cv2.resize(image_rgb, (new_w, new_h))
-
-                # 轉換為PIL Image
-                pil_image = Image.fromarray(resized_image)
-                photo = ImageTk.PhotoImage(pil_image)
-
-                # 在canvas上顯示圖像
-                tracking_canvas.delete("all")
-                tracking_canvas.create_image(canvas_width//2, canvas_height//2, image=photo, anchor=tk.CENTER)
-
-                # 保持對photo的引用以避免被垃圾回收
-                tracking_canvas.image = photo
-
-                # 繼續下一幀
+                track_seconds[0] += time.perf_counter() - step_start
+
+                # 檢查每個物件的追蹤健康，退化的物件在這一幀重新提示 (新物件編號依序接在track_prompts之後)
+                if track_health is not None:
+                    classes = {obj_id: prompt['class'] for obj_id, prompt in enumerate(track_prompts)}
+                    result, reseeds = track_health.check(engine, result, classes, health_detect)
+                    for old_id, new_id, box, source in reseeds:
+                        track_prompts.append({'bbox': list(box), 'class': track_prompts[old_id]['class']})
+                        print(f"第 {result.frame_idx} 幀: 物件 #{old_id} 追蹤退化，以{source}重新提示為 #{new_id}")
+
+                # 獲取模型解析度的標籤圖 (0為背景，i+1對應第i個物件)，顯示時才以最近鄰放大到畫面尺寸；
+                # 原始尺寸的標籤圖只在寫入輸出時建立
+                label_map = result.low_res_label_map
+
+                # 依物件對應的類別建立顏色和透明度查找表
+                label_colors, label_alphas = self.build_label_colors(track_prompts, result.obj_ids)
+
+                # 輸出延後一幀寫入: 上一幀已不能再修正，寫入後以這一幀取代
+                write_pending_output()
+                pending_output[0] = result
+
+                # 可選：在write_pending_output的annotated_frame上繪製邊界框（根據需求決定是否顯示）
+                # 如果只需要顯示mask而不顯示邊界框，可以註釋掉下面的代碼
+                # boxes = result.boxes
+                # if boxes is not None:
+                #     for i, box in enumerate(boxes.xyxy.cpu().numpy()):
+                #         x1, y1, x2, y2 = map(int, box)
+                #         color_bgr = tuple(int(c) for c in label_colors[i + 1])
+                #         class_name = track_prompts[result.obj_ids[i]]['class']
+
+                #         # 繪製邊界框
+                #         cv2.rectangle(annotated_frame, (x1, y1), (x2, y2), color_bgr, 2)
+
+                #         # 在邊界框上方繪製類別名稱
+                #         cv2.putText(annotated_frame, class_name, (x1, y1 - 10),
+                #                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, color_bgr, 2)
+
+                # 合併背景偵測的結果，並定期提交新的偵測請求
+                if auto_prompter is not None:
+                    self.merge_redetections(auto_prompter, engine, track_prompts, result.frame_idx)
+                    if result.frame_idx > 0 and result.frame_idx % redetect_interval == 0:
+                        # 追蹤中的框由模型解析度的標籤圖換算，不需要上採樣每個物件的mask
+                        boxes = label_map_boxes(label_map, len(result.obj_ids), result.orig_img.shape[:2])
+                        tracked_boxes = np.array([box for box in boxes if box is not None],
+                                                 dtype=np.float32).reshape(-1, 4)
+                        auto_prompter.submit(result.frame_idx, result.orig_img, tracked_boxes)
+
+                # 記錄端到端延遲 (擷取到輸出完成)
+                if latency_tracker is not None and result.capture_time is not None:
+                    latency_tracker.record(result.capture_time)
+                    latency_var.set(latency_tracker.format(live_source))
+
+                # 提交最新一幀給顯示計時器 (舊的未顯示幀直接被取代)
+                frame_display.submit(result.orig_img, label_map, label_colors, label_alphas)
+
+                # 定期取樣記憶體 (包含顯示用的PhotoImage)
+                last_frame_idx[0] = result.frame_idx
+                if memory_monitor is not None:
+                    memory_monitor.sample(result.frame_idx)
+
+                # 繼續下一幀，不依顯示幀率等待 (顯示由frame_display的計時器獨立進行)
                 if not self.tracking_stopped:
-                    tracking_window.after(30, update_frame)  # 大約33fps
+                    tracking_window.after(1, update_frame)
 
             except StopIteration:
                 print("視頻播放完畢")
-                # 釋放視頻寫入器
-                if video_writer is not None:
-                    video_writer.release()
-                    if self.output_path:
-                        print(f"視頻已儲存完成: {self.output_path}")
-                    else:
-                        print("視頻已儲存完成")
-                # 釋放Mask視頻寫入器
-                if mask_video_writer is not None:
-                    mask_video_writer.release()
-                    if self.mask_output_path:
-                        print(f"Mask視頻已儲存完成: {self.mask_output_path}")
-                    else:
-                        print("Mask視頻已儲存完成")
+                if isinstance(engine, ObjectShardedEngine):
+                    print(engine.format())
+                else:
+                    transfer_bytes, transfer_ms = engine.reducer.stats()
+                    print(f"Mask主機傳輸: 每幀 {transfer_bytes / 1024:.1f} KB, {transfer_ms:.2f} ms")
+                if frame_reader is not None:
+                    print(frame_reader.format(track_seconds[0]))
+                if lookahead is not None:
+                    print(lookahead.format())
+                frame_display.flush()
+                print(frame_display.format())
+                finish_outputs()
                 if not self.tracking_stopped:
                     tracking_window.destroy()
                     self.root.deiconify()  # 重新顯示主視窗
+                    # 從剛儲存的mask存檔檢視結果 (不重新推論)
+                    if save_archive and self.review_config.get('open_after_tracking') and self.last_archive_path:
+                        self.open_review(self.last_archive_path)
             except Exception as e:
-                # 釋放視頻寫入器
-                if video_writer is not None:
-                    video_writer.release()
-                    if self.output_path:
-                        print(f"視頻已儲存完成: {self.output_path}")
-                    else:
-                        print("視頻已儲存完成")
-                # 釋放Mask視頻寫入器
-                if mask_video_writer is not None:
-                    mask_video_writer.release()
-                    if self.mask_output_path:
-                        print(f"Mask視頻已儲存完成: {self.mask_output_path}")
-                    else:
-                        print("Mask視頻已儲存完成")
+                finish_outputs()
                 if not self.tracking_stopped:
                     print(f"追蹤過程中出錯: {e}")
                     tracking_window.destroy()
@@ -1037,26 +1766,16 @@ class SAM2TrackerApp:
         # 在開始追蹤前儲存配置
         self.save_config()
 
-        # 開始顯示第一幀
+        # 開始追蹤和顯示
+        frame_display.start()
         update_frame()
 
         # 綁定關閉事件
         def on_closing():
             self.tracking_stopped = True
-            # 釋放視頻寫入器
-            if video_writer is not None:
-                video_writer.release()
-                if self.output_path:
-                    print(f"視頻已儲存完成: {self.output_path}")
-                else:
-                    print("視頻已儲存完成")
-            # 釋放Mask視頻寫入器
-            if mask_video_writer is not None:
-                mask_video_writer.release()
-                if self.mask_output_path:
-                    print(f"Mask視頻已儲存完成: {self.mask_output_path}")
-                else:
-                    print("Mask視頻已儲存完成")
+            if live_source is not None:
+                live_source.stop()
+            finish_outputs()
             tracking_window.destroy()
             self.root.deiconify()  # 重新顯示主視窗
 
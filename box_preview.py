@@ -0,0 +1,99 @@
+import threading
+import time
+
+import torch
+from ultralytics.models.sam import SAM2Predictor
+from ultralytics.utils import ops
+
+from model_optimization import apply_optimizations
+from object_masks import CroppedMask
+
+
+# 框選預覽的預設配置 (可在sam2_config.json的"preview"區段覆寫)
+DEFAULT_PREVIEW_CONFIG = {
+    "enabled": True,  # 框選時即時顯示SAM2預測的mask
+    "poll_ms": 50  # 圖像嵌入尚未完成時，重新檢查的間隔 (毫秒)
+}
+
+
+class BoxMaskPreviewer:
+    """以快取的首幀SAM2圖像嵌入即時預覽框提示的mask
+
+    圖像編碼器只在set_frame時於背景執行緒執行一次，之後每個框只需要提示編碼器和
+    mask解碼器 (數十毫秒)。嵌入在下一次set_frame之前一直重複使用。
+    """
+
+    def __init__(self, overrides, optimization=None):
+        self.overrides = dict(overrides)
+        self.optimization = dict(optimization or {})
+        self.predictor = None
+        self._lock = threading.Lock()
+        self._generation = 0  # 每次換幀加一，用於丟棄過期的嵌入
+        self._features = None
+        self._im_shape = None
+        self._frame_shape = None
+
+        # 統計
+        self.embed_ms = 0.0
+        self.decode_ms = 0.0
+
+    @property
+    def ready(self):
+        return self._features is not None
+
+    def set_frame(self, frame):
+        """在背景執行緒計算新幀的圖像嵌入，先前的嵌入立即失效"""
+        self._generation += 1
+        self._features = None
+        # 唯讀的共用幀 (video_source解碼的幀) 不會被修改，不需要複製
+        frame = frame if not frame.flags.writeable else frame.copy()
+        thread = threading.Thread(target=self._embed, args=(frame, self._generation), daemon=True)
+        thread.start()
+
+    def _setup_predictor(self):
+        predictor = SAM2Predictor(overrides=self.overrides)
+        predictor.setup_model(verbose=False)
+        apply_optimizations(predictor.model, self.optimization, predictor.device)
+        return predictor
+
+    @torch.inference_mode()
+    def _embed(self, frame, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            try:
+                if self.predictor is None:
+                    self.predictor = self._setup_predictor()
+                start = time.perf_counter()
+                self.predictor.setup_source(frame)
+                im = self.predictor.preprocess([frame])
+                features = self.predictor.get_im_features(im)
+                self.embed_ms = (time.perf_counter() - start) * 1e3
+            except Exception as e:
+                print(f"計算預覽用的圖像嵌入時出錯: {e}")
+                return
+            if generation == self._generation:
+                self._im_shape = tuple(im.shape[2:])
+                self._frame_shape = frame.shape[:2]
+                self._features = features
+
+    @torch.inference_mode()
+    def predict(self, bbox):
+        """以快取的嵌入預測單一框的mask (CroppedMask，只保存物件框內的位元)，嵌入尚未完成時回傳None"""
+        if not self.ready or not self._lock.acquire(blocking=False):
+            return None
+        try:
+            features = self._features
+            if features is None:
+                return None
+            start = time.perf_counter()
+            predictor = self.predictor
+            points, labels, masks = predictor._prepare_prompts(self._im_shape, self._frame_shape,
+                                                               bboxes=[list(map(float, bbox))])
+            pred_masks, _ = predictor._inference_features(features, points, labels, masks, multimask_output=False)
+            mask = ops.scale_masks(pred_masks[None].float(), self._frame_shape, padding=False)[0][0]
+            result = CroppedMask.from_mask((mask > predictor.model.mask_threshold).cpu().numpy())
+            self.decode_ms = (time.perf_counter() - start) * 1e3
+            return result
+        finally:
+            self._lock.release()
@@ -0,0 +1,258 @@
+import argparse
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+
+import torch
+
+from mask_archive import MaskArchiveWriter, archive_iou
+from sam2_engine import SAM2FrameEngine
+from video_source import PrefetchFrameReader, source_frame_count
+
+
+# 圖像編碼器預讀的預設配置 (可在sam2_config.json的"encoder_lookahead"區段覆寫)
+DEFAULT_ENCODER_LOOKAHEAD_CONFIG = {
+    "enabled": False,
+    "batch_size": 4,  # 每批一起執行圖像編碼器的幀數
+    "buffer": 8  # 已編碼但尚未追蹤的幀數上限 (至少為batch_size)
+}
+
+
+def split_features(backbone_out, count):
+    """把批次的圖像編碼器輸出拆成每幀一份 (沿第0維切片，不複製)"""
+    def take(value, i):
+        if isinstance(value, torch.Tensor):
+            return value[i:i + 1]
+        if isinstance(value, (list, tuple)):
+            return [take(v, i) for v in value]
+        if isinstance(value, dict):
+            return {key: take(v, i) for key, v in value.items()}
+        return value
+    return [take(backbone_out, i) for i in range(count)]
+
+
+class EncoderLookahead:
+    """在背景執行緒中以批次預先執行後續幀的圖像編碼器
+
+    圖像編碼器不依賴提示和記憶，因此可以領先追蹤: 背景執行緒每次讀取batch_size幀，
+    預處理後一起編碼，拆成每幀的特徵放入最多buffer幀的緩衝區；目前幀的記憶注意力和
+    mask解碼同時在呼叫端的執行緒進行。特徵存放區已有的幀不編碼，由engine.step讀取。
+    """
+
+    def __init__(self, batch_size=DEFAULT_ENCODER_LOOKAHEAD_CONFIG["batch_size"],
+                 buffer=DEFAULT_ENCODER_LOOKAHEAD_CONFIG["buffer"]):
+        self.batch_size = max(1, int(batch_size))
+        self.buffer = max(self.batch_size, int(buffer))
+
+        # 統計
+        self.frames = 0
+        self.encoded_frames = 0
+        self.batches = 0
+        self.encode_seconds = 0.0  # 背景執行緒預處理和編碼的時間
+        self.stall_seconds = 0.0  # 追蹤端等待編碼的時間
+
+    def _encode_batch(self, engine, batch):
+        """預處理並編碼一批幀，回傳 [(item, (im, backbone_out或None)), ...]"""
+        predictor = engine.predictor
+        store = engine.feature_store
+        start = time.perf_counter()
+        with torch.inference_mode():
+            ims = [predictor.preprocess([item[1]]) for item in batch]
+            features = [None] * len(batch)
+            pending = [i for i, item in enumerate(batch) if store is None or not store.has(item[0])]
+            if pending:
+                backbone_out = predictor.model.forward_image(torch.cat([ims[i] for i in pending]))
+                for i, feature in zip(pending, split_features(backbone_out, len(pending))):
+                    features[i] = feature
+                self.batches += 1
+                self.encoded_frames += len(pending)
+        self.encode_seconds += time.perf_counter() - start
+        return [(item, (im, feature)) for item, im, feature in zip(batch, ims, features)]
+
+    def encode(self, engine, frames):
+        """對 (frame_idx, frame, ...) 疊代器產生 (item, encoded)，encoded可直接傳給engine.step
+
+        engine必須已完成設定 (至少處理過一幀)。
+        """
+        encoded = queue.Queue(maxsize=self.buffer)
+        stopped = threading.Event()
+        errors = []
+
+        def put(item):
+            # 追蹤端提前停止時不要永久阻塞
+            while not stopped.is_set():
+                try:
+                    encoded.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def run():
+            batch = []
+            try:
+                for item in frames:
+                    batch.append(item)
+                    if len(batch) < self.batch_size:
+                        continue
+                    if not all(put(out) for out in self._encode_batch(engine, batch)):
+                        return
+                    batch = []
+                if batch and not stopped.is_set():
+                    for out in self._encode_batch(engine, batch):
+                        put(out)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                close = getattr(frames, 'close', None)
+                if close is not None:
+                    close()
+                put(None)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            while True:
+                wait_start = time.perf_counter()
+                out = encoded.get()
+                self.stall_seconds += time.perf_counter() - wait_start
+                if out is None:
+                    if errors:
+                        raise errors[0]
+                    return
+                self.frames += 1
+                yield out
+        finally:
+            stopped.set()
+            thread.join(timeout=2)
+
+    def summary(self):
+        return {
+            'batch_size': self.batch_size,
+            'buffer': self.buffer,
+            'frames': self.frames,
+            'encoded_frames': self.encoded_frames,
+            'batches': self.batches,
+            'encode_seconds': round(self.encode_seconds, 3),
+            'stall_seconds': round(self.stall_seconds, 3)
+        }
+
+    def format(self):
+        encode_ms = self.encode_seconds / self.encoded_frames * 1e3 if self.encoded_frames else 0.0
+        return (f"圖像編碼預讀: {self.frames} 幀, 每批 {self.batch_size} 幀 ({self.batches} 批), "
+                f"平均每幀編碼 {encode_ms:.1f} ms, 等待編碼 {self.stall_seconds:.1f} 秒")
+
+
+def use_lookahead(config, engine, live=False):
+    """是否使用圖像編碼預讀 (GUI和追蹤服務共用的規則)
+
+    需已啟用、來源可預讀 (視頻檔案或影像序列；即時影像只處理最新的幀)，且為單一的
+    SAM2FrameEngine (物件分片引擎在各自的程序中編碼)。
+    """
+    return bool(config.get('enabled')) and not live and isinstance(engine, SAM2FrameEngine)
+
+
+def lookahead_track(engine, frames, lookahead):
+    """與engine.track相同，但圖像編碼器由lookahead在背景執行緒中批次預先執行"""
+    frames = iter(frames)
+    # 第一幀同步處理，完成模型載入和圖像尺寸的設定後才開始預讀
+    while not engine._ready:
+        item = next(frames, None)
+        if item is None:
+            return
+        result = engine.step(item[1], item[0])
+        if len(item) > 2:
+            result.capture_time = item[2]
+        yield result
+    for item, encoded in lookahead.encode(engine, frames):
+        result = engine.step(item[1], item[0], encoded)
+        if len(item) > 2:
+            result.capture_time = item[2]
+        yield result
+
+
+def benchmark_run(engine, source, boxes, archive_path, max_side=0, end=None, lookahead=None):
+    """追蹤來源一次 (lookahead為None時逐幀編碼)，回傳 (秒數, 幀數)"""
+    engine.reset(num_frames=source_frame_count(source), source_name=source)
+    engine.add_objects(boxes, frame_idx=0)
+    frames = PrefetchFrameReader(source, max_side=max_side, end=end)
+    results = engine.track(frames) if lookahead is None else lookahead_track(engine, frames, lookahead)
+    writer = None
+    count = 0
+    start = time.perf_counter()
+    for result in results:
+        if writer is None:
+            writer = MaskArchiveWriter(archive_path, *result.label_map.shape, obj_ids=result.obj_ids,
+                                       dtype=result.label_map.dtype)
+        writer.write(result.frame_idx, result.label_map)
+        count += 1
+    seconds = time.perf_counter() - start
+    if writer is not None:
+        writer.close()
+    return seconds, count
+
+
+def main():
+    """比較逐幀編碼與不同批次大小的圖像編碼預讀的追蹤速度"""
+    from sharded_tracking import sam2_overrides
+
+    parser = argparse.ArgumentParser(description="SAM2圖像編碼器批次預讀的速度比較")
+    parser.add_argument("source", help="視頻或影像序列目錄")
+    parser.add_argument("--box", action="append", default=[], help='框提示 "x1,y1,x2,y2" (可重複，預設為畫面中央)')
+    parser.add_argument("--batch-sizes", default="1,2,4,8", help="要比較的批次大小 (逗號分隔)")
+    parser.add_argument("--buffer", type=int, default=DEFAULT_ENCODER_LOOKAHEAD_CONFIG["buffer"],
+                        help="已編碼幀的緩衝區大小 (小於批次大小時使用批次大小)")
+    parser.add_argument("--model", default="./models/sam2.1_t.pt", help="SAM2模型路徑")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="裝置")
+    parser.add_argument("--imgsz", type=int, default=1024, help="輸入尺寸")
+    parser.add_argument("--max-side", type=int, default=0, help="載入時把長邊縮小到此尺寸")
+    parser.add_argument("--frames", type=int, help="只追蹤前幾幀")
+    parser.add_argument("--output-dir", default="./output", help="報告輸出目錄")
+    args = parser.parse_args()
+
+    batch_sizes = [int(v) for v in args.batch_sizes.split(',') if v.strip()]
+    boxes = [[int(float(v)) for v in box.split(',')[:4]] for box in args.box]
+    if not boxes:
+        frame = next(iter(PrefetchFrameReader(args.source, max_side=args.max_side, end=1)))[1]
+        h, w = frame.shape[:2]
+        boxes = [[w // 4, h // 4, w * 3 // 4, h * 3 // 4]]
+
+    engine = SAM2FrameEngine(sam2_overrides(args.model, args.device, args.imgsz), source_name=args.source)
+    report = {'source': os.path.abspath(args.source), 'device': args.device, 'imgsz': args.imgsz,
+              'torch_threads': torch.get_num_threads(), 'runs': []}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # 預熱 (模型載入和第一次執行的配置) 不計入
+        benchmark_run(engine, args.source, boxes, os.path.join(tmp_dir, "warmup"), args.max_side, end=2)
+        baseline_path = os.path.join(tmp_dir, "baseline")
+        seconds, count = benchmark_run(engine, args.source, boxes, baseline_path, args.max_side, args.frames)
+        baseline_fps = count / seconds
+        report['runs'].append({'mode': 'per_frame', 'frames': count, 'seconds': round(seconds, 3),
+                               'fps': round(baseline_fps, 2), 'speedup': 1.0, 'mean_iou': 1.0})
+        print(f"逐幀編碼: {count} 幀, {seconds:.1f} 秒 ({baseline_fps:.2f} FPS)")
+
+        for batch_size in batch_sizes:
+            lookahead = EncoderLookahead(batch_size, args.buffer)
+            archive_path = os.path.join(tmp_dir, f"batch_{batch_size}")
+            seconds, count = benchmark_run(engine, args.source, boxes, archive_path, args.max_side, args.frames,
+                                           lookahead)
+            run = {'mode': 'lookahead', 'frames': count, 'seconds': round(seconds, 3),
+                   'fps': round(count / seconds, 2), 'speedup': round(count / seconds / baseline_fps, 2),
+                   'mean_iou': round(archive_iou(baseline_path, archive_path), 4)}
+            run.update(lookahead.summary())
+            report['runs'].append(run)
+            print(f"預讀 批次 {batch_size}: {seconds:.1f} 秒 ({run['fps']:.2f} FPS, 加速 {run['speedup']:.2f}x), "
+                  f"與逐幀編碼的平均IoU {run['mean_iou']:.4f}; {lookahead.format()}")
+    engine.close()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    report_path = os.path.join(args.output_dir, f"encoder_lookahead_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"報告已儲存: {report_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from mask_archive import MaskArchiveWriter, archive_iou
+from model_optimization import enabled_modes
+from sam2_engine import SAM2FrameEngine
+from video_source import PrefetchFrameReader, is_frame_sequence, list_sequence_frames, source_frame_count
+
+
+# 圖像編碼器特徵存放區的預設配置 (可在sam2_config.json的"feature_store"區段覆寫)
+DEFAULT_FEATURE_STORE_CONFIG = {
+    "enabled": False,  # 追蹤時讀取已儲存的特徵，缺少的幀計算後寫入
+    "root": "./feature_cache",  # 存放區根目錄，每個 (來源, 模型, imgsz) 一個子目錄
+    "write": True  # False時只讀取已儲存的特徵，不寫入新的特徵
+}
+
+HASH_CHUNK = 1 << 20
+
+
+def source_hash(source, root):
+    """來源內容的SHA1 (前16碼)
+
+    視頻雜湊整個檔案內容；影像序列雜湊每一幀的檔名、大小和修改時間。結果依 (路徑, 大小, 修改時間)
+    快取在root/sources.json，同一個檔案不會重複雜湊。
+    """
+    source = os.path.abspath(source)
+    stat = os.stat(source)
+    cache_key = f"{source}|{stat.st_size}|{stat.st_mtime_ns}"
+    cache_path = os.path.join(root, "sources.json")
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    if cache_key in cache:
+        return cache[cache_key]
+
+    digest = hashlib.sha1()
+    if is_frame_sequence(source):
+        for path in list_sequence_frames(source):
+            frame_stat = os.stat(path)
+            digest.update(f"{os.path.basename(path)}|{frame_stat.st_size}|{frame_stat.st_mtime_ns}\n".encode('utf-8'))
+    else:
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+                digest.update(chunk)
+    value = digest.hexdigest()[:16]
+
+    cache[cache_key] = value
+    os.makedirs(root, exist_ok=True)
+    with open(cache_path, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, ensure_ascii=False, indent=2)
+    return value
+
+
+def _image_encoder(model):
+    """取得未經AutocastModule/torch.compile包裝的圖像編碼器"""
+    encoder = model.image_encoder
+    while not hasattr(encoder, 'neck'):
+        encoder = getattr(encoder, 'module', None) or getattr(encoder, '_orig_mod')
+    return encoder
+
+
+class FeatureStore:
+    """單一 (來源, 模型, imgsz) 的SAM2圖像編碼器特徵存放區
+
+    每個FPN層級是一個 (幀數, C, H, W) 的fp16 .npy記憶體映射檔，written.npy記錄哪些幀已寫入。
+    位置編碼只取決於特徵尺寸，不儲存，讀取時由編碼器的neck重新計算 (整個存放區只算一次)。
+    """
+
+    def __init__(self, path, num_frames=None, writable=True):
+        self.path = path
+        self.num_frames = num_frames
+        self.writable = writable
+        self.meta = None
+        self._levels = None
+        self._written = None
+        self._pos = None
+
+        # 統計
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.load_seconds = 0.0
+
+        if os.path.exists(os.path.join(path, "meta.json")):
+            self._open()
+
+    @classmethod
+    def for_source(cls, root, source, model, imgsz, max_side=0, optimization=None, writable=True):
+        """依來源雜湊、模型、imgsz、解碼縮放和最佳化模式決定存放區目錄"""
+        modes = enabled_modes(optimization or {})
+        key = [source_hash(source, root), os.path.splitext(os.path.basename(model))[0], f"imgsz{imgsz}"]
+        if max_side:
+            key.append(f"side{max_side}")
+        if modes:
+            # int8/bf16的特徵與float32不同，分開存放
+            key.append('+'.join(modes))
+        return cls(os.path.join(root, '_'.join(key)), num_frames=source_frame_count(source), writable=writable)
+
+    def _open(self):
+        with open(os.path.join(self.path, "meta.json"), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.num_frames = self.meta['frames']
+        mode = 'r+' if self.writable else 'r'
+        self._levels = [np.load(os.path.join(self.path, f"level{i}.npy"), mmap_mode=mode)
+                        for i in range(len(self.meta['shapes']))]
+        self._written = np.load(os.path.join(self.path, "written.npy"), mmap_mode=mode)
+
+    def _create(self, backbone_out):
+        """以第一個寫入的特徵決定各層級的形狀，建立記憶體映射檔"""
+        os.makedirs(self.path, exist_ok=True)
+        shapes = [list(feature.shape[1:]) for feature in backbone_out["backbone_fpn"]]
+        for i, shape in enumerate(shapes):
+            np.lib.format.open_memmap(os.path.join(self.path, f"level{i}.npy"), mode='w+', dtype=np.float16,
+                                      shape=(self.num_frames, *shape))
+        np.lib.format.open_memmap(os.path.join(self.path, "written.npy"), mode='w+', dtype=np.bool_,
+                                  shape=(self.num_frames,))
+        self.meta = {'frames': self.num_frames, 'shapes': shapes, 'dtype': 'float16'}
+        with open(os.path.join(self.path, "meta.json"), 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f, ensure_ascii=False, indent=2)
+        self._open()
+
+    def has(self, frame_idx):
+        return self._written is not None and 0 <= frame_idx < len(self._written) and bool(self._written[frame_idx])
+
+    @property
+    def complete(self):
+        return self._written is not None and bool(self._written.all())
+
+    def load(self, frame_idx, model, device):
+        """讀取一幀的特徵並組成forward_image相同格式的backbone_out，沒有該幀時回傳None"""
+        if not self.has(frame_idx):
+            self.misses += 1
+            return None
+        start = time.perf_counter()
+        fpn = [torch.from_numpy(np.ascontiguousarray(level[frame_idx]))[None].to(device=device, dtype=torch.float32)
+               for level in self._levels]
+        if self._pos is None or self._pos[0].device != fpn[0].device:
+            neck = _image_encoder(model).neck
+            self._pos = [neck.position_encoding(feature).to(feature.dtype) for feature in fpn]
+        self.load_seconds += time.perf_counter() - start
+        self.hits += 1
+        return {"vision_features": fpn[-1], "vision_pos_enc": self._pos, "backbone_fpn": fpn}
+
+    def save(self, frame_idx, backbone_out):
+        """寫入一幀的特徵 (唯讀、幀數未知或已寫入時略過)"""
+        if not self.writable or not self.num_frames or not 0 <= frame_idx < self.num_frames or self.has(frame_idx):
+            return
+        if self._levels is None:
+            self._create(backbone_out)
+        for level, feature in zip(self._levels, backbone_out["backbone_fpn"]):
+            level[frame_idx] = feature[0].to(torch.float16).cpu().numpy()
+        # 特徵寫完後才標記為已寫入，中斷時未完成的幀會在下次重新計算
+        self._written[frame_idx] = True
+        self.writes += 1
+
+    def close(self):
+        """把記憶體映射檔寫回磁碟"""
+        for array in (self._levels or []) + ([self._written] if self._written is not None else []):
+            if isinstance(array, np.memmap):
+                array.flush()
+        self._levels = None
+        self._written = None
+        self._pos = None
+
+    def disk_bytes(self):
+        if not os.path.isdir(self.path):
+            return 0
+        return sum(os.path.getsize(os.path.join(self.path, name)) for name in os.listdir(self.path))
+
+    def frame_bytes(self):
+        """每幀特徵佔用的位元組數"""
+        if self.meta is None:
+            return 0
+        return sum(int(np.prod(shape)) * 2 for shape in self.meta['shapes'])
+
+    def format(self):
+        written = int(self._written.sum()) if self._written is not None else 0
+        load_ms = self.load_seconds / self.hits * 1e3 if self.hits else 0.0
+        return (f"特徵存放區: 讀取 {self.hits} 幀 (平均 {load_ms:.1f} ms), 計算 {self.misses} 幀, 寫入 {self.writes} 幀, "
+                f"已儲存 {written}/{self.num_frames or 0} 幀, 磁碟 {self.disk_bytes() / 2 ** 20:.1f} MB")
+
+
+def precompute(source, overrides, store, max_side=0, optimization=None):
+    """只執行圖像編碼器，把來源中尚未儲存的幀寫入特徵存放區，回傳計算的幀數和時間"""
+    engine = SAM2FrameEngine(overrides, num_frames=store.num_frames, source_name=source, optimization=optimization)
+    start = time.perf_counter()
+    count = 0
+    with torch.inference_mode():
+        for frame_idx, frame in PrefetchFrameReader(source, max_side=max_side):
+            if store.has(frame_idx):
+                continue
+            if not engine._ready:
+                engine._setup(frame)
+            im = engine.predictor.preprocess([frame])
+            store.save(frame_idx, engine.predictor.model.forward_image(im))
+            count += 1
+    engine.close()
+    return count, time.perf_counter() - start
+
+
+def track_once(source, boxes, overrides, archive_path, max_side=0, optimization=None, feature_store=None):
+    """追蹤整個來源一次 (可使用特徵存放區)，回傳秒數"""
+    start = time.perf_counter()
+    engine = SAM2FrameEngine(overrides, num_frames=source_frame_count(source), source_name=source,
+                             optimization=optimization, feature_store=feature_store)
+    engine.add_objects(boxes, frame_idx=0)
+    writer = None
+    for result in engine.track(PrefetchFrameReader(source, max_side=max_side)):
+        if writer is None:
+            writer = MaskArchiveWriter(archive_path, *result.label_map.shape, obj_ids=result.obj_ids,
+                                       dtype=result.label_map.dtype)
+        writer.write(result.frame_idx, result.label_map)
+    if writer is not None:
+        writer.close()
+    engine.close()
+    return time.perf_counter() - start
+
+
+def main():
+    """預先計算來源的SAM2圖像編碼器特徵，或比較使用特徵存放區前後的追蹤速度"""
+    from sharded_tracking import sam2_overrides
+
+    parser = argparse.ArgumentParser(description="SAM2圖像編碼器特徵存放區")
+    parser.add_argument("source", help="視頻或影像序列目錄")
+    parser.add_argument("--config", default="./sam2_config.json", help="配置檔案 (feature_store和最佳化)")
+    parser.add_argument("--model", default="./models/sam2.1_t.pt", help="SAM2模型路徑")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="裝置")
+    parser.add_argument("--imgsz", type=int, default=1024, help="輸入尺寸")
+    parser.add_argument("--max-side", type=int, default=0, help="載入時把長邊縮小到此尺寸 (與追蹤時相同)")
+    parser.add_argument("--root", help="存放區根目錄 (預設使用feature_store區段)")
+    parser.add_argument("--benchmark", action="append", default=[], metavar="BOX",
+                        help='以框提示 "x1,y1,x2,y2" (可重複) 比較不使用和使用存放區的追蹤時間')
+    parser.add_argument("--clear", action="store_true", help="刪除這個來源已儲存的特徵後再計算")
+    args = parser.parse_args()
+
+    config = dict(DEFAULT_FEATURE_STORE_CONFIG)
+    optimization = None
+    if os.path.exists(args.config):
+        with open(args.config, 'r', encoding='utf-8') as f:
+            full_config = json.load(f)
+        config.update(full_config.get('feature_store', {}))
+        optimization = full_config.get('optimization')
+    root = args.root or config['root']
+    overrides = sam2_overrides(args.model, args.device, args.imgsz)
+
+    store = FeatureStore.for_source(root, args.source, args.model, args.imgsz, args.max_side, optimization)
+    if args.clear and os.path.isdir(store.path):
+        store.close()
+        shutil.rmtree(store.path)
+        store = FeatureStore.for_source(root, args.source, args.model, args.imgsz, args.max_side, optimization)
+    if not store.num_frames:
+        print(f"無法取得來源幀數: {args.source}")
+        return
+    print(f"特徵存放區: {store.path}")
+
+    report = {'source': os.path.abspath(args.source), 'store': store.path, 'frames': store.num_frames}
+    boxes = [[int(float(v)) for v in box.split(',')[:4]] for box in args.benchmark]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if boxes:
+            # 基準: 不使用存放區 (每幀執行圖像編碼器)
+            report['baseline_seconds'] = round(track_once(args.source, boxes, overrides,
+                                                          os.path.join(tmp_dir, "baseline"), args.max_side,
+                                                          optimization), 3)
+        count, seconds = precompute(args.source, overrides, store, args.max_side, optimization)
+        report.update({'encoded_frames': count, 'precompute_seconds': round(seconds, 3),
+                       'disk_mb': round(store.disk_bytes() / 2 ** 20, 1),
+                       'frame_mb': round(store.frame_bytes() / 2 ** 20, 3)})
+        print(f"計算 {count} 幀特徵, {seconds:.1f} 秒; 磁碟 {report['disk_mb']:.1f} MB "
+              f"(每幀 {report['frame_mb']:.2f} MB)")
+        if boxes:
+            cached_seconds = track_once(args.source, boxes, overrides, os.path.join(tmp_dir, "cached"),
+                                        args.max_side, optimization, feature_store=store)
+            report['cached_seconds'] = round(cached_seconds, 3)
+            report['speedup'] = round(report['baseline_seconds'] / cached_seconds, 2)
+            report['mean_iou'] = round(archive_iou(os.path.join(tmp_dir, "baseline"),
+                                                   os.path.join(tmp_dir, "cached")), 4)
+            print(store.format())
+            print(f"追蹤: 不使用存放區 {report['baseline_seconds']:.1f} 秒, 使用存放區 {cached_seconds:.1f} 秒 "
+                  f"(加速 {report['speedup']:.2f}x), 平均IoU {report['mean_iou']:.4f}")
+    store.close()
+
+    with open(os.path.join(store.path, "report.json"), 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
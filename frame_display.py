@@ -0,0 +1,164 @@
+import time
+
+import cv2
+import numpy as np
+import tkinter as tk
+from PIL import Image, ImageTk
+
+from label_map import blend_label_map
+
+
+# 追蹤視窗顯示的預設配置 (可在sam2_config.json的"display"區段覆寫)
+DEFAULT_DISPLAY_CONFIG = {
+    "fps": 30,  # 目標顯示幀率，與追蹤速度無關；兩次顯示之間處理的幀只保留最新的一幀
+    "interpolation": "area"  # 縮小畫面使用的插值 ("area"、"linear"、"nearest")
+}
+
+INTERPOLATIONS = {
+    "area": cv2.INTER_AREA,
+    "linear": cv2.INTER_LINEAR,
+    "nearest": cv2.INTER_NEAREST
+}
+
+
+class FrameDisplay:
+    """以固定顯示幀率在canvas上顯示最新的追蹤結果
+
+    追蹤迴圈每處理完一幀就呼叫submit，只記錄最新一幀的參考 (不複製)；顯示計時器依設定的
+    幀率取出最新一幀繪製，期間被新幀取代的舊幀直接略過，顯示不會拖慢追蹤。繪製時先縮小
+    再做顏色轉換和mask混合，所有中間結果寫入預先配置的緩衝區，並就地更新同一個PhotoImage。
+    """
+
+    def __init__(self, canvas, fps=DEFAULT_DISPLAY_CONFIG["fps"],
+                 interpolation=DEFAULT_DISPLAY_CONFIG["interpolation"]):
+        self.canvas = canvas
+        self.interval_ms = max(1, int(round(1000 / max(fps, 1e-3))))
+        self.interpolation = INTERPOLATIONS.get(interpolation, cv2.INTER_AREA)
+        self._pending = None
+        self._after_id = None
+        self._size = None
+        self._photo = None
+        self._image_item = None
+        self._bgr = None
+        self._rgba = None
+        self._labels = None
+        self._pil = None
+        self._frame_size = None  # 最後繪製的原始畫面 (寬, 高)
+
+        # 統計
+        self.submitted = 0
+        self.shown = 0
+        self.render_seconds = 0.0
+
+    def submit(self, image, label_map=None, colors=None, alphas=None):
+        """提交最新一幀 (BGR)，可附帶尚未混合的標籤圖和查找表，在縮小後的畫面上混合
+
+        標籤圖可以是任意解析度 (例如模型解析度)，繪製時以最近鄰縮放到顯示尺寸。
+
+        只保留參考，呼叫端在下一次submit之前不可修改這些陣列。LabelMapReducer的輪替緩衝區
+        在下一幀才會被覆寫，而下一幀提交時會取代這一幀，因此可以直接傳入。
+        """
+        self._pending = (image, label_map, colors, alphas)
+        self.submitted += 1
+
+    def start(self):
+        if self._after_id is None:
+            self._after_id = self.canvas.after(self.interval_ms, self._tick)
+
+    def stop(self):
+        """停止顯示計時器並釋放最新一幀的參考"""
+        if self._after_id is not None:
+            try:
+                self.canvas.after_cancel(self._after_id)
+            except tk.TclError:
+                pass  # 視窗已關閉
+            self._after_id = None
+        self._pending = None
+
+    def _tick(self):
+        self._after_id = None
+        if self._pending is not None:
+            try:
+                self.render(*self._pending)
+            except tk.TclError:
+                return  # 視窗已關閉
+            self._pending = None
+        self._after_id = self.canvas.after(self.interval_ms, self._tick)
+
+    def flush(self):
+        """立即繪製尚未顯示的最新一幀"""
+        if self._pending is not None:
+            self.render(*self._pending)
+            self._pending = None
+
+    def _allocate(self, canvas_size, frame_shape):
+        """依canvas和畫面尺寸配置緩衝區和PhotoImage (尺寸不變時重複使用)"""
+        canvas_width, canvas_height = canvas_size
+        h, w = frame_shape[:2]
+        self._frame_size = (w, h)
+        scale = min(canvas_width / w, canvas_height / h)
+        new_w = max(1, int(w * scale))
+        new_h = max(1, int(h * scale))
+        if self._bgr is None or self._bgr.shape[:2] != (new_h, new_w):
+            self._bgr = np.empty((new_h, new_w, 3), dtype=np.uint8)
+            # PIL只有4通道等模式能直接映射外部記憶體，因此顯示緩衝區使用RGBA (alpha固定為255)
+            self._rgba = np.empty((new_h, new_w, 4), dtype=np.uint8)
+            self._labels = None
+            # 與_rgba共用記憶體的PIL影像，每次繪製不再建立新的影像物件
+            self._pil = Image.frombuffer('RGBA', (new_w, new_h), self._rgba, 'raw', 'RGBA', 0, 1)
+            self._photo = ImageTk.PhotoImage('RGBA', (new_w, new_h))
+            if self._image_item is None:
+                self._image_item = self.canvas.create_image(0, 0, image=self._photo, anchor=tk.CENTER)
+            else:
+                self.canvas.itemconfigure(self._image_item, image=self._photo)
+        if self._size != (canvas_width, canvas_height):
+            self._size = (canvas_width, canvas_height)
+            self.canvas.coords(self._image_item, canvas_width // 2, canvas_height // 2)
+
+    def render(self, image, label_map=None, colors=None, alphas=None):
+        """縮小、混合、轉換顏色後就地更新PhotoImage"""
+        start = time.perf_counter()
+        canvas_width = self.canvas.winfo_width()
+        canvas_height = self.canvas.winfo_height()
+        if canvas_width <= 1 or canvas_height <= 1:
+            canvas_width, canvas_height = 800, 600
+        self._allocate((canvas_width, canvas_height), image.shape)
+
+        size = (self._bgr.shape[1], self._bgr.shape[0])
+        cv2.resize(image, size, dst=self._bgr, interpolation=self.interpolation)
+        if label_map is not None:
+            if self._labels is None or self._labels.dtype != label_map.dtype:
+                self._labels = np.empty(self._bgr.shape[:2], dtype=label_map.dtype)
+            # 標籤圖以最近鄰直接縮放到顯示尺寸 (模型解析度的標籤圖不需要先上採樣到原始尺寸)，
+            # 混合只處理顯示尺寸的像素
+            cv2.resize(label_map, size, dst=self._labels, interpolation=cv2.INTER_NEAREST)
+            blend_label_map(self._bgr, self._labels, colors, alphas)
+        cv2.cvtColor(self._bgr, cv2.COLOR_BGR2RGBA, dst=self._rgba)
+        self._photo.paste(self._pil)
+
+        self.shown += 1
+        self.render_seconds += time.perf_counter() - start
+
+    def _geometry(self):
+        """回傳 (縮放比例, x偏移, y偏移)，畫面置中顯示在canvas上"""
+        canvas_width, canvas_height = self._size
+        new_h, new_w = self._bgr.shape[:2]
+        return self._frame_size[0] / new_w, (canvas_width - new_w) // 2, (canvas_height - new_h) // 2
+
+    def canvas_to_image(self, x, y):
+        """canvas座標轉為原始畫面座標 (尚未繪製任何畫面時回傳None)"""
+        if self._bgr is None:
+            return None
+        scale, offset_x, offset_y = self._geometry()
+        return int((x - offset_x) * scale), int((y - offset_y) * scale)
+
+    def image_to_canvas(self, x, y):
+        """原始畫面座標轉為canvas座標"""
+        scale, offset_x, offset_y = self._geometry()
+        return x / scale + offset_x, y / scale + offset_y
+
+    def format(self):
+        """顯示統計 (顯示/略過的幀數和平均繪製時間)"""
+        skipped = self.submitted - self.shown
+        render_ms = self.render_seconds / self.shown * 1e3 if self.shown else 0.0
+        return f"顯示: {self.shown} 幀 (略過 {skipped} 幀), 平均繪製 {render_ms:.2f} ms/幀"
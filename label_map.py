@@ -0,0 +1,220 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+from ultralytics.utils import ops
+
+
+def valid_mask_region(mask_shape, image_shape):
+    """模型解析度的mask中對應畫面的區域 (高, 寬)
+
+    SAM2的輸入以LetterBox (center=False) 補齊在右方和下方，與ops.scale_masks(padding=False)
+    相同地去除補齊的部分後，剩下的區域才對應整個畫面。
+    """
+    mask_h, mask_w = mask_shape[:2]
+    image_h, image_w = image_shape[:2]
+    gain = min(mask_h / image_h, mask_w / image_w)
+    return mask_h - round(mask_h - image_h * gain + 0.1), mask_w - round(mask_w - image_w * gain + 0.1)
+
+
+def build_label_map(logits, out_shape, threshold=0.0, chunk_size=8):
+    """在logits的裝置上建立標籤圖，回傳 (標籤圖, 每個像素勝出的logit)
+
+    logits以雙線性上採樣到out_shape後逐像素取logit最高的物件，out_shape與logits相同時不上採樣。
+    """
+    num_objects = logits.shape[0]
+    dtype = LabelMapReducer.label_dtype(num_objects)
+    out_shape = tuple(out_shape)
+    best = torch.full(out_shape, threshold, dtype=torch.float32, device=logits.device)
+    labels = torch.zeros(out_shape, dtype=dtype, device=logits.device)
+
+    for start in range(0, num_objects, chunk_size):
+        chunk = logits[start:start + chunk_size].float()
+        if tuple(chunk.shape[-2:]) != out_shape:
+            chunk = ops.scale_masks(chunk[None], out_shape, padding=False)[0]
+        chunk_max, chunk_arg = chunk.max(dim=0)
+        better = chunk_max > best
+        best = torch.where(better, chunk_max, best)
+        labels = torch.where(better, (chunk_arg + start + 1).to(dtype), labels)
+    return labels, best
+
+
+class LabelMapReducer:
+    """在predictor的裝置上把多個物件的mask logits合併為單一標籤圖
+
+    閾值、重疊處理 (每個像素取logit最高的物件) 和標籤圖建立都在裝置上完成，
+    每幀只把一張uint8標籤圖 (0為背景，i+1為第i個物件) 經由重複使用的
+    pinned主機緩衝區傳回主機。
+    """
+
+    def __init__(self, threshold=0.0, chunk_size=8, num_buffers=2, keep_scores=False):
+        self.threshold = threshold
+        self.chunk_size = chunk_size  # 每次上採樣的物件數量，限制裝置上的暫存記憶體
+        self.num_buffers = num_buffers  # 輪替使用的主機緩衝區數量
+        self.keep_scores = keep_scores  # 保留每個像素勝出的logit (跨行程合併標籤圖時使用)
+        self.scores = None  # 最後一次build的 (H, W) 勝出logit，背景為threshold
+        self._buffers = []
+        self._buffer_index = 0
+
+        # 主機傳輸統計
+        self.frames = 0
+        self.transfer_bytes = 0
+        self.transfer_time = 0.0
+
+    @staticmethod
+    def label_dtype(num_objects):
+        """物件數量少於255時使用uint8，否則使用int32"""
+        return torch.uint8 if num_objects < 255 else torch.int32
+
+    def build(self, logits, out_shape):
+        """在裝置上建立標籤圖
+
+        Args:
+            logits: (N, h, w) 模型解析度的mask logits
+            out_shape: 輸出標籤圖的 (H, W)
+        """
+        labels, best = build_label_map(logits, out_shape, self.threshold, self.chunk_size)
+        if self.keep_scores:
+            self.scores = best
+        return labels
+
+    def _host_buffer(self, shape, dtype, pin_memory):
+        """取得下一個可重複使用的主機緩衝區"""
+        if len(self._buffers) < self.num_buffers:
+            self._buffers.append(None)
+        buffer = self._buffers[self._buffer_index]
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = torch.empty(shape, dtype=dtype, pin_memory=pin_memory)
+            self._buffers[self._buffer_index] = buffer
+        self._buffer_index = (self._buffer_index + 1) % self.num_buffers
+        return buffer
+
+    def to_host(self, labels):
+        """把裝置上的標籤圖傳回主機，回傳numpy陣列
+
+        回傳的陣列是輪替緩衝區的視圖，num_buffers幀之後會被覆寫，需要長期保留時請自行copy。
+        """
+        start = time.perf_counter()
+        if labels.device.type == "cpu":
+            host = labels
+        else:
+            host = self._host_buffer(tuple(labels.shape), labels.dtype, pin_memory=labels.is_cuda)
+            host.copy_(labels, non_blocking=labels.is_cuda)
+            if labels.is_cuda:
+                torch.cuda.current_stream(labels.device).synchronize()
+        self.transfer_time += time.perf_counter() - start
+        self.transfer_bytes += host.numel() * host.element_size()
+        self.frames += 1
+        return host.numpy()
+
+    def reduce(self, logits, out_shape):
+        """建立標籤圖並傳回主機"""
+        return self.to_host(self.build(logits, out_shape))
+
+    def empty(self, out_shape):
+        """沒有任何物件時的空標籤圖"""
+        self.frames += 1
+        if self.keep_scores:
+            self.scores = None
+        return np.zeros(out_shape, dtype=np.uint8)
+
+    def stats(self):
+        """回傳每幀平均傳輸量 (bytes) 和傳輸時間 (ms)"""
+        if self.frames == 0:
+            return 0.0, 0.0
+        return self.transfer_bytes / self.frames, self.transfer_time * 1e3 / self.frames
+
+
+def build_label_luts(labels_to_colors, default_color=(0, 0, 255), default_alpha=0.5):
+    """由 [(BGR顏色, 透明度), ...] 建立標籤查找表，索引0為背景"""
+    colors = np.zeros((len(labels_to_colors) + 1, 3), dtype=np.float32)
+    alphas = np.zeros(len(labels_to_colors) + 1, dtype=np.float32)
+    for label, (color, alpha) in enumerate(labels_to_colors, start=1):
+        colors[label] = color if color is not None else default_color
+        alphas[label] = alpha if alpha is not None else default_alpha
+    return colors, alphas
+
+
+def blend_label_map(image, label_map, colors, alphas, out=None):
+    """依標籤圖一次完成所有物件的透明度混合
+
+    out為None時原地修改image；否則先複製到out (可重複使用的緩衝區) 再混合，image不變，
+    用於共用的唯讀解碼幀。
+    """
+    if out is not None:
+        np.copyto(out, image)
+        image = out
+    foreground = label_map > 0
+    if not foreground.any():
+        return image
+    labels = label_map[foreground]
+    alpha = alphas[labels][:, None]
+    image[foreground] = (image[foreground] * (1 - alpha) + colors[labels] * alpha).astype(np.uint8)
+    return image
+
+
+def render_label_map(label_map, colors, alphas, background_color):
+    """把標籤圖渲染為純Mask幀 (前景顏色以透明度混合到背景色上)"""
+    background = np.asarray(background_color, dtype=np.float32)
+    lut = background * (1 - alphas[:, None]) + colors * alphas[:, None]
+    lut[0] = background
+    return lut.astype(np.uint8)[label_map]
+
+
+def benchmark(num_objects, height, width, device, frames=20, low_res=256):
+    """比較逐物件傳回主機與標籤圖傳回主機的傳輸量和時間"""
+    logits = torch.randn(num_objects, low_res, low_res, device=device) * 4
+    sync = torch.cuda.synchronize if device.type == "cuda" else (lambda: None)
+
+    # 舊流程: 每個物件在裝置上上採樣與閾值化後各自傳回主機 (覆蓋影片和Mask影片各一次)
+    per_object_bytes = 0
+    start = time.perf_counter()
+    for _ in range(frames):
+        masks = ops.scale_masks(logits[None].float(), (height, width), padding=False)[0] > 0
+        for _ in range(2):
+            for mask in masks:
+                per_object_bytes += mask.cpu().numpy().nbytes
+        sync()
+    per_object_time = (time.perf_counter() - start) * 1e3 / frames
+
+    # 新流程: 在裝置上建立標籤圖，每幀只傳回一張uint8標籤圖
+    reducer = LabelMapReducer()
+    start = time.perf_counter()
+    for _ in range(frames):
+        reducer.reduce(logits, (height, width))
+        sync()
+    label_time = (time.perf_counter() - start) * 1e3 / frames
+    label_bytes, transfer_ms = reducer.stats()
+
+    return {
+        'objects': num_objects,
+        'per_object_mb': per_object_bytes / frames / 1e6,
+        'per_object_ms': per_object_time,
+        'label_map_mb': label_bytes / 1e6,
+        'label_map_ms': label_time,
+        'transfer_ms': transfer_ms
+    }
+
+
+def main():
+    """報告1、10、100個物件時每幀的主機傳輸量和時間"""
+    parser = argparse.ArgumentParser(description="mask主機傳輸量基準測試")
+    parser.add_argument("--objects", type=int, nargs="+", default=[1, 10, 100], help="物件數量")
+    parser.add_argument("--height", type=int, default=1080, help="幀高度")
+    parser.add_argument("--width", type=int, default=1920, help="幀寬度")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="裝置")
+    parser.add_argument("--frames", type=int, default=20, help="每組測試的幀數")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    print(f"裝置: {device}, 幀尺寸: {args.width}x{args.height}")
+    print(f"{'物件數':>6} | {'逐物件 MB/幀':>12} | {'逐物件 ms/幀':>12} | {'標籤圖 MB/幀':>12} | {'標籤圖 ms/幀':>12} | {'傳輸 ms/幀':>10}")
+    for num_objects in args.objects:
+        r = benchmark(num_objects, args.height, args.width, device, frames=args.frames)
+        print(f"{r['objects']:>6} | {r['per_object_mb']:>12.2f} | {r['per_object_ms']:>12.2f} | "
+              f"{r['label_map_mb']:>12.2f} | {r['label_map_ms']:>12.2f} | {r['transfer_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from mask_archive import MaskArchiveWriter, archive_iou
+from model_optimization import DEFAULT_OPTIMIZATION_CONFIG, mode_config
+
+
+# 本機硬體設定的預設值 (由校準工具寫入sam2_config.json的"machine_profile"區段)
+# None/0 表示沿用各程式原本的設定，未校準的機器行為不變
+DEFAULT_MACHINE_PROFILE = {
+    "device": None,  # SAM2/YOLOE使用的裝置 ("cpu"、"cuda"、"cuda:1" ...)
+    "imgsz": None,  # SAM2輸入尺寸
+    "num_threads": 0  # torch的CPU執行緒數
+}
+
+
+def load_machine_profile(config_path="./sam2_config.json"):
+    """讀取配置檔案中的machine_profile區段 (不存在時回傳預設值)"""
+    profile = dict(DEFAULT_MACHINE_PROFILE)
+    if os.path.exists(config_path):
+        try:
+            with open(config_path, 'r', encoding='utf-8') as f:
+                profile.update(json.load(f).get('machine_profile', {}))
+        except Exception as e:
+            print(f"加載本機硬體設定時出錯: {e}")
+    return profile
+
+
+def apply_machine_profile(overrides, profile):
+    """把硬體設定套用到SAM2的overrides (就地修改並回傳) 並設定torch執行緒數"""
+    if profile.get('device'):
+        overrides['device'] = profile['device']
+    if profile.get('imgsz'):
+        overrides['imgsz'] = profile['imgsz']
+    if profile.get('num_threads'):
+        torch.set_num_threads(profile['num_threads'])
+    return overrides
+
+
+def default_grid():
+    """預設的校準網格: 可用的裝置 × 輸入尺寸 × CPU執行緒數"""
+    cpu_count = os.cpu_count() or 1
+    devices = ["cuda", "cpu"] if torch.cuda.is_available() else ["cpu"]
+    threads = sorted({1, max(1, cpu_count // 2), cpu_count}, reverse=True)
+    return devices, [1024, 768, 512], threads
+
+
+def calibrate_setting(video_path, boxes, model, setting, frames, archive_path):
+    """在全新的行程中以單一設定追蹤合成片段，量測匯入、載入、暖機和穩定延遲"""
+    start = time.perf_counter()
+    import ultralytics  # noqa: F401 (量測匯入時間)
+    from sam2_engine import SAM2FrameEngine
+    from sharded_tracking import sam2_overrides
+    from video_source import PrefetchFrameReader
+    import_seconds = time.perf_counter() - start
+
+    if setting['num_threads']:
+        torch.set_num_threads(setting['num_threads'])
+    engine = SAM2FrameEngine(sam2_overrides(model, setting['device'], setting['imgsz']), num_frames=frames,
+                             source_name=video_path, optimization=mode_config(setting['optimization']))
+    start = time.perf_counter()
+    engine.load_model()
+    load_seconds = time.perf_counter() - start
+
+    engine.add_objects(boxes, frame_idx=0)
+    latencies = []
+    writer = None
+    for frame_idx, frame in PrefetchFrameReader(video_path, end=frames):
+        start = time.perf_counter()
+        result = engine.step(frame, frame_idx)
+        latencies.append(time.perf_counter() - start)
+        if writer is None:
+            writer = MaskArchiveWriter(archive_path, *result.label_map.shape, obj_ids=result.obj_ids,
+                                       dtype=result.label_map.dtype)
+        writer.write(result.frame_idx, result.label_map)
+    if writer is not None:
+        writer.close()
+    applied = engine.applied_optimizations
+    engine.close()
+
+    # 第一幀包含圖像尺寸設定和torch.compile的編譯，視為暖機
+    steady = np.asarray(latencies[1:] or latencies) * 1e3
+    return {
+        'applied': applied,
+        'frames': len(latencies),
+        'import_ms': round(import_seconds * 1e3, 1),
+        'load_ms': round(load_seconds * 1e3, 1),
+        'warmup_ms': round(latencies[0] * 1e3, 1) if latencies else 0.0,
+        'latency_mean_ms': round(float(steady.mean()), 2) if len(steady) else 0.0,
+        'latency_p90_ms': round(float(np.percentile(steady, 90)), 2) if len(steady) else 0.0
+    }
+
+
+def setting_name(setting):
+    return f"{setting['device']}/imgsz{setting['imgsz']}/t{setting['num_threads']}/{setting['optimization']}"
+
+
+def calibrate(video_path, boxes, model, settings, frames, min_iou):
+    """依序 (各自在獨立行程中) 執行每個設定，並以第一個設定 (參考設定) 的mask計算IoU
+
+    參考設定應為品質最高的設定 (最大輸入尺寸、不做最佳化)，回傳 (報告列表, 推薦設定)。
+    """
+    context = multiprocessing.get_context("spawn")
+    report = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        reference_archive = None
+        for index, setting in enumerate(settings):
+            name = setting_name(setting)
+            archive_path = os.path.join(tmp_dir, f"setting_{index}")
+            print(f"校準設定: {name}")
+            with context.Pool(1) as pool:
+                try:
+                    stats = pool.apply(calibrate_setting, (video_path, boxes, model, setting, frames, archive_path))
+                except Exception as e:
+                    print(f"設定 {name} 執行失敗: {e}")
+                    report.append({'setting': setting, 'error': str(e)})
+                    continue
+            if reference_archive is None:
+                reference_archive = archive_path
+                stats['mean_iou'] = 1.0
+            else:
+                stats['mean_iou'] = round(archive_iou(reference_archive, archive_path), 4)
+            report.append({'setting': setting, **stats})
+
+    # 在符合IoU門檻的設定中選出穩定延遲最低者
+    candidates = [(entry['latency_mean_ms'], index) for index, entry in enumerate(report)
+                  if 'error' not in entry and entry['mean_iou'] >= min_iou]
+    recommended = report[min(candidates)[1]] if candidates else None
+    return report, recommended
+
+
+def write_profile(config_path, entry, min_iou, write_optimization=False):
+    """把推薦設定寫入配置檔案的machine_profile區段 (保留其他區段)
+
+    有校準最佳化模式時，選出的模式同時寫入應用程式原本讀取的optimization區段。
+    """
+    config = {}
+    if os.path.exists(config_path):
+        with open(config_path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    setting = entry['setting']
+    config['machine_profile'] = {
+        'device': setting['device'],
+        'imgsz': setting['imgsz'],
+        'num_threads': setting['num_threads'],
+        'calibrated': {
+            'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'machine': platform.node(),
+            'cpu_count': os.cpu_count(),
+            'cuda': torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+            'optimization': setting['optimization'],
+            'latency_mean_ms': entry['latency_mean_ms'],
+            'mean_iou': entry['mean_iou'],
+            'min_iou': min_iou
+        }
+    }
+    if write_optimization:
+        optimization = dict(DEFAULT_OPTIMIZATION_CONFIG)
+        optimization.update(config.get('optimization', {}))
+        optimization.update({name: value for name, value in mode_config(setting['optimization']).items()
+                             if name in ("int8", "bf16", "compile")})
+        config['optimization'] = optimization
+    with open(config_path, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+
+
+def main():
+    """在合成片段上校準本機的SAM2處理設定，把符合mask品質門檻的最快設定寫入配置檔案"""
+    from soak_test import make_synthetic_video
+    from test_ultralytics import test_installation
+
+    devices, sizes, threads = default_grid()
+    parser = argparse.ArgumentParser(description="SAM2本機硬體校準")
+    parser.add_argument("--config", default="./sam2_config.json", help="寫入machine_profile區段的配置檔案")
+    parser.add_argument("--model", default="./models/sam2.1_t.pt", help="SAM2模型路徑")
+    parser.add_argument("--devices", nargs="+", default=devices, help="要校準的裝置")
+    parser.add_argument("--imgsz", nargs="+", type=int, default=sizes, help="要校準的輸入尺寸 (第一個為參考)")
+    parser.add_argument("--threads", nargs="+", type=int, default=threads, help="要校準的CPU執行緒數 (0為torch預設)")
+    parser.add_argument("--modes", nargs="+", default=["baseline"], help="要校準的最佳化模式 (可用+組合)")
+    parser.add_argument("--frames", type=int, default=30, help="合成片段幀數")
+    parser.add_argument("--width", type=int, default=640, help="合成片段寬度")
+    parser.add_argument("--height", type=int, default=480, help="合成片段高度")
+    parser.add_argument("--objects", type=int, default=3, help="合成片段中的物件數量")
+    parser.add_argument("--min-iou", type=float, default=0.9, help="與參考設定相比可接受的最低平均IoU")
+    parser.add_argument("--output", default="./output", help="報告輸出目錄")
+    parser.add_argument("--dry-run", action="store_true", help="只輸出報告，不寫入配置檔案")
+    args = parser.parse_args()
+
+    # 沿用test_ultralytics的安裝檢查，再確認模型檔案存在
+    if not test_installation():
+        return
+    if not os.path.exists(args.model):
+        print(f"找不到SAM2模型: {args.model}")
+        return
+
+    # 參考設定: 第一個裝置、第一個輸入尺寸、第一個執行緒數、baseline
+    modes = ["baseline"] + [mode for mode in args.modes if mode != "baseline"]
+    # GPU上的執行緒數幾乎不影響延遲，只在CPU裝置上展開執行緒數
+    settings = [{'device': device, 'imgsz': imgsz, 'num_threads': num_threads, 'optimization': mode}
+                for device, imgsz, mode in itertools.product(args.devices, args.imgsz, modes)
+                for num_threads in (args.threads if device == "cpu" else [0])]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        video_path = os.path.join(tmp_dir, "calibration.mp4")
+        boxes = make_synthetic_video(video_path, args.frames, args.width, args.height, args.objects)
+        report, recommended = calibrate(video_path, boxes, args.model, settings, args.frames, args.min_iou)
+
+    print(f"{'設定':<32} | {'匯入 ms':>8} | {'載入 ms':>8} | {'暖機 ms':>8} | {'平均 ms/幀':>10} | {'p90 ms':>8} | {'平均IoU':>7}")
+    for entry in report:
+        name = setting_name(entry['setting'])
+        if 'error' in entry:
+            print(f"{name:<32} | 失敗: {entry['error']}")
+            continue
+        print(f"{name:<32} | {entry['import_ms']:>8.0f} | {entry['load_ms']:>8.0f} | {entry['warmup_ms']:>8.0f} | "
+              f"{entry['latency_mean_ms']:>10.1f} | {entry['latency_p90_ms']:>8.1f} | {entry['mean_iou']:>7.4f}")
+
+    os.makedirs(args.output, exist_ok=True)
+    report_path = os.path.join(args.output, f"calibration_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump({'settings': report, 'recommended': recommended, 'min_iou': args.min_iou}, f,
+                  ensure_ascii=False, indent=2)
+    print(f"報告已儲存: {report_path}")
+
+    if recommended is None:
+        print(f"沒有設定符合IoU門檻 ({args.min_iou})，配置檔案未修改")
+        return
+    print(f"符合IoU門檻 ({args.min_iou}) 的最快設定: {setting_name(recommended['setting'])}")
+    if not args.dry_run:
+        write_profile(args.config, recommended, args.min_iou, write_optimization=len(modes) > 1)
+        print(f"本機硬體設定已寫入: {args.config} (machine_profile)")
+
+
+if __name__ == "__main__":
+    main()
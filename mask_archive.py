@@ -0,0 +1,166 @@
+import json
+import os
+import zlib
+
+import numpy as np
+
+from object_masks import masks_from_label_map
+
+
+class MaskArchiveWriter:
+    """把逐幀標籤圖寫入mask存檔目錄
+
+    存檔目錄包含:
+        meta.json  - 尺寸、dtype、物件編號和類別等資訊 (標籤i+1對應obj_ids[i])
+        labels.bin - 逐幀zlib壓縮的標籤圖，依寫入順序追加
+        index.npy  - 每幀的 (frame_idx, offset, length)
+    """
+
+    def __init__(self, path, height, width, obj_ids=(), dtype=np.uint8, meta=None, level=1):
+        self.path = path
+        self.height = height
+        self.width = width
+        self.obj_ids = list(obj_ids)
+        self.dtype = np.dtype(dtype)
+        self.meta = dict(meta or {})
+        self.level = level  # zlib壓縮等級，標籤圖大多是連續區塊，低等級就足夠
+
+        os.makedirs(path, exist_ok=True)
+        self._data = open(os.path.join(path, "labels.bin"), 'wb')
+        self._index = []
+        self._offset = 0
+
+    def write(self, frame_idx, label_map):
+        """寫入一幀標籤圖"""
+        label_map = np.ascontiguousarray(label_map, dtype=self.dtype)
+        if label_map.shape != (self.height, self.width):
+            raise ValueError(f"標籤圖尺寸不符: {label_map.shape} != {(self.height, self.width)}")
+        self.write_raw(frame_idx, zlib.compress(label_map.tobytes(), self.level))
+
+    def write_raw(self, frame_idx, data):
+        """直接寫入一幀已壓縮的資料 (由相同尺寸和dtype的存檔以read_raw取得，不需解壓)"""
+        self._data.write(data)
+        self._index.append((frame_idx, self._offset, len(data)))
+        self._offset += len(data)
+
+    def close(self):
+        """寫入索引和meta.json"""
+        if self._data is None:
+            return
+        self._data.close()
+        self._data = None
+        np.save(os.path.join(self.path, "index.npy"), np.asarray(self._index, dtype=np.int64).reshape(-1, 3))
+        meta = dict(self.meta)
+        meta.update({
+            'height': self.height,
+            'width': self.width,
+            'dtype': self.dtype.name,
+            'obj_ids': self.obj_ids,
+            'frames': len(self._index)
+        })
+        with open(os.path.join(self.path, "meta.json"), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class MaskArchive:
+    """讀取mask存檔，支援依幀編號隨機存取"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.height = self.meta['height']
+        self.width = self.meta['width']
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.obj_ids = self.meta['obj_ids']
+
+        index = np.load(os.path.join(path, "index.npy"))
+        self._entries = {int(frame_idx): (int(offset), int(length)) for frame_idx, offset, length in index}
+        self.frame_indices = sorted(self._entries)
+        self._data = open(os.path.join(path, "labels.bin"), 'rb')
+
+    def __len__(self):
+        return len(self.frame_indices)
+
+    def __contains__(self, frame_idx):
+        return frame_idx in self._entries
+
+    def read_raw(self, frame_idx):
+        """讀取指定幀未解壓的資料"""
+        offset, length = self._entries[frame_idx]
+        self._data.seek(offset)
+        return self._data.read(length)
+
+    def read(self, frame_idx):
+        """讀取指定幀的標籤圖"""
+        data = zlib.decompress(self.read_raw(frame_idx))
+        return np.frombuffer(data, dtype=self.dtype).reshape(self.height, self.width)
+
+    def __iter__(self):
+        """依幀編號順序產生 (frame_idx, label_map)"""
+        for frame_idx in self.frame_indices:
+            yield frame_idx, self.read(frame_idx)
+
+    def close(self):
+        self._data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def label_map_boxes(label_map, num_labels, shape=None):
+    """由標籤圖計算每個標籤 (1..num_labels) 的xyxy框，不存在的標籤為None
+
+    shape為 (H, W) 時把框換算為該尺寸的座標 (由低解析度的標籤圖計算原始畫面的框)。
+    """
+    boxes = [None] * num_labels
+    ys, xs = np.nonzero(label_map)
+    if len(ys) == 0:
+        return boxes
+    scale_x = scale_y = 1.0
+    if shape is not None:
+        scale_y = shape[0] / label_map.shape[0]
+        scale_x = shape[1] / label_map.shape[1]
+    labels = label_map[ys, xs].astype(np.int64)
+    for label in np.unique(labels):
+        if label < 1 or label > num_labels:
+            continue
+        sel = labels == label
+        boxes[label - 1] = [int(xs[sel].min() * scale_x), int(ys[sel].min() * scale_y),
+                            int(np.ceil((xs[sel].max() + 1) * scale_x)), int(np.ceil((ys[sel].max() + 1) * scale_y))]
+    return boxes
+
+
+def archive_iou(archive_a, archive_b):
+    """比較兩個mask存檔中相同物件編號的平均IoU (逐物件累計所有共同幀)"""
+    with MaskArchive(archive_a) as a, MaskArchive(archive_b) as b:
+        common = [obj_id for obj_id in a.obj_ids if obj_id in b.obj_ids]
+        inter = np.zeros(len(common))
+        union = np.zeros(len(common))
+        labels_a = [a.obj_ids.index(obj_id) + 1 for obj_id in common]
+        labels_b = [b.obj_ids.index(obj_id) + 1 for obj_id in common]
+        for frame_idx, map_a in a:
+            if frame_idx not in b:
+                continue
+            # 裁切的物件mask: 交集只處理兩個框重疊的部分，面積在建立時已計算
+            masks_a = masks_from_label_map(map_a, len(a.obj_ids))
+            masks_b = masks_from_label_map(b.read(frame_idx), len(b.obj_ids))
+            for i, (label_a, label_b) in enumerate(zip(labels_a, labels_b)):
+                mask_a, mask_b = masks_a[label_a - 1], masks_b[label_b - 1]
+                overlap = mask_a.intersection(mask_b) if mask_a is not None and mask_b is not None else 0
+                inter[i] += overlap
+                union[i] += (mask_a.area if mask_a is not None else 0) + (mask_b.area if mask_b is not None else 0) - overlap
+    if not common:
+        return 0.0
+    # 兩邊都沒有mask的物件視為完全一致
+    iou = np.where(union > 0, inter / np.maximum(union, 1), 1.0)
+    return float(iou.mean())
@@ -0,0 +1,254 @@
+import argparse
+import collections
+import concurrent.futures
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from object_masks import masks_from_label_map
+
+
+# mask後處理的預設配置 (可在sam2_config.json的"mask_postprocess"區段覆寫)
+DEFAULT_MASK_POSTPROCESS_CONFIG = {
+    "enabled": False,
+    "workers": 2,  # 後處理的工作執行緒數
+    "max_pending": 8,  # 後處理中尚未寫入的幀數上限 (至少為workers)
+    "min_area": 64,  # 移除面積小於此值的連通區域 (像素，0為不移除)
+    "fill_holes": True,  # 填補物件內部的孔洞
+    "max_hole_area": 0,  # 只填補面積不超過此值的孔洞 (像素，0為不限制)
+    "smooth": 5,  # 形態學閉運算再開運算的橢圓核大小 (像素，0或1為不平滑)
+    "priority": 0,  # 物件重疊時優先權高的類別取得重疊的像素
+    "classes": {}  # 依類別名稱覆寫上面的參數，例如 {"Person": {"priority": 1, "min_area": 200}}
+}
+
+CLASS_PARAM_KEYS = ("min_area", "fill_holes", "max_hole_area", "smooth", "priority")
+
+
+def class_params(config, class_name):
+    """合併預設參數和類別的覆寫參數"""
+    params = {key: config.get(key, DEFAULT_MASK_POSTPROCESS_CONFIG[key]) for key in CLASS_PARAM_KEYS}
+    params.update((config.get('classes') or {}).get(class_name, {}))
+    return params
+
+
+def clean_mask(mask, min_area=0, fill_holes=False, max_hole_area=0, smooth=0, **_):
+    """清理單一物件的bool mask: 移除小連通區域、平滑、填補孔洞
+
+    區域需已向外留白 (接觸區域邊緣的背景視為物件外部，不當作孔洞)。
+    """
+    mask = mask.astype(np.uint8)
+    if min_area > 0:
+        _, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        keep = stats[:, cv2.CC_STAT_AREA] >= min_area
+        keep[0] = False
+        mask = keep[labels].astype(np.uint8)
+    if smooth > 1:
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (int(smooth), int(smooth)))
+        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+    mask = mask > 0
+    if fill_holes:
+        # 背景的4連通區域中不接觸邊緣的為孔洞
+        count, labels, stats, _ = cv2.connectedComponentsWithStats((~mask).astype(np.uint8), connectivity=4)
+        hole = np.ones(count, dtype=bool)
+        hole[0] = False
+        for edge in (labels[0], labels[-1], labels[:, 0], labels[:, -1]):
+            hole[edge] = False
+        if max_hole_area > 0:
+            hole &= stats[:, cv2.CC_STAT_AREA] <= max_hole_area
+        if hole.any():
+            mask = mask | hole[labels]
+    return mask
+
+
+def remove_specks(label_map, params):
+    """一次移除整張標籤圖中的小斑點 (回傳新的標籤圖，沒有要移除的斑點時回傳原圖)
+
+    對所有前景做一次連通區域標記: 連通區域 (可能包含多個相鄰的物件) 的面積小於其中
+    像素所屬標籤的min_area時，該標籤在這個區域內的部分一定也小於min_area，可以直接移除。
+    遠處的斑點因此不會把物件的外接框撐大到整個畫面。
+    """
+    min_area = np.zeros(len(params) + 1, dtype=np.int64)
+    min_area[1:] = [p['min_area'] for p in params]
+    if not min_area.any():
+        return label_map
+    _, components, stats, _ = cv2.connectedComponentsWithStats((label_map > 0).astype(np.uint8), connectivity=8)
+    small = stats[:, cv2.CC_STAT_AREA] < min_area.max()
+    small[0] = False
+    if not small.any():
+        return label_map
+    speck = small[components]
+    speck[speck] = stats[components[speck], cv2.CC_STAT_AREA] < min_area[label_map[speck]]
+    if not speck.any():
+        return label_map
+    label_map = label_map.copy()
+    label_map[speck] = 0
+    return label_map
+
+
+def postprocess_label_map(label_map, params):
+    """依每個標籤的參數 (params[i]對應標籤i+1) 清理標籤圖，回傳新的標籤圖
+
+    先一次移除整張圖的小斑點，之後每個物件只在外接框 (向外留白) 內處理。平滑和填補孔洞
+    可能讓物件長到其他物件上，重疊的像素由優先權高的物件取得；優先權相同時保留給原本的物件。
+    """
+    label_map = remove_specks(label_map, params)
+    masks = masks_from_label_map(label_map, len(params))
+    height, width = label_map.shape[:2]
+    out = np.zeros_like(label_map)
+    priority = np.full(len(params) + 1, -np.inf)
+    priority[1:] = [p['priority'] for p in params]
+    # 依優先權由低到高寫入 (sorted為穩定排序，同優先權依標籤順序)
+    for i in sorted(range(len(params)), key=lambda i: params[i]['priority']):
+        if masks[i] is None:
+            continue
+        label = i + 1
+        margin = max(0, int(params[i]['smooth'])) + 1
+        x1, y1, x2, y2 = masks[i].box
+        x1, y1 = max(0, x1 - margin), max(0, y1 - margin)
+        x2, y2 = min(width, x2 + margin), min(height, y2 + margin)
+        cleaned = clean_mask(masks[i].region((x1, y1, x2, y2)), **params[i])
+        region = out[y1:y2, x1:x2]
+        claim = cleaned & ((priority[region] < priority[label]) | (label_map[y1:y2, x1:x2] == label))
+        region[claim] = label
+    return out
+
+
+class MaskPostprocessor:
+    """在工作執行緒池中清理標籤圖，依提交順序交給寫入器
+
+    推論端每幀提交一張標籤圖 (會被複製，可傳入輪替緩衝區的視圖) 和每個標籤的類別，
+    submit回傳已完成的幀；後處理中的幀超過max_pending時等待最舊的一幀，
+    讓後處理跟不上時對推論施加背壓，而不是無限累積。
+    """
+
+    def __init__(self, config=None):
+        self.config = dict(DEFAULT_MASK_POSTPROCESS_CONFIG)
+        self.config.update(config or {})
+        self.workers = max(1, int(self.config['workers']))
+        self.max_pending = max(self.workers, int(self.config['max_pending']))
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        self._pending = collections.deque()
+        self._lock = threading.Lock()
+
+        # 統計
+        self.frames = 0
+        self.process_seconds = 0.0  # 工作執行緒中的處理時間 (所有執行緒的總和)
+        self.stall_seconds = 0.0  # 寫入端等待後處理的時間
+        self.changed_pixels = 0
+        self.total_pixels = 0
+
+    def params(self, classes):
+        return [class_params(self.config, class_name) for class_name in classes]
+
+    def _process(self, label_map, params):
+        start = time.perf_counter()
+        out = postprocess_label_map(label_map, params)
+        changed = int(np.count_nonzero(out != label_map))
+        with self._lock:
+            self.process_seconds += time.perf_counter() - start
+            self.changed_pixels += changed
+            self.total_pixels += label_map.size
+        return out
+
+    def _pop(self):
+        item, future = self._pending.popleft()
+        wait_start = time.perf_counter()
+        label_map = future.result()
+        self.stall_seconds += time.perf_counter() - wait_start
+        self.frames += 1
+        return item, label_map
+
+    def submit(self, item, label_map, classes):
+        """提交一幀 (classes[i]為標籤i+1的類別)，回傳已完成的 [(item, 後處理的標籤圖), ...] (依提交順序)"""
+        future = self._executor.submit(self._process, label_map.copy(), self.params(classes))
+        self._pending.append((item, future))
+        done = []
+        while self._pending and (len(self._pending) > self.max_pending or self._pending[0][1].done()):
+            done.append(self._pop())
+        return done
+
+    def drain(self):
+        """等待並回傳所有尚未取出的幀 (依提交順序)"""
+        return [self._pop() for _ in range(len(self._pending))]
+
+    def close(self):
+        for _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=False)
+
+    def summary(self):
+        return {
+            'workers': self.workers,
+            'frames': self.frames,
+            'process_ms': round(self.process_seconds * 1e3 / self.frames, 2) if self.frames else 0.0,
+            'stall_seconds': round(self.stall_seconds, 3),
+            'changed_ratio': round(self.changed_pixels / self.total_pixels, 5) if self.total_pixels else 0.0
+        }
+
+    def format(self):
+        summary = self.summary()
+        return (f"Mask後處理: {summary['frames']} 幀, {self.workers} 個工作執行緒, "
+                f"平均每幀 {summary['process_ms']:.1f} ms, 寫入等待 {self.stall_seconds:.1f} 秒, "
+                f"修改 {summary['changed_ratio'] * 100:.2f}% 的像素")
+
+
+def make_noisy_label_map(rng, num_objects, height, width, radius):
+    """產生有斑點、孔洞和細突出物的合成標籤圖 (相鄰物件可能互相接觸)"""
+    label_map = np.zeros((height, width), dtype=np.uint8)
+    for label in range(1, num_objects + 1):
+        cx, cy = int(rng.integers(radius, width - radius)), int(rng.integers(radius, height - radius))
+        cv2.ellipse(label_map, (cx, cy), (radius, radius * 2 // 3), int(rng.integers(0, 180)), 0, 360, label, -1)
+        for _ in range(4):
+            # 孔洞、斑點和細突出物
+            hx, hy = cx + int(rng.integers(-radius // 2, radius // 2)), cy + int(rng.integers(-radius // 3, radius // 3))
+            cv2.circle(label_map, (hx, hy), 3, 0, -1)
+            sx, sy = cx + int(rng.integers(-2 * radius, 2 * radius)), cy + int(rng.integers(-2 * radius, 2 * radius))
+            cv2.circle(label_map, (sx, sy), 2, label, -1)
+        cv2.line(label_map, (cx, cy), (cx + radius * 2, cy + int(rng.integers(-radius, radius))), label, 1)
+    noise = (rng.random((height, width)) < 0.0005) & (label_map == 0)  # 背景中的雜訊像素
+    label_map[noise] = rng.integers(1, num_objects + 1, int(noise.sum()))
+    return label_map
+
+
+def benchmark(workers, num_objects, height, width, radius=60, frames=20, seed=0):
+    """量測指定工作執行緒數下每幀的後處理時間和吞吐量"""
+    rng = np.random.default_rng(seed)
+    label_maps = [make_noisy_label_map(rng, num_objects, height, width, radius) for _ in range(4)]
+    classes = ["Object"] * num_objects
+    postprocessor = MaskPostprocessor({'workers': workers, 'max_pending': workers * 2})
+    start = time.perf_counter()
+    count = 0
+    for i in range(frames):
+        count += len(postprocessor.submit(i, label_maps[i % len(label_maps)], classes))
+    count += len(postprocessor.drain())
+    seconds = time.perf_counter() - start
+    postprocessor.close()
+    summary = postprocessor.summary()
+    summary['fps'] = count / seconds
+    return summary
+
+
+def main():
+    """報告不同工作執行緒數下mask後處理的吞吐量"""
+    parser = argparse.ArgumentParser(description="mask後處理的吞吐量基準測試")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="工作執行緒數")
+    parser.add_argument("--objects", type=int, default=10, help="物件數量")
+    parser.add_argument("--height", type=int, default=1080, help="幀高度")
+    parser.add_argument("--width", type=int, default=1920, help="幀寬度")
+    parser.add_argument("--radius", type=int, default=60, help="物件半徑 (像素)")
+    parser.add_argument("--frames", type=int, default=20, help="每組測試的幀數")
+    args = parser.parse_args()
+
+    print(f"幀尺寸: {args.width}x{args.height}, 物件數: {args.objects}, 執行緒數: {cv2.getNumThreads()} (OpenCV)")
+    print(f"{'工作執行緒':>8} | {'每幀處理 ms':>10} | {'吞吐量 FPS':>10} | {'修改像素 %':>10}")
+    for workers in args.workers:
+        r = benchmark(workers, args.objects, args.height, args.width, args.radius, args.frames)
+        print(f"{workers:>8} | {r['process_ms']:>10.1f} | {r['fps']:>10.1f} | {r['changed_ratio'] * 100:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
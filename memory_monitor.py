@@ -0,0 +1,205 @@
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import torch
+
+
+# 記憶體監控的預設配置 (可在sam2_config.json的"memory"區段覆寫)
+DEFAULT_MEMORY_CONFIG = {
+    "enabled": False,
+    "sample_interval": 50,  # 每N幀取樣一次
+    "tracemalloc_top": 10,  # 報告增長最多的Python配置位置數量，0表示不啟用tracemalloc
+    "growth_threshold_mb": 32  # 單調增長超過此值才判定為洩漏
+}
+
+MB = 1024 * 1024
+
+
+def rss_bytes():
+    """目前行程的常駐記憶體 (RSS)，無法取得時回傳0"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        # 只能取得峰值RSS (Linux為KB，macOS為bytes)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        return 0
+
+
+def torch_memory():
+    """torch CUDA配置器的統計 (MB)，沒有CUDA時回傳空字典"""
+    if not torch.cuda.is_available():
+        return {}
+    return {
+        'torch_allocated_mb': torch.cuda.memory_allocated() / MB,
+        'torch_reserved_mb': torch.cuda.memory_reserved() / MB,
+        'torch_peak_mb': torch.cuda.max_memory_allocated() / MB
+    }
+
+
+def memory_sample():
+    """取樣一次RSS、Python堆積 (tracemalloc) 和torch配置器的記憶體 (MB)"""
+    sample = {'time': time.time(), 'rss_mb': rss_bytes() / MB}
+    if tracemalloc.is_tracing():
+        sample['py_heap_mb'] = tracemalloc.get_traced_memory()[0] / MB
+    sample.update(torch_memory())
+    return sample
+
+
+def detect_growth(values, threshold_mb, warmup=1, min_samples=4, monotonic_ratio=0.8):
+    """判斷一串取樣值是否持續單調增長
+
+    略過前warmup個取樣 (模型載入等一次性配置)，相鄰取樣中至少monotonic_ratio比例不下降、
+    線性趨勢為正且總增長超過threshold_mb時判定為洩漏。取樣不足時回傳None。
+    """
+    values = np.asarray(values, dtype=np.float64)[warmup:]
+    if len(values) < min_samples:
+        return None
+    # 允許少量抖動 (閾值的1%) 仍視為不下降
+    diffs = np.diff(values)
+    monotonic = float((diffs >= -threshold_mb * 0.01).mean())
+    slope = float(np.polyfit(np.arange(len(values)), values, 1)[0])
+    growth = float(values[-1] - values[0])
+    return {
+        'growth_mb': round(growth, 2),
+        'slope_mb_per_sample': round(slope, 4),
+        'monotonic_ratio': round(monotonic, 3),
+        'leak': monotonic >= monotonic_ratio and slope > 0 and growth > threshold_mb
+    }
+
+
+class MemoryMonitor:
+    """追蹤期間定期取樣記憶體，並在結束時檢查逐幀的單調增長"""
+
+    SERIES = ('rss_mb', 'py_heap_mb', 'torch_allocated_mb', 'torch_reserved_mb')
+
+    def __init__(self, sample_interval=DEFAULT_MEMORY_CONFIG["sample_interval"],
+                 tracemalloc_top=DEFAULT_MEMORY_CONFIG["tracemalloc_top"],
+                 growth_threshold_mb=DEFAULT_MEMORY_CONFIG["growth_threshold_mb"]):
+        self.sample_interval = max(1, sample_interval)
+        self.tracemalloc_top = tracemalloc_top
+        self.growth_threshold_mb = growth_threshold_mb
+        self.samples = []
+        self._baseline = None
+        self._owns_tracemalloc = False
+        self._report = None
+
+    def start(self):
+        """開始監控 (需要時啟動tracemalloc並記錄基準快照)"""
+        if self.tracemalloc_top and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._owns_tracemalloc = True
+        if tracemalloc.is_tracing():
+            self._baseline = tracemalloc.take_snapshot()
+        self.samples = []
+        self._report = None
+        self.sample(0, force=True)
+
+    def sample(self, frame_idx, force=False):
+        """每sample_interval幀取樣一次，回傳取樣或None"""
+        if not force and frame_idx % self.sample_interval:
+            return None
+        sample = memory_sample()
+        sample['frame'] = frame_idx
+        self.samples.append(sample)
+        return sample
+
+    def top_allocators(self):
+        """相對於基準快照增長最多的Python配置位置"""
+        if self._baseline is None or not tracemalloc.is_tracing():
+            return []
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")
+        ])
+        stats = snapshot.compare_to(self._baseline, 'lineno')
+        return [{
+            'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            'size_diff_kb': round(stat.size_diff / 1024, 1),
+            'count_diff': stat.count_diff
+        } for stat in stats[:self.tracemalloc_top]]
+
+    def check(self):
+        """檢查各項記憶體取樣是否逐幀單調增長"""
+        growth = {}
+        for key in self.SERIES:
+            values = [sample[key] for sample in self.samples if key in sample]
+            result = detect_growth(values, self.growth_threshold_mb)
+            if result is not None:
+                growth[key] = result
+        return growth
+
+    def stop(self, frame_idx=None):
+        """結束監控，回傳報告 (取樣、增長檢查和增長最多的配置位置)"""
+        if self._report is not None:
+            return self._report
+        if frame_idx is not None:
+            self.sample(frame_idx, force=True)
+        self._report = {
+            'samples': self.samples,
+            'growth': self.check(),
+            'top_allocators': self.top_allocators()
+        }
+        self._baseline = None
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+            self._owns_tracemalloc = False
+        return self._report
+
+    @staticmethod
+    def format(report):
+        """把報告整理為可列印的文字"""
+        lines = []
+        if report['samples']:
+            first, last = report['samples'][0], report['samples'][-1]
+            lines.append(f"RSS: {first['rss_mb']:.1f} -> {last['rss_mb']:.1f} MB ({len(report['samples'])} 個取樣)")
+            if 'torch_allocated_mb' in last:
+                lines.append(f"torch已配置: {first['torch_allocated_mb']:.1f} -> {last['torch_allocated_mb']:.1f} MB, "
+                             f"保留: {last['torch_reserved_mb']:.1f} MB")
+        for key, result in report['growth'].items():
+            if result['leak']:
+                lines.append(f"疑似記憶體洩漏: {key} 逐幀持續增長 {result['growth_mb']:.1f} MB")
+        for item in report['top_allocators'][:5]:
+            lines.append(f"  {item['location']}: {item['size_diff_kb']:+.1f} KB ({item['count_diff']:+d} 個物件)")
+        return "\n".join(lines)
+
+
+class SessionHistory:
+    """記錄每次追蹤結束 (釋放資源並回收垃圾) 後的記憶體，檢查跨多次追蹤的增長"""
+
+    def __init__(self, growth_threshold_mb=DEFAULT_MEMORY_CONFIG["growth_threshold_mb"]):
+        self.growth_threshold_mb = growth_threshold_mb
+        self.sessions = []
+
+    def record(self):
+        """回收垃圾後記錄一次追蹤結束時的記憶體"""
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        sample = memory_sample()
+        self.sessions.append(sample)
+        return sample
+
+    def check(self):
+        """檢查跨追蹤的單調增長 (第一次追蹤包含模型載入，不計入)"""
+        growth = {}
+        for key in ('rss_mb', 'torch_allocated_mb'):
+            values = [sample[key] for sample in self.sessions if key in sample]
+            result = detect_growth(values, self.growth_threshold_mb, min_samples=2)
+            if result is not None:
+                growth[key] = result
+        return growth
@@ -0,0 +1,210 @@
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from mask_archive import MaskArchiveWriter, archive_iou
+from memory_monitor import MB, rss_bytes
+
+
+# SAM2模型最佳化的預設配置 (可在sam2_config.json的"optimization"區段覆寫)
+DEFAULT_OPTIMIZATION_CONFIG = {
+    "int8": False,  # 線性層 (含注意力的qkv/投影層) 動態int8量化，僅限CPU
+    "bf16": False,  # 以bfloat16 autocast執行圖像編碼器
+    "compile": False,  # 以torch.compile編譯圖像編碼器
+    "compile_mode": "default"  # torch.compile的mode ("default"、"reduce-overhead"、"max-autotune")
+}
+
+
+def enabled_modes(config):
+    """回傳啟用的最佳化名稱列表"""
+    return [name for name in ("int8", "bf16", "compile") if config.get(name)]
+
+
+def mode_config(mode):
+    """把 "int8+compile" 這類模式名稱轉為最佳化配置，"baseline" 表示全部關閉"""
+    config = dict(DEFAULT_OPTIMIZATION_CONFIG)
+    for name in mode.split('+'):
+        if name == "baseline":
+            continue
+        if name not in ("int8", "bf16", "compile"):
+            raise ValueError(f"未知的最佳化模式: {name}")
+        config[name] = True
+    return config
+
+
+def to_float32(output):
+    """把巢狀輸出中的浮點張量轉回float32"""
+    if isinstance(output, torch.Tensor):
+        return output.float() if output.is_floating_point() else output
+    if isinstance(output, dict):
+        return {key: to_float32(value) for key, value in output.items()}
+    if isinstance(output, (list, tuple)):
+        return type(output)(to_float32(value) for value in output)
+    return output
+
+
+class AutocastModule(torch.nn.Module):
+    """在autocast下執行子模組，輸出轉回float32
+
+    SAM2的記憶注意力和mask解碼器在autocast下會遇到混合精度的運算錯誤，
+    因此只對計算量最大的圖像編碼器使用bfloat16，其餘部分維持float32。
+    """
+
+    def __init__(self, module, device_type, dtype=torch.bfloat16):
+        super().__init__()
+        self.module = module
+        self.device_type = device_type
+        self.dtype = dtype
+
+    def forward(self, *args, **kwargs):
+        with torch.autocast(device_type=self.device_type, dtype=self.dtype):
+            return to_float32(self.module(*args, **kwargs))
+
+
+def apply_optimizations(model, config, device):
+    """依配置對已載入的SAM2模型套用量化、bf16和編譯，回傳實際套用的最佳化名稱"""
+    applied = []
+    if config.get("int8"):
+        if device.type != "cpu":
+            print("int8動態量化只支援CPU，已略過")
+        else:
+            # SAM2的注意力層由nn.Linear組成，量化Linear即涵蓋注意力的qkv和輸出投影
+            torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+            applied.append("int8")
+    if config.get("bf16"):
+        if "int8" in applied:
+            # 動態量化的Linear只接受float32輸入
+            print("int8量化的模型不支援bf16，已略過bf16")
+        else:
+            model.image_encoder = AutocastModule(model.image_encoder, device.type)
+            applied.append("bf16")
+    if config.get("compile"):
+        # 圖像編碼器佔每幀大部分的計算量，只編譯這一部分以避免記憶模組的動態控制流
+        model.image_encoder = torch.compile(model.image_encoder, mode=config.get("compile_mode") or "default")
+        applied.append("compile")
+    return applied
+
+
+def run_mode(video_path, boxes, overrides, config, frames, archive_path):
+    """在獨立行程中以指定最佳化追蹤固定片段，回傳延遲和記憶體統計"""
+    from sam2_engine import SAM2FrameEngine
+    from video_source import PrefetchFrameReader
+
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    base_rss = rss_bytes()
+    peak_rss = base_rss
+
+    engine = SAM2FrameEngine(overrides, num_frames=frames, source_name=video_path, optimization=config)
+    engine.add_objects(boxes, frame_idx=0)
+    latencies = []
+    writer = None
+    for frame_idx, frame in PrefetchFrameReader(video_path, end=frames):
+        start = time.perf_counter()
+        result = engine.step(frame, frame_idx)
+        latencies.append(time.perf_counter() - start)
+        peak_rss = max(peak_rss, rss_bytes())
+        if writer is None:
+            writer = MaskArchiveWriter(archive_path, *result.label_map.shape, obj_ids=result.obj_ids,
+                                       dtype=result.label_map.dtype)
+        writer.write(result.frame_idx, result.label_map)
+    if writer is not None:
+        writer.close()
+    applied = engine.applied_optimizations
+    engine.close()
+
+    # 第一幀包含模型載入 (以及torch.compile的編譯)，不計入穩定延遲
+    steady = np.asarray(latencies[1:] or latencies) * 1e3
+    stats = {
+        'applied': applied,
+        'frames': len(latencies),
+        'first_frame_ms': round(latencies[0] * 1e3, 2) if latencies else 0.0,
+        'latency_mean_ms': round(float(steady.mean()), 2) if len(steady) else 0.0,
+        'latency_p90_ms': round(float(np.percentile(steady, 90)), 2) if len(steady) else 0.0,
+        'peak_rss_mb': round(peak_rss / MB, 1),
+        'rss_growth_mb': round((peak_rss - base_rss) / MB, 1)
+    }
+    if torch.cuda.is_available():
+        stats['peak_cuda_mb'] = round(torch.cuda.max_memory_allocated() / MB, 1)
+    return stats
+
+
+def compare_modes(video_path, boxes, overrides, modes, frames, min_iou):
+    """依序 (各自在獨立行程中) 執行每個模式，並以baseline的mask計算IoU"""
+    if "baseline" in modes:
+        modes = ["baseline"] + [mode for mode in modes if mode != "baseline"]
+    else:
+        modes = ["baseline"] + list(modes)
+
+    context = multiprocessing.get_context("spawn")
+    report = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for mode in modes:
+            archive_path = os.path.join(tmp_dir, mode.replace('+', '_'))
+            print(f"執行模式: {mode}")
+            with context.Pool(1) as pool:
+                try:
+                    stats = pool.apply(run_mode, (video_path, boxes, overrides, mode_config(mode), frames, archive_path))
+                except Exception as e:
+                    print(f"模式 {mode} 執行失敗: {e}")
+                    report[mode] = {'error': str(e)}
+                    continue
+            baseline_archive = os.path.join(tmp_dir, "baseline")
+            stats['mean_iou'] = 1.0 if mode == "baseline" else round(archive_iou(baseline_archive, archive_path), 4)
+            report[mode] = stats
+
+    # 在符合IoU門檻的模式中選出穩定延遲最低者
+    candidates = [(stats['latency_mean_ms'], mode) for mode, stats in report.items()
+                  if 'error' not in stats and stats['mean_iou'] >= min_iou]
+    recommended = min(candidates)[1] if candidates else "baseline"
+    return report, recommended
+
+
+def main():
+    """比較SAM2各最佳化模式在固定片段上的延遲、峰值記憶體和mask IoU"""
+    parser = argparse.ArgumentParser(description="SAM2量化/編譯模式比較")
+    parser.add_argument("video", help="固定測試片段 (視頻或影像序列目錄)")
+    parser.add_argument("--box", action="append", default=[], help='框提示 "x1,y1,x2,y2" (可重複)')
+    parser.add_argument("--modes", nargs="+", default=["baseline", "int8", "bf16", "compile", "bf16+compile"],
+                        help="要比較的模式 (可用+組合)")
+    parser.add_argument("--frames", type=int, default=60, help="使用片段的前N幀")
+    parser.add_argument("--min-iou", type=float, default=0.9, help="與baseline相比可接受的最低平均IoU")
+    parser.add_argument("--model", default="./models/sam2.1_t.pt", help="SAM2模型路徑")
+    parser.add_argument("--device", default="cpu", help="裝置")
+    parser.add_argument("--imgsz", type=int, default=1024, help="輸入尺寸")
+    parser.add_argument("--output", default="./output", help="報告輸出目錄")
+    args = parser.parse_args()
+
+    boxes = [[int(float(v)) for v in box.split(',')[:4]] for box in args.box]
+    if not boxes:
+        print("請以 --box 指定至少一個框提示")
+        return
+
+    overrides = dict(conf=0.25, device=args.device, task="segment", mode="predict", imgsz=args.imgsz, model=args.model)
+    report, recommended = compare_modes(args.video, boxes, overrides, args.modes, args.frames, args.min_iou)
+
+    print(f"{'模式':<14} | {'平均 ms/幀':>10} | {'p90 ms':>8} | {'首幀 ms':>9} | {'峰值RSS MB':>10} | {'平均IoU':>7}")
+    for mode, stats in report.items():
+        if 'error' in stats:
+            print(f"{mode:<14} | 失敗: {stats['error']}")
+            continue
+        print(f"{mode:<14} | {stats['latency_mean_ms']:>10.1f} | {stats['latency_p90_ms']:>8.1f} | "
+              f"{stats['first_frame_ms']:>9.1f} | {stats['peak_rss_mb']:>10.1f} | {stats['mean_iou']:>7.4f}")
+    print(f"符合IoU門檻 ({args.min_iou}) 的最快模式: {recommended}")
+
+    os.makedirs(args.output, exist_ok=True)
+    report_path = os.path.join(args.output, f"optimization_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump({'modes': report, 'recommended': recommended, 'min_iou': args.min_iou}, f,
+                  ensure_ascii=False, indent=2)
+    print(f"報告已儲存: {report_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import copy
+
+import cv2
+import numpy as np
+
+
+# 靜止幀略過推論的預設配置 (可在sam2_config.json的"motion_gate"區段覆寫)
+DEFAULT_MOTION_GATE_CONFIG = {
+    "enabled": False,
+    "size": 96,  # 變化偵測使用的縮小畫面長邊 (像素)
+    "pixel_threshold": 12,  # 灰階差超過此值的像素視為有變化
+    "changed_ratio": 0.005,  # 追蹤區域內有變化的像素比例超過此值才執行推論
+    "margin": 4,  # 追蹤區域向外擴張的像素數 (縮小畫面上)，涵蓋物件邊緣的移動
+    "refresh_interval": 15  # 連續沿用mask達到此幀數時強制推論一次
+}
+
+
+class MotionGate:
+    """以縮小畫面的幀差判斷是否需要執行SAM2推論
+
+    只比較追蹤中物件所在區域 (前一次推論的標籤圖，向外擴張margin) 與上一個推論幀的差異；
+    所有物件都消失時比較整個畫面。差異小於閾值時沿用前一幀的mask。
+    """
+
+    def __init__(self, size=DEFAULT_MOTION_GATE_CONFIG["size"],
+                 pixel_threshold=DEFAULT_MOTION_GATE_CONFIG["pixel_threshold"],
+                 changed_ratio=DEFAULT_MOTION_GATE_CONFIG["changed_ratio"],
+                 margin=DEFAULT_MOTION_GATE_CONFIG["margin"],
+                 refresh_interval=DEFAULT_MOTION_GATE_CONFIG["refresh_interval"]):
+        self.size = size
+        self.pixel_threshold = pixel_threshold
+        self.changed_ratio = changed_ratio
+        self.margin = margin
+        self.refresh_interval = refresh_interval
+        self._current = None  # 目前幀的縮小灰階畫面
+        self._reference = None  # 上一個推論幀的縮小灰階畫面
+        self._region = None  # 縮小畫面上的追蹤區域
+        self._reused = 0  # 連續沿用的幀數
+
+        # 每幀的決策記錄
+        self.inferred_frames = []
+        self.reused_frames = []
+        self.last_ratio = None
+
+    def _small(self, frame):
+        h, w = frame.shape[:2]
+        scale = self.size / max(h, w)
+        size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+        small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+
+    def should_infer(self, frame):
+        """判斷這一幀是否需要推論 (沒有參考幀或達到強制刷新間隔時一定推論)"""
+        self._current = self._small(frame)
+        if self._reference is None or self._reused >= self.refresh_interval:
+            self.last_ratio = None
+            return True
+        changed = cv2.absdiff(self._current, self._reference) > self.pixel_threshold
+        if self._region is not None:
+            area = int(np.count_nonzero(self._region))
+            self.last_ratio = np.count_nonzero(changed & self._region) / area
+        else:
+            self.last_ratio = float(changed.mean())
+        return self.last_ratio > self.changed_ratio
+
+    def record(self, frame_idx, result):
+        """記錄決策；推論幀成為新的參考幀，並以其標籤圖更新追蹤區域"""
+        if not result.inferred:
+            self._reused += 1
+            self.reused_frames.append(frame_idx)
+            return
+        self._reused = 0
+        self.inferred_frames.append(frame_idx)
+        self._reference = self._current
+        height, width = self._reference.shape
+        # 模型解析度的標籤圖已足夠縮小到參考幀尺寸，不需建立原始尺寸的標籤圖
+        region = cv2.resize(result.low_res_label_map, (width, height), interpolation=cv2.INTER_NEAREST) > 0
+        if region.any():
+            if self.margin > 0:
+                kernel = np.ones((2 * self.margin + 1, 2 * self.margin + 1), dtype=np.uint8)
+                region = cv2.dilate(region.astype(np.uint8), kernel) > 0
+            self._region = region
+        else:
+            self._region = None
+
+    def summary(self):
+        """推論/沿用的幀數統計和逐幀記錄"""
+        total = len(self.inferred_frames) + len(self.reused_frames)
+        return {
+            'frames': total,
+            'inferred': len(self.inferred_frames),
+            'reused': len(self.reused_frames),
+            'reuse_ratio': round(len(self.reused_frames) / total, 4) if total else 0.0,
+            'inferred_frames': self.inferred_frames,
+            'reused_frames': self.reused_frames
+        }
+
+    def format(self):
+        summary = self.summary()
+        return (f"動態閘門: 推論 {summary['inferred']} 幀, 沿用 {summary['reused']} 幀 "
+                f"({summary['reuse_ratio'] * 100:.1f}%)")
+
+
+def gated_track(engine, frames, gate):
+    """與engine.track相同，但靜止的幀沿用前一幀的mask而不執行推論
+
+    沿用的幀產生inferred=False的結果 (logits和標籤圖與前一幀相同)。有新加入但尚未
+    開始追蹤的物件時一定推論。
+    """
+    previous = None
+    for item in frames:
+        frame_idx, frame = item[0], item[1]
+        pending_objects = any(not group.started and group.start_frame <= frame_idx for group in engine.groups)
+        # should_infer放在前面，確保每一幀都計算縮小畫面 (推論幀會成為新的參考幀)
+        if gate.should_infer(frame) or previous is None or pending_objects:
+            result = engine.step(frame, frame_idx)
+        else:
+            # 淺複製保留結果的類型和已計算的masks/boxes (畫面尺寸相同)
+            result = copy.copy(previous)
+            result.frame_idx = frame_idx
+            result.orig_img = frame
+            result.capture_time = None
+            result.inferred = False
+        if len(item) > 2:
+            result.capture_time = item[2]
+        gate.record(frame_idx, result)
+        previous = result
+        yield result
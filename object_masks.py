@@ -0,0 +1,244 @@
+import argparse
+import time
+
+import numpy as np
+
+
+class CroppedMask:
+    """以框偏移加上位元壓縮的裁切區域儲存的單一物件mask
+
+    只保存物件外接框內的mask (每列以np.packbits壓縮為1位元/像素) 和框在畫面中的位置，
+    面積、質心、IoU、混合和匯出都只處理框內的像素，記憶體和運算量與物件面積成正比，
+    與畫面尺寸無關。
+    """
+
+    def __init__(self, box, bits, shape, area):
+        self.box = tuple(int(v) for v in box)  # 畫面座標的 (x1, y1, x2, y2)
+        self.bits = bits  # (高, ceil(寬/8)) 的uint8位元陣列
+        self.shape = tuple(shape[:2])  # 畫面的 (H, W)
+        self.area = int(area)
+
+    @classmethod
+    def from_crop(cls, crop, x1, y1, shape):
+        """由框內的bool陣列建立 (框左上角為 (x1, y1))"""
+        h, w = crop.shape
+        return cls((x1, y1, x1 + w, y1 + h), np.packbits(crop, axis=1), shape, np.count_nonzero(crop))
+
+    @classmethod
+    def from_mask(cls, mask):
+        """由原始尺寸的bool mask建立 (空mask的框為 (0, 0, 0, 0))"""
+        rows = np.flatnonzero(mask.any(axis=1))
+        if len(rows) == 0:
+            return cls((0, 0, 0, 0), np.zeros((0, 0), dtype=np.uint8), mask.shape, 0)
+        cols = np.flatnonzero(mask.any(axis=0))
+        y1, y2, x1, x2 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+        return cls.from_crop(mask[y1:y2, x1:x2], x1, y1, mask.shape)
+
+    @property
+    def width(self):
+        return self.box[2] - self.box[0]
+
+    @property
+    def height(self):
+        return self.box[3] - self.box[1]
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def crop(self):
+        """解壓縮框內的bool陣列 (高, 寬)"""
+        return np.unpackbits(self.bits, axis=1, count=self.width).view(bool)
+
+    def centroid(self):
+        """畫面座標的質心 (x, y)，空mask回傳None"""
+        if self.area == 0:
+            return None
+        ys, xs = np.nonzero(self.crop())
+        return float(xs.mean()) + self.box[0], float(ys.mean()) + self.box[1]
+
+    def region(self, box):
+        """框內的mask在另一個區域 (x1, y1, x2, y2) 中的bool陣列，區域外的部分為False"""
+        x1, y1, x2, y2 = box
+        out = np.zeros((y2 - y1, x2 - x1), dtype=bool)
+        ix1, iy1 = max(x1, self.box[0]), max(y1, self.box[1])
+        ix2, iy2 = min(x2, self.box[2]), min(y2, self.box[3])
+        if ix1 < ix2 and iy1 < iy2:
+            out[iy1 - y1:iy2 - y1, ix1 - x1:ix2 - x1] = \
+                self.crop()[iy1 - self.box[1]:iy2 - self.box[1], ix1 - self.box[0]:ix2 - self.box[0]]
+        return out
+
+    def intersection(self, other):
+        """與另一個mask的交集像素數 (只解壓縮兩個框重疊的部分)"""
+        x1, y1 = max(self.box[0], other.box[0]), max(self.box[1], other.box[1])
+        x2, y2 = min(self.box[2], other.box[2]), min(self.box[3], other.box[3])
+        if x1 >= x2 or y1 >= y2:
+            return 0
+        return int(np.count_nonzero(self.region((x1, y1, x2, y2)) & other.region((x1, y1, x2, y2))))
+
+    def iou(self, other):
+        inter = self.intersection(other)
+        union = self.area + other.area - inter
+        return inter / union if union else 0.0
+
+    def blend(self, image, color, alpha):
+        """以透明度把顏色混合到image (原地修改) 的mask像素上，只處理框內的區域"""
+        x1, y1, x2, y2 = self.box
+        region = image[y1:y2, x1:x2]
+        mask = self.crop()
+        region[mask] = (region[mask] * (1 - alpha) + np.asarray(color, dtype=np.float32) * alpha).astype(np.uint8)
+        return image
+
+    def paint(self, label_map, label):
+        """把label寫入label_map (原地修改) 的mask像素"""
+        x1, y1, x2, y2 = self.box
+        label_map[y1:y2, x1:x2][self.crop()] = label
+        return label_map
+
+    def to_mask(self):
+        """匯出為原始尺寸的bool mask"""
+        mask = np.zeros(self.shape, dtype=bool)
+        x1, y1, x2, y2 = self.box
+        mask[y1:y2, x1:x2] = self.crop()
+        return mask
+
+
+def masks_from_label_map(label_map, num_labels):
+    """由標籤圖建立每個標籤 (1..num_labels) 的CroppedMask，不存在的標籤為None
+
+    所有標籤的外接框由前景像素一次計算，每個物件只在自己的框內比對標籤。
+    """
+    masks = [None] * num_labels
+    ys, xs = np.nonzero(label_map)
+    if len(ys) == 0:
+        return masks
+    labels = label_map[ys, xs].astype(np.int64)
+    valid = (labels >= 1) & (labels <= num_labels)
+    ys, xs, labels = ys[valid], xs[valid], labels[valid]
+    x1 = np.full(num_labels + 1, label_map.shape[1])
+    y1 = np.full(num_labels + 1, label_map.shape[0])
+    x2 = np.zeros(num_labels + 1, dtype=np.int64)
+    y2 = np.zeros(num_labels + 1, dtype=np.int64)
+    np.minimum.at(x1, labels, xs)
+    np.minimum.at(y1, labels, ys)
+    np.maximum.at(x2, labels, xs + 1)
+    np.maximum.at(y2, labels, ys + 1)
+    for label in np.unique(labels):
+        crop = label_map[y1[label]:y2[label], x1[label]:x2[label]] == label
+        masks[label - 1] = CroppedMask.from_crop(crop, x1[label], y1[label], label_map.shape)
+    return masks
+
+
+def masks_to_label_map(masks, shape, dtype=np.uint8):
+    """把CroppedMask列表 (第i個為標籤i+1，None略過) 匯出為標籤圖，後面的mask覆蓋前面的"""
+    label_map = np.zeros(shape[:2], dtype=dtype)
+    for label, mask in enumerate(masks, start=1):
+        if mask is not None:
+            mask.paint(label_map, label)
+    return label_map
+
+
+def composite_masks(image, masks, colors, alphas):
+    """依查找表 (索引0為背景，i+1為masks[i]) 把所有mask混合到image上 (原地修改)，只處理各物件的框內像素"""
+    for label, mask in enumerate(masks, start=1):
+        if mask is not None:
+            mask.blend(image, colors[label], alphas[label])
+    return image
+
+
+def paired_regions(mask_a, mask_b, margin=0):
+    """兩個mask (可為None) 在共同區域 (兩個框的聯集向外擴張margin並限制在畫面內) 的bool陣列
+
+    用於需要鄰域的比較 (例如邊界F值)，兩者都為None時回傳None。
+    """
+    present = [mask for mask in (mask_a, mask_b) if mask is not None]
+    if not present:
+        return None
+    height, width = present[0].shape
+    box = (max(0, min(mask.box[0] for mask in present) - margin),
+           max(0, min(mask.box[1] for mask in present) - margin),
+           min(width, max(mask.box[2] for mask in present) + margin),
+           min(height, max(mask.box[3] for mask in present) + margin))
+    empty = np.zeros((box[3] - box[1], box[2] - box[0]), dtype=bool)
+    return (mask_a.region(box) if mask_a is not None else empty,
+            mask_b.region(box) if mask_b is not None else empty)
+
+
+def benchmark(num_objects, height, width, object_size=24, frames=5, seed=0):
+    """比較原始尺寸的逐物件float mask與CroppedMask的記憶體、混合和IoU時間"""
+    rng = np.random.default_rng(seed)
+    image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    label_map = np.zeros((height, width), dtype=np.uint8 if num_objects < 255 else np.int32)
+    for label in range(1, num_objects + 1):
+        x = rng.integers(0, width - object_size)
+        y = rng.integers(0, height - object_size)
+        label_map[y:y + object_size, x:x + object_size] = label
+    colors = rng.integers(0, 256, (num_objects + 1, 3)).astype(np.float32)
+    alphas = np.full(num_objects + 1, 0.5, dtype=np.float32)
+
+    # 舊表示: 每個物件一張原始尺寸的float mask，混合時每個物件都處理整個畫面
+    full = [(label_map == label).astype(np.float32) for label in range(1, num_objects + 1)]
+    start = time.perf_counter()
+    for _ in range(frames):
+        out = image.copy()
+        for label, mask in enumerate(full, start=1):
+            weight = mask[..., None] * alphas[label]
+            out = (out * (1 - weight) + colors[label] * weight).astype(np.uint8)
+    full_composite_ms = (time.perf_counter() - start) * 1e3 / frames
+    start = time.perf_counter()
+    for _ in range(frames):
+        for mask in full:
+            np.logical_and(mask > 0, mask > 0).sum() / np.logical_or(mask > 0, mask > 0).sum()
+    full_iou_ms = (time.perf_counter() - start) * 1e3 / frames
+    full_bytes = sum(mask.nbytes for mask in full)
+    del full
+
+    start = time.perf_counter()
+    for _ in range(frames):
+        cropped = masks_from_label_map(label_map, num_objects)
+    build_ms = (time.perf_counter() - start) * 1e3 / frames
+    start = time.perf_counter()
+    for _ in range(frames):
+        composite_masks(image.copy(), cropped, colors, alphas)
+    cropped_composite_ms = (time.perf_counter() - start) * 1e3 / frames
+    start = time.perf_counter()
+    for _ in range(frames):
+        for mask in cropped:
+            if mask is not None:
+                mask.iou(mask)
+    cropped_iou_ms = (time.perf_counter() - start) * 1e3 / frames
+
+    return {
+        'objects': num_objects,
+        'full_mb': full_bytes / 2 ** 20,
+        'cropped_kb': sum(mask.nbytes for mask in cropped if mask is not None) / 1024,
+        'full_composite_ms': full_composite_ms,
+        'cropped_composite_ms': cropped_composite_ms,
+        'full_iou_ms': full_iou_ms,
+        'cropped_iou_ms': cropped_iou_ms,
+        'build_ms': build_ms
+    }
+
+
+def main():
+    """報告不同物件數量時逐物件mask的記憶體、混合和IoU時間"""
+    parser = argparse.ArgumentParser(description="裁切位元壓縮mask的基準測試")
+    parser.add_argument("--objects", type=int, nargs="+", default=[10, 50, 200], help="物件數量")
+    parser.add_argument("--height", type=int, default=1080, help="幀高度")
+    parser.add_argument("--width", type=int, default=1920, help="幀寬度")
+    parser.add_argument("--size", type=int, default=24, help="物件邊長 (像素)")
+    parser.add_argument("--frames", type=int, default=3, help="每組測試的幀數")
+    args = parser.parse_args()
+
+    print(f"幀尺寸: {args.width}x{args.height}, 物件邊長: {args.size}")
+    print(f"{'物件數':>6} | {'原始 MB':>8} | {'裁切 KB':>8} | {'原始混合 ms':>11} | {'裁切混合 ms':>11} | "
+          f"{'原始IoU ms':>10} | {'裁切IoU ms':>10} | {'建立 ms':>8}")
+    for num_objects in args.objects:
+        r = benchmark(num_objects, args.height, args.width, args.size, args.frames)
+        print(f"{r['objects']:>6} | {r['full_mb']:>8.1f} | {r['cropped_kb']:>8.1f} | {r['full_composite_ms']:>11.1f} | "
+              f"{r['cropped_composite_ms']:>11.2f} | {r['full_iou_ms']:>10.1f} | {r['cropped_iou_ms']:>10.2f} | "
+              f"{r['build_ms']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
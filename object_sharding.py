@@ -0,0 +1,440 @@
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+import types
+from multiprocessing import shared_memory
+
+import numpy as np
+import torch
+from ultralytics.engine.results import Masks
+
+from mask_archive import MaskArchiveWriter, archive_iou
+from sam2_engine import FrameResult, SAM2FrameEngine
+
+
+# 物件分組平行追蹤的預設配置 (可在sam2_config.json的"object_sharding"區段覆寫)
+DEFAULT_OBJECT_SHARDING_CONFIG = {
+    "workers": 0,  # 分組追蹤的工作行程數量，0或1表示所有物件在同一個行程中追蹤
+    "min_objects": 8  # 提示數量達到此值才分組 (物件少時分組只會增加圖像編碼的次數)
+}
+
+
+def use_object_sharding(config, num_objects):
+    """依配置和提示數量判斷是否使用物件分組"""
+    return config.get('workers', 0) > 1 and num_objects >= config.get('min_objects', 0)
+
+
+class MergedFrameResult(FrameResult):
+    """由各工作行程的標籤圖合併而成的結果
+
+    沒有logits，masks和boxes在被存取時由標籤圖計算 (第i個mask對應obj_ids[i])。
+    """
+
+    def __init__(self, frame_idx, orig_img, obj_ids, label_map):
+        super().__init__(frame_idx, orig_img, None, obj_ids, label_map)
+
+    @property
+    def masks(self):
+        if self._masks is None and self.obj_ids:
+            labels = torch.arange(1, len(self.obj_ids) + 1, dtype=torch.int32)
+            label_map = torch.from_numpy(self.label_map.astype(np.int32, copy=False))
+            self._masks = Masks(label_map[None] == labels[:, None, None], self.orig_img.shape[:2])
+        return self._masks
+
+
+def _write_output(engine, result, labels, scores):
+    """把局部標籤圖和每個像素勝出的logit寫入共享記憶體"""
+    labels[...] = result.label_map
+    if engine.reducer.scores is not None:
+        scores[...] = engine.reducer.scores.float().cpu().numpy()
+
+
+def _object_worker(conn, overrides, num_frames, source_name, optimization, num_threads):
+    """工作行程: 以自己的SAM2FrameEngine追蹤分配到的物件，結果寫入共享記憶體
+
+    指令經由Pipe傳入 (指令, 參數)，每個指令回覆 ('ok', 結果) 或 ('error', 訊息)。
+    """
+    torch.set_num_threads(num_threads)
+    engine = SAM2FrameEngine(overrides, num_frames=num_frames, source_name=source_name, optimization=optimization)
+    engine.reducer.keep_scores = True
+    buffers = []
+    frame = labels = scores = None
+    last = None
+    try:
+        while True:
+            command, args = conn.recv()
+            if command == 'close':
+                break
+            try:
+                if command == 'attach':
+                    names, shape = args
+                    frame = labels = scores = None
+                    for buffer in buffers:
+                        buffer.close()
+                    buffers = [shared_memory.SharedMemory(name=name) for name in names]
+                    frame = np.ndarray(shape + (3,), dtype=np.uint8, buffer=buffers[0].buf)
+                    labels = np.ndarray(shape, dtype=np.int32, buffer=buffers[1].buf)
+                    scores = np.ndarray(shape, dtype=np.float32, buffer=buffers[2].buf)
+                    reply = None
+                elif command == 'add':
+                    reply = engine.add_objects(*args)
+                elif command == 'step':
+                    # 共享的幀緩衝區在下一幀會被覆寫，結果 (修正時需要) 保留自己的副本
+                    last = engine.step(frame.copy(), args)
+                    _write_output(engine, last, labels, scores)
+                    reply = last.obj_ids
+                elif command == 'correct':
+                    last, new_ids = engine.correct(last, *args)
+                    _write_output(engine, last, labels, scores)
+                    reply = (new_ids, last.obj_ids)
+                else:
+                    raise ValueError(f"未知的指令: {command}")
+                conn.send(('ok', reply))
+            except Exception as e:
+                conn.send(('error', f"{type(e).__name__}: {e}"))
+    finally:
+        engine.close()
+        frame = labels = scores = None
+        for buffer in buffers:
+            buffer.close()
+
+
+class ObjectShardedEngine:
+    """把物件分組到多個工作行程追蹤的引擎 (介面與SAM2FrameEngine相同)
+
+    每一幀只由主行程解碼並寫入共享記憶體一次，所有工作行程讀取同一幀，以各自的
+    SAM2FrameEngine追蹤分配到的物件，每個行程的記憶和mask後處理只涵蓋自己的物件。
+    新物件分配給目前物件最少的行程 (相同時取編號小的行程)。各行程的局部標籤圖依固定的
+    重疊規則合併: 每個像素取logit最高的物件，logit相同時物件編號小者優先，與行程數量
+    和分組方式無關。物件編號與單一引擎相同 (依加入順序連續分配)。
+    """
+
+    def __init__(self, overrides, workers, num_frames=None, source_name="frames", optimization=None,
+                 num_threads=None):
+        self.num_frames = num_frames
+        self.source_name = source_name
+        self.workers = workers
+        num_threads = num_threads or max(1, (os.cpu_count() or 1) // workers)
+        context = multiprocessing.get_context("spawn")
+        self._conns = []
+        self._processes = []
+        for _ in range(workers):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=_object_worker, daemon=True,
+                                      args=(child_conn, dict(overrides), num_frames, source_name,
+                                            optimization, num_threads))
+            process.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._processes.append(process)
+
+        self.groups = []  # 每批加入的物件 (obj_ids, start_frame, started)，供gated_track判斷新物件
+        self.next_obj_id = 0
+        self.retired = set()
+        self.state_frames = 0
+        self._owner = {}  # 全域物件編號 -> (行程, 局部編號)
+        self._global_ids = [{} for _ in range(workers)]  # 各行程的局部編號 -> 全域物件編號
+        self._load = [0] * workers  # 各行程追蹤中的物件數量
+        self._local_obj_ids = [[] for _ in range(workers)]  # 各行程最後一幀的局部obj_ids
+        self._shape = None
+        self._buffers = []
+        self._frame = None
+        self._labels = []
+        self._scores = []
+
+        # 統計
+        self.frames = 0
+        self.track_seconds = 0.0  # 等待所有行程完成追蹤的時間
+        self.merge_seconds = 0.0
+
+    @property
+    def num_objects(self):
+        return self.next_obj_id
+
+    def _send(self, worker, command, args=None):
+        self._conns[worker].send((command, args))
+
+    def _receive(self, workers):
+        """依序接收多個行程的回覆，全部接收後才拋出錯誤 (避免Pipe中殘留未讀的回覆)"""
+        replies = []
+        error = None
+        for worker in workers:
+            try:
+                status, reply = self._conns[worker].recv()
+            except (EOFError, OSError):
+                status, reply = 'error', "工作行程已結束"
+            if status == 'error' and error is None:
+                error = f"物件分組工作行程 {worker} 出錯: {reply}"
+            replies.append(reply)
+        if error is not None:
+            raise RuntimeError(error)
+        return replies
+
+    def _call(self, worker, command, args=None):
+        self._send(worker, command, args)
+        return self._receive([worker])[0]
+
+    def _attach(self, shape):
+        """依畫面尺寸配置共享記憶體 (幀、各行程的局部標籤圖和勝出logit)"""
+        if self._shape == shape:
+            return
+        self._release_buffers()
+        h, w = shape
+        self._buffers = [shared_memory.SharedMemory(create=True, size=h * w * 3)]
+        self._frame = np.ndarray((h, w, 3), dtype=np.uint8, buffer=self._buffers[0].buf)
+        for worker in range(self.workers):
+            label_buffer = shared_memory.SharedMemory(create=True, size=h * w * 4)
+            score_buffer = shared_memory.SharedMemory(create=True, size=h * w * 4)
+            self._buffers += [label_buffer, score_buffer]
+            self._labels.append(np.ndarray((h, w), dtype=np.int32, buffer=label_buffer.buf))
+            self._scores.append(np.ndarray((h, w), dtype=np.float32, buffer=score_buffer.buf))
+            self._send(worker, 'attach', ([self._buffers[0].name, label_buffer.name, score_buffer.name], shape))
+        self._receive(range(self.workers))
+        self._shape = shape
+
+    def _release_buffers(self):
+        self._frame = None
+        self._labels = []
+        self._scores = []
+        for buffer in self._buffers:
+            buffer.close()
+            buffer.unlink()
+        self._buffers = []
+        self._shape = None
+
+    def _assign(self, obj_ids, bboxes):
+        """依序把物件分配給目前物件最少的行程，回傳每個行程的 [(全域編號, bbox), ...]"""
+        assignment = [[] for _ in range(self.workers)]
+        for obj_id, bbox in zip(obj_ids, bboxes):
+            worker = min(range(self.workers), key=lambda w: (self._load[w], w))
+            self._load[worker] += 1
+            assignment[worker].append((obj_id, bbox))
+        return assignment
+
+    def _register(self, worker, items, local_ids):
+        for (obj_id, _), local_id in zip(items, local_ids):
+            self._owner[obj_id] = (worker, local_id)
+            self._global_ids[worker][local_id] = obj_id
+
+    def add_objects(self, bboxes, frame_idx=0):
+        """在指定幀加入新的框提示，回傳分配的物件編號"""
+        if len(bboxes) == 0:
+            return []
+        obj_ids = list(range(self.next_obj_id, self.next_obj_id + len(bboxes)))
+        self.next_obj_id += len(bboxes)
+        for worker, items in enumerate(self._assign(obj_ids, bboxes)):
+            if items:
+                local_ids = self._call(worker, 'add', ([bbox for _, bbox in items], frame_idx))
+                self._register(worker, items, local_ids)
+        self.groups.append(types.SimpleNamespace(obj_ids=obj_ids, start_frame=frame_idx, started=False))
+        return obj_ids
+
+    def _merge(self, frame_idx, frame):
+        """依重疊規則合併各行程的局部標籤圖"""
+        start = time.perf_counter()
+        ids_by_worker = [[self._global_ids[worker][local_id] for local_id in local_ids]
+                         for worker, local_ids in enumerate(self._local_obj_ids)]
+        obj_ids = sorted(obj_id for ids in ids_by_worker for obj_id in ids)
+        label_of = {obj_id: i + 1 for i, obj_id in enumerate(obj_ids)}
+        dtype = np.uint8 if len(obj_ids) < 255 else np.int32
+        label_map = np.zeros(frame.shape[:2], dtype=dtype)
+        best = np.full(frame.shape[:2], -np.inf, dtype=np.float32)
+        label_flat = label_map.reshape(-1)
+        best_flat = best.reshape(-1)
+        for worker, ids in enumerate(ids_by_worker):
+            if not ids:
+                continue
+            local = self._labels[worker].reshape(-1)
+            foreground = np.flatnonzero(local)
+            if len(foreground) == 0:
+                continue
+            lut = np.asarray([0] + [label_of[obj_id] for obj_id in ids], dtype=dtype)
+            labels = lut[local[foreground]]
+            scores = self._scores[worker].reshape(-1)[foreground]
+            current = best_flat[foreground]
+            # 標籤依物件編號遞增，logit相同時標籤小者 (物件編號小者) 勝出
+            better = (scores > current) | ((scores == current) & (labels < label_flat[foreground]))
+            selected = foreground[better]
+            label_flat[selected] = labels[better]
+            best_flat[selected] = scores[better]
+        self.merge_seconds += time.perf_counter() - start
+        return MergedFrameResult(frame_idx, frame, obj_ids, label_map)
+
+    def step(self, frame, frame_idx):
+        """把幀寫入共享記憶體，所有行程同時追蹤後合併，回傳FrameResult"""
+        self._attach(frame.shape[:2])
+        start = time.perf_counter()
+        self._frame[...] = frame
+        for worker in range(self.workers):
+            self._send(worker, 'step', frame_idx)
+        self._local_obj_ids = self._receive(range(self.workers))
+        self.track_seconds += time.perf_counter() - start
+        self.state_frames += 1
+        self.frames += 1
+        for group in self.groups:
+            if group.start_frame <= frame_idx:
+                group.started = True
+        return self._merge(frame_idx, frame)
+
+    def correct(self, result, bboxes, replace_ids=()):
+        """在最後處理的一幀上修正提示，回傳 (該幀修正後的FrameResult, 新物件編號)
+
+        被取代的物件由原本的行程停止追蹤，新物件分配給物件最少的行程，只有受影響的行程
+        需要重新處理這一幀。
+        """
+        if self.state_frames == 0:
+            raise RuntimeError("尚未處理任何幀，無法修正")
+        replace_by_worker = [[] for _ in range(self.workers)]
+        for obj_id in replace_ids:
+            if obj_id in self._owner and obj_id not in self.retired:
+                worker, local_id = self._owner[obj_id]
+                replace_by_worker[worker].append(local_id)
+                self._load[worker] -= 1
+                self.retired.add(obj_id)
+
+        new_ids = list(range(self.next_obj_id, self.next_obj_id + len(bboxes)))
+        self.next_obj_id += len(bboxes)
+        assignment = self._assign(new_ids, bboxes)
+        workers = [worker for worker in range(self.workers) if assignment[worker] or replace_by_worker[worker]]
+        for worker in workers:
+            self._send(worker, 'correct', ([bbox for _, bbox in assignment[worker]], replace_by_worker[worker]))
+        for worker, (local_new_ids, local_obj_ids) in zip(workers, self._receive(workers)):
+            self._register(worker, assignment[worker], local_new_ids)
+            self._local_obj_ids[worker] = local_obj_ids
+        if new_ids:
+            self.groups.append(types.SimpleNamespace(obj_ids=new_ids, start_frame=result.frame_idx, started=True))
+
+        corrected = self._merge(result.frame_idx, result.orig_img)
+        corrected.capture_time = result.capture_time
+        return corrected, new_ids
+
+    def track(self, frames):
+        """對 (frame_idx, frame) 或 (frame_idx, frame, capture_time) 疊代器逐幀追蹤，產生FrameResult"""
+        for item in frames:
+            result = self.step(item[1], item[0])
+            if len(item) > 2:
+                result.capture_time = item[2]
+            yield result
+
+    def close(self):
+        """結束所有工作行程並釋放共享記憶體"""
+        for conn, process in zip(self._conns, self._processes):
+            try:
+                conn.send(('close', None))
+            except (BrokenPipeError, OSError):
+                pass
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+            conn.close()
+        self._conns = []
+        self._processes = []
+        self._release_buffers()
+
+    def format(self):
+        """每幀平均的追蹤和合併時間"""
+        if not self.frames:
+            return f"物件分組: {self.workers} 個行程"
+        return (f"物件分組: {self.workers} 個行程, 每幀追蹤 {self.track_seconds / self.frames * 1e3:.1f} ms, "
+                f"合併 {self.merge_seconds / self.frames * 1e3:.2f} ms")
+
+
+def run_benchmark(video_path, boxes, overrides, workers, frames, archive_path, optimization=None):
+    """以指定的行程數量追蹤片段，回傳吞吐量統計 (workers<=1時使用單一SAM2FrameEngine)"""
+    from video_source import PrefetchFrameReader
+
+    start_time = time.perf_counter()
+    if workers > 1:
+        engine = ObjectShardedEngine(overrides, workers, num_frames=frames, source_name=video_path,
+                                     optimization=optimization)
+    else:
+        engine = SAM2FrameEngine(overrides, num_frames=frames, source_name=video_path, optimization=optimization)
+    engine.add_objects(boxes, frame_idx=0)
+    writer = None
+    steady_start = None
+    count = 0
+    try:
+        for result in engine.track(PrefetchFrameReader(video_path, end=frames)):
+            if writer is None:
+                writer = MaskArchiveWriter(archive_path, *result.label_map.shape, obj_ids=result.obj_ids,
+                                           dtype=result.label_map.dtype)
+                # 第一幀包含模型載入，不計入穩定吞吐量
+                steady_start = time.perf_counter()
+            writer.write(result.frame_idx, result.label_map)
+            count += 1
+    finally:
+        if writer is not None:
+            writer.close()
+        engine.close()
+    end_time = time.perf_counter()
+    steady_frames = count - 1
+    return {
+        'workers': max(1, workers),
+        'frames': count,
+        'first_frame_seconds': round(steady_start - start_time, 3) if steady_start else 0.0,
+        'fps': round(steady_frames / (end_time - steady_start), 3) if steady_frames > 0 else 0.0
+    }
+
+
+def main():
+    """比較不同物件數量下單一行程和物件分組的追蹤吞吐量"""
+    from sharded_tracking import sam2_overrides
+    from soak_test import make_synthetic_video
+
+    parser = argparse.ArgumentParser(description="物件分組平行追蹤的吞吐量測試")
+    parser.add_argument("--objects", nargs="+", type=int, default=[4, 16, 32], help="合成片段中的物件數量")
+    parser.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4], help="要比較的行程數量 (1為單一行程)")
+    parser.add_argument("--frames", type=int, default=30, help="合成片段幀數")
+    parser.add_argument("--width", type=int, default=640, help="合成片段寬度")
+    parser.add_argument("--height", type=int, default=480, help="合成片段高度")
+    parser.add_argument("--config", default="./sam2_config.json", help="配置檔案 (最佳化)")
+    parser.add_argument("--model", default="./models/sam2.1_t.pt", help="SAM2模型路徑")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="裝置")
+    parser.add_argument("--imgsz", type=int, default=1024, help="輸入尺寸")
+    parser.add_argument("--output", default="./output", help="報告輸出目錄")
+    args = parser.parse_args()
+
+    optimization = None
+    if os.path.exists(args.config):
+        with open(args.config, 'r', encoding='utf-8') as f:
+            optimization = json.load(f).get('optimization')
+    overrides = sam2_overrides(args.model, args.device, args.imgsz)
+    worker_counts = [1] + sorted(set(w for w in args.workers if w > 1))
+
+    report = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for num_objects in args.objects:
+            video_path = os.path.join(tmp_dir, f"objects_{num_objects}.mp4")
+            boxes = make_synthetic_video(video_path, args.frames, args.width, args.height, num_objects)
+            baseline = None
+            for workers in worker_counts:
+                print(f"物件數量 {num_objects}, 行程數量 {workers}")
+                archive_path = os.path.join(tmp_dir, f"objects_{num_objects}_workers_{workers}")
+                stats = run_benchmark(video_path, boxes, overrides, workers, args.frames, archive_path, optimization)
+                stats['objects'] = num_objects
+                if baseline is None:
+                    # 單一行程為基準，分組結果以IoU確認合併後的mask一致
+                    baseline = dict(stats, archive=archive_path)
+                    stats['mean_iou'] = 1.0
+                else:
+                    stats['mean_iou'] = round(archive_iou(baseline['archive'], archive_path), 4)
+                stats['speedup'] = round(stats['fps'] / baseline['fps'], 2) if baseline['fps'] else 0.0
+                report.append(stats)
+
+    print(f"{'物件數':>6} | {'行程數':>6} | {'FPS':>8} | {'加速':>6} | {'首幀 秒':>8} | {'平均IoU':>7}")
+    for stats in report:
+        print(f"{stats['objects']:>6} | {stats['workers']:>6} | {stats['fps']:>8.2f} | {stats['speedup']:>6.2f} | "
+              f"{stats['first_frame_seconds']:>8.1f} | {stats['mean_iou']:>7.4f}")
+
+    os.makedirs(args.output, exist_ok=True)
+    report_path = os.path.join(args.output, f"object_sharding_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"報告已儲存: {report_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+from label_map import blend_label_map, render_label_map
+from mask_archive import MaskArchive, MaskArchiveWriter
+from sam2_engine import SAM2FrameEngine
+from segmented_writer import open_video_writer
+from sharded_tracking import class_luts, load_style, parse_box, sam2_overrides
+from video_source import PrefetchFrameReader
+
+
+def parse_replacement(text):
+    """解析 "物件編號:x1,y1,x2,y2" 格式的取代框"""
+    obj_id, box = text.split(':', 1)
+    return int(obj_id), [int(float(v)) for v in box.split(',')[:4]]
+
+
+def retrack_from(archive_path, frame_idx, replacements, new_prompts, overrides, output_path,
+                 video_path=None, optimization=None):
+    """從指定幀起以修正的提示重新傳播，輸出拼接後的新mask存檔
+
+    只有被取代和新增的物件需要重新追蹤，且只處理frame_idx之後的幀:
+    frame_idx之前的幀直接複製存檔中已壓縮的資料 (不解壓)；之後的幀以原存檔的標籤圖為基礎，
+    清除被取代的物件後疊上新的追蹤結果 (新結果優先)，其他物件的結果維持不變。
+
+    Args:
+        replacements: {物件編號: bbox}，被取代的物件沿用原編號和類別
+        new_prompts: [{'bbox': [...], 'class': 類別}, ...] 新增的物件
+    """
+    start_time = time.perf_counter()
+    source = MaskArchive(archive_path)
+    try:
+        video_path = video_path or source.meta.get('video')
+        if not video_path:
+            raise ValueError("存檔沒有記錄來源視頻，請以 --video 指定")
+        if frame_idx not in source:
+            raise ValueError(f"存檔中沒有第 {frame_idx} 幀")
+        unknown = [obj_id for obj_id in replacements if obj_id not in source.obj_ids]
+        if unknown:
+            raise ValueError(f"存檔中沒有物件: {unknown}")
+
+        # 新物件編號接在原有編號之後，原有物件的標籤維持不變
+        next_id = max(source.obj_ids, default=-1) + 1
+        new_ids = list(range(next_id, next_id + len(new_prompts)))
+        obj_ids = list(source.obj_ids) + new_ids
+        dtype = source.dtype if len(obj_ids) < np.iinfo(source.dtype).max else np.dtype(np.int32)
+        classes = dict(source.meta.get('classes', {}))
+        for obj_id, prompt in zip(new_ids, new_prompts):
+            classes[str(obj_id)] = prompt.get('class', "Unknown")
+
+        # 重新追蹤的物件: 先取代的物件，再新增的物件 (引擎內標籤i+1對應retrack_ids[i])
+        retrack_ids = list(replacements) + new_ids
+        bboxes = list(replacements.values()) + [prompt['bbox'] for prompt in new_prompts]
+        label_of = {obj_id: i + 1 for i, obj_id in enumerate(obj_ids)}
+        lut = np.asarray([0] + [label_of[obj_id] for obj_id in retrack_ids], dtype=dtype)
+        replaced_labels = [label_of[obj_id] for obj_id in replacements]
+
+        meta = dict(source.meta)
+        meta['classes'] = classes
+        meta['corrections'] = list(meta.get('corrections', [])) + [{
+            'frame': frame_idx,
+            'replaced': list(replacements),
+            'added': new_ids,
+            'source': os.path.abspath(archive_path)
+        }]
+        writer = MaskArchiveWriter(output_path, source.height, source.width, obj_ids=obj_ids, dtype=dtype,
+                                   meta=meta)
+
+        # frame_idx之前的幀直接複製
+        reused = 0
+        for idx in source.frame_indices:
+            if idx >= frame_idx:
+                break
+            if dtype == source.dtype:
+                writer.write_raw(idx, source.read_raw(idx))
+            else:
+                writer.write(idx, source.read(idx))
+            reused += 1
+
+        engine = SAM2FrameEngine(overrides, num_frames=len(source.frame_indices) - reused, source_name=video_path,
+                                 optimization=optimization)
+        engine.add_objects(bboxes, frame_idx=frame_idx)
+        frames = PrefetchFrameReader(video_path, start=frame_idx, max_side=max(source.height, source.width))
+        retracked = 0
+        for result in engine.track(frames):
+            if result.frame_idx in source:
+                label_map = source.read(result.frame_idx).astype(dtype)
+                if replaced_labels:
+                    label_map[np.isin(label_map, replaced_labels)] = 0
+            else:
+                label_map = np.zeros((source.height, source.width), dtype=dtype)
+            # 直接在存檔尺寸建立標籤圖 (幀尺寸不同時不需要先建立原始尺寸再縮放)
+            new_labels = result.label_map_at(label_map.shape)
+            foreground = new_labels > 0
+            label_map[foreground] = lut[new_labels[foreground]]
+            writer.write(result.frame_idx, label_map)
+            retracked += 1
+        engine.close()
+        writer.close()
+    finally:
+        source.close()
+
+    seconds = time.perf_counter() - start_time
+    return {
+        'archive': output_path,
+        'frame': frame_idx,
+        'reused_frames': reused,
+        'retracked_frames': retracked,
+        'retracked_objects': len(retrack_ids),
+        'seconds': round(seconds, 3),
+        'replaced': list(replacements),
+        'added': new_ids
+    }
+
+
+def render_archive(archive_path, video_path, output_dir, timestamp, color_map, alpha_map,
+                   segmented_output_config=None):
+    """由mask存檔和來源視頻重新產生覆蓋視頻和Mask視頻 (不需要推論，依segmented_output配置分段寫入)"""
+    with MaskArchive(archive_path) as archive:
+        classes = [archive.meta.get('classes', {}).get(str(obj_id), "Unknown") for obj_id in archive.obj_ids]
+        colors, alphas = class_luts(classes, color_map, alpha_map)
+        fps = archive.meta.get('fps') or 30
+        size = (archive.width, archive.height)
+        output_path = os.path.join(output_dir, f"tracking_result_{timestamp}.mp4")
+        mask_output_path = os.path.join(output_dir, f"mask_result_{timestamp}.mp4")
+        video_writer = open_video_writer(output_path, fps, size, segmented_output_config)
+        mask_video_writer = open_video_writer(mask_output_path, fps, size, segmented_output_config)
+        background_color = (35, 142, 107)  # 與GUI的Mask視頻相同的背景色 (BGR)
+        composite = None  # 混合結果的緩衝區 (解碼的幀為唯讀，不原地修改)
+        for frame_idx, frame in PrefetchFrameReader(video_path, max_side=max(archive.height, archive.width)):
+            if frame_idx not in archive:
+                continue
+            label_map = archive.read(frame_idx)
+            if composite is None:
+                composite = np.empty_like(frame)
+            video_writer.write(blend_label_map(frame, label_map, colors, alphas, out=composite))
+            mask_video_writer.write(render_label_map(label_map, colors, alphas, background_color))
+        video_writer.release()
+        mask_video_writer.release()
+    # 分段合併後的實際路徑 (沒有ffmpeg時為.ts)
+    return getattr(video_writer, 'path', output_path), getattr(mask_video_writer, 'path', mask_output_path)
+
+
+def main():
+    """在已儲存的追蹤結果上修正某一幀之後的提示，只重新傳播修正的物件和之後的幀"""
+    parser = argparse.ArgumentParser(description="SAM2追蹤結果的提示修正")
+    parser.add_argument("archive", help="mask存檔目錄 (追蹤服務或分段平行追蹤的輸出)")
+    parser.add_argument("--frame", type=int, required=True, help="開始修正的幀編號")
+    parser.add_argument("--replace", action="append", default=[], help='取代物件 "物件編號:x1,y1,x2,y2" (可重複)')
+    parser.add_argument("--box", action="append", default=[], help='新增物件 "x1,y1,x2,y2[,類別]" (可重複)')
+    parser.add_argument("--video", help="來源視頻 (預設使用存檔中記錄的路徑)")
+    parser.add_argument("--config", default="./sam2_config.json", help="配置檔案 (類別顏色和最佳化)")
+    parser.add_argument("--model", default="./models/sam2.1_t.pt", help="SAM2模型路徑")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="裝置")
+    parser.add_argument("--imgsz", type=int, default=1024, help="輸入尺寸")
+    parser.add_argument("--output", default="./output", help="輸出目錄")
+    parser.add_argument("--render", action="store_true", help="由修正後的存檔重新產生覆蓋視頻和Mask視頻")
+    args = parser.parse_args()
+
+    replacements = dict(parse_replacement(text) for text in args.replace)
+    new_prompts = [parse_box(text) for text in args.box]
+    if not replacements and not new_prompts:
+        print("請以 --replace 或 --box 指定至少一個修正")
+        return
+
+    optimization = segmented_output_config = None
+    if os.path.exists(args.config):
+        with open(args.config, 'r', encoding='utf-8') as f:
+            full_config = json.load(f)
+        optimization = full_config.get('optimization')
+        segmented_output_config = full_config.get('segmented_output')
+
+    os.makedirs(args.output, exist_ok=True)
+    timestamp = time.strftime("%Y%m%d_%H%M%S")
+    output_path = os.path.join(args.output, f"masks_{timestamp}_fix{args.frame}")
+    report = retrack_from(args.archive, args.frame, replacements, new_prompts,
+                          sam2_overrides(args.model, args.device, args.imgsz), output_path,
+                          video_path=args.video, optimization=optimization)
+    print(f"沿用 {report['reused_frames']} 幀, 重新傳播 {report['retracked_frames']} 幀 "
+          f"({report['retracked_objects']} 個物件), {report['seconds']:.2f} 秒")
+    print(f"修正後的mask存檔: {report['archive']}")
+
+    if args.render:
+        with MaskArchive(output_path) as archive:
+            video_path = args.video or archive.meta['video']
+        color_map, alpha_map = load_style(args.config)
+        report['videos'] = render_archive(output_path, video_path, args.output, timestamp, color_map, alpha_map,
+                                          segmented_output_config)
+        print(f"視頻已儲存: {report['videos'][0]}, {report['videos'][1]}")
+
+    with open(output_path + "_correction.json", 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,420 @@
+import argparse
+import copy
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from mask_archive import MaskArchive, MaskArchiveWriter
+from object_masks import masks_from_label_map, paired_regions
+
+
+# 評估設定的預設值，候選設定只需寫出與參考設定不同的項目 (例如 "imgsz=512,stride=2")
+DEFAULT_EVAL_SETTING = {
+    "imgsz": 1024,  # SAM2輸入尺寸
+    "mode": "baseline",  # 最佳化模式 (model_optimization，可用+組合，例如 "bf16+compile")
+    "stride": 1,  # 每N幀推論一次，其餘幀沿用前一幀的mask
+    "gate": 0,  # 1表示啟用靜止幀略過推論 (motion_gate，參數取自配置檔案)
+    "max_side": 0,  # 解碼時把長邊縮小到此尺寸，0表示不縮放
+    "crop": 0.0,  # >0時只處理框提示聯集向外擴張此比例的區域，0表示不裁切
+    "workers": 0  # >1時以物件分組平行追蹤 (object_sharding)
+}
+
+
+def parse_setting(spec, base=None):
+    """解析 "鍵=值,鍵=值" 格式的設定，未指定的項目沿用base (預設為DEFAULT_EVAL_SETTING)"""
+    setting = dict(base or DEFAULT_EVAL_SETTING)
+    for part in filter(None, (part.strip() for part in spec.split(','))):
+        key, _, value = part.partition('=')
+        key = key.strip()
+        if key not in DEFAULT_EVAL_SETTING:
+            raise ValueError(f"未知的設定項目: {key}")
+        setting[key] = type(DEFAULT_EVAL_SETTING[key])(value.strip())
+    return setting
+
+
+def crop_region(boxes, shape, margin):
+    """框提示聯集向外擴張margin (相對於聯集的寬高) 後的裁切區域 (x1, y1, x2, y2)"""
+    boxes = np.asarray(boxes, dtype=np.float64)
+    x1, y1 = boxes[:, :2].min(axis=0)
+    x2, y2 = boxes[:, 2:4].max(axis=0)
+    pad_x = (x2 - x1) * margin
+    pad_y = (y2 - y1) * margin
+    h, w = shape[:2]
+    return (int(max(0, x1 - pad_x)), int(max(0, y1 - pad_y)),
+            int(min(w, np.ceil(x2 + pad_x))), int(min(h, np.ceil(y2 + pad_y))))
+
+
+def run_setting(video_path, boxes, model, device, setting, frames, archive_path, motion_gate_config=None):
+    """在獨立行程中以指定設定追蹤片段，標籤圖寫入mask存檔，回傳吞吐量統計
+
+    框提示以原始畫面座標指定；縮小解碼或裁切時換算到處理的畫面上，輸出的標籤圖
+    為解碼尺寸 (裁切的結果貼回完整畫面)。
+    """
+    from model_optimization import mode_config
+    from motion_gate import DEFAULT_MOTION_GATE_CONFIG, MotionGate, gated_track
+    from object_sharding import ObjectShardedEngine
+    from sam2_engine import SAM2FrameEngine
+    from sharded_tracking import sam2_overrides
+    from video_source import PrefetchFrameReader, read_first_frame
+
+    overrides = sam2_overrides(model, device, setting['imgsz'])
+    optimization = mode_config(setting['mode'])
+    if setting['workers'] > 1:
+        engine = ObjectShardedEngine(overrides, setting['workers'], num_frames=frames, source_name=video_path,
+                                     optimization=optimization)
+    else:
+        engine = SAM2FrameEngine(overrides, num_frames=frames, source_name=video_path, optimization=optimization)
+
+    # 縮小解碼時框提示等比例縮放
+    original = read_first_frame(video_path)
+    first = read_first_frame(video_path, setting['max_side'])
+    scale = first.shape[1] / original.shape[1]
+    boxes = [[v * scale for v in box[:4]] for box in boxes]
+    height, width = first.shape[:2]
+
+    region = None
+    if setting['crop'] > 0:
+        region = crop_region(boxes, first.shape, setting['crop'])
+        boxes = [[x1 - region[0], y1 - region[1], x2 - region[0], y2 - region[1]] for x1, y1, x2, y2 in boxes]
+    engine.add_objects([[int(round(v)) for v in box] for box in boxes], frame_idx=0)
+
+    reader = PrefetchFrameReader(video_path, end=frames, max_side=setting['max_side'])
+
+    def source():
+        for frame_idx, frame in reader:
+            if region is not None:
+                frame = np.ascontiguousarray(frame[region[1]:region[3], region[0]:region[2]])
+            yield frame_idx, frame
+
+    # gate和stride同時指定時以gate為準
+    if setting['gate']:
+        gate_config = dict(DEFAULT_MOTION_GATE_CONFIG)
+        gate_config.update(motion_gate_config or {})
+        gate_config.pop('enabled', None)
+        results = gated_track(engine, source(), MotionGate(**gate_config))
+    else:
+        results = engine.track(source())
+
+    def strided():
+        # 每stride幀推論一次，其餘幀沿用前一幀的結果 (與gated_track相同的淺複製)
+        previous = None
+        for frame_idx, frame in source():
+            if previous is None or frame_idx % setting['stride'] == 0:
+                result = engine.step(frame, frame_idx)
+            else:
+                result = copy.copy(previous)
+                result.frame_idx = frame_idx
+                result.orig_img = frame
+                result.inferred = False
+            previous = result
+            yield result
+
+    if setting['stride'] > 1 and not setting['gate']:
+        results = strided()
+
+    writer = None
+    inferred = 0
+    count = 0
+    first_time = None
+    try:
+        for result in results:
+            label_map = result.label_map
+            if region is not None:
+                full = np.zeros((height, width), dtype=label_map.dtype)
+                full[region[1]:region[3], region[0]:region[2]] = label_map
+                label_map = full
+            if writer is None:
+                writer = MaskArchiveWriter(archive_path, height, width, obj_ids=result.obj_ids, dtype=label_map.dtype)
+                # 第一幀包含模型載入和圖像尺寸設定，吞吐量從第一幀完成後起算
+                first_time = time.perf_counter()
+            writer.write(result.frame_idx, label_map)
+            inferred += getattr(result, 'inferred', True)
+            count += 1
+        end_time = time.perf_counter()
+    finally:
+        if writer is not None:
+            writer.close()
+        engine.close()
+
+    seconds = end_time - first_time if first_time is not None else 0.0
+    return {
+        'frames': count,
+        'inferred_frames': int(inferred),
+        'seconds': round(seconds, 3),
+        'fps': round((count - 1) / seconds, 3) if seconds > 0 else 0.0,
+        'applied': getattr(engine, 'applied_optimizations', [])
+    }
+
+
+def _setting_process(conn, args):
+    try:
+        conn.send(('ok', run_setting(*args)))
+    except Exception as e:
+        conn.send(('error', str(e)))
+    finally:
+        conn.close()
+
+
+def run_setting_process(context, args):
+    """在全新的行程中執行run_setting (非daemon行程，物件分組平行追蹤可以再建立子行程)"""
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=_setting_process, args=(child_conn, args))
+    process.start()
+    child_conn.close()
+    try:
+        status, value = parent_conn.recv()
+    except EOFError:
+        status, value = 'error', None
+    process.join()
+    if value is None:
+        value = f"行程異常結束 (exit code {process.exitcode})"
+    if status == 'error':
+        raise RuntimeError(value)
+    return value
+
+
+def mask_boundary(mask):
+    """mask的邊界像素 (mask減去3x3侵蝕)"""
+    mask = mask.astype(np.uint8)
+    return mask.astype(bool) & ~cv2.erode(mask, np.ones((3, 3), np.uint8)).astype(bool)
+
+
+def boundary_f_score(reference, candidate, tolerance):
+    """邊界F值 (DAVIS的F度量): 邊界像素在tolerance像素內有對應即視為命中"""
+    ref_boundary = mask_boundary(reference)
+    cand_boundary = mask_boundary(candidate)
+    ref_count = int(ref_boundary.sum())
+    cand_count = int(cand_boundary.sum())
+    if ref_count == 0 and cand_count == 0:
+        return 1.0
+    if ref_count == 0 or cand_count == 0:
+        return 0.0
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * tolerance + 1, 2 * tolerance + 1))
+    ref_dilated = cv2.dilate(ref_boundary.astype(np.uint8), kernel).astype(bool)
+    cand_dilated = cv2.dilate(cand_boundary.astype(np.uint8), kernel).astype(bool)
+    precision = (cand_boundary & ref_dilated).sum() / cand_count
+    recall = (ref_boundary & cand_dilated).sum() / ref_count
+    if precision + recall == 0:
+        return 0.0
+    return float(2 * precision * recall / (precision + recall))
+
+
+def compare_archives(reference_path, candidate_path, loss_iou=0.1, boundary_ratio=0.008):
+    """逐物件比較候選存檔與參考存檔，回傳每個物件的IoU、邊界F值和追蹤遺失幀數
+
+    IoU和邊界F值是參考或候選有mask的幀的平均；參考中有mask而候選的IoU低於loss_iou
+    (包含候選沒有mask或沒有該幀) 的幀計為追蹤遺失。候選的標籤圖尺寸不同時以最近鄰縮放到參考尺寸。
+    邊界容許距離為畫面對角線長度的boundary_ratio倍 (至少1像素)。每幀的標籤圖先轉為裁切的
+    物件mask (object_masks)，IoU只處理兩個框重疊的部分，邊界F值只處理兩個框的聯集加上容許距離。
+    """
+    with MaskArchive(reference_path) as reference, MaskArchive(candidate_path) as candidate:
+        size = (reference.width, reference.height)
+        tolerance = max(1, int(round(boundary_ratio * np.hypot(*size))))
+        objects = {obj_id: {'iou': [], 'boundary_f': [], 'loss_frames': 0, 'frames': 0}
+                   for obj_id in reference.obj_ids}
+        labels = {obj_id: (reference.obj_ids.index(obj_id) + 1,
+                           candidate.obj_ids.index(obj_id) + 1 if obj_id in candidate.obj_ids else None)
+                  for obj_id in reference.obj_ids}
+        for frame_idx, ref_map in reference:
+            cand_map = candidate.read(frame_idx) if frame_idx in candidate else None
+            if cand_map is not None and cand_map.shape != ref_map.shape:
+                cand_map = cv2.resize(cand_map, size, interpolation=cv2.INTER_NEAREST)
+            ref_masks = masks_from_label_map(ref_map, len(reference.obj_ids))
+            cand_masks = masks_from_label_map(cand_map, len(candidate.obj_ids)) if cand_map is not None else None
+            for obj_id, (ref_label, cand_label) in labels.items():
+                ref_mask = ref_masks[ref_label - 1]
+                cand_mask = cand_masks[cand_label - 1] if cand_masks is not None and cand_label is not None else None
+                if ref_mask is None and cand_mask is None:
+                    continue  # 兩邊都沒有mask的幀不計入
+                stats = objects[obj_id]
+                iou = ref_mask.iou(cand_mask) if ref_mask is not None and cand_mask is not None else 0.0
+                stats['frames'] += 1
+                stats['iou'].append(float(iou))
+                # 邊界擴張需要容許距離內的鄰域 (再加1像素讓侵蝕在區域邊緣與原始畫面相同)
+                stats['boundary_f'].append(boundary_f_score(*paired_regions(ref_mask, cand_mask, tolerance + 1),
+                                                            tolerance))
+                if ref_mask is not None and iou < loss_iou:
+                    stats['loss_frames'] += 1
+
+    return {obj_id: {
+        'frames': stats['frames'],
+        'mean_iou': round(float(np.mean(stats['iou'])), 4) if stats['iou'] else 1.0,
+        'boundary_f': round(float(np.mean(stats['boundary_f'])), 4) if stats['boundary_f'] else 1.0,
+        'loss_frames': stats['loss_frames']
+    } for obj_id, stats in objects.items()}
+
+
+def pareto_front(rows):
+    """回傳不被其他設定支配的設定名稱 (FPS、IoU、邊界F值越高越好，追蹤遺失幀數越少越好)"""
+    def keys(row):
+        return (row['fps'], row['mean_iou'], row['boundary_f'], -row['loss_frames'])
+
+    front = set()
+    for row in rows:
+        dominated = any(all(a >= b for a, b in zip(keys(other), keys(row))) and keys(other) != keys(row)
+                        for other in rows if other is not row)
+        if not dominated:
+            front.add(row['name'])
+    return front
+
+
+def evaluate(clips, model, device, reference, candidates, frames=0, loss_iou=0.1, motion_gate_config=None):
+    """在每個片段上依序 (各自在獨立行程中) 執行參考設定和所有候選設定，並與參考設定比較
+
+    Args:
+        clips: [{'video': 路徑, 'boxes': [[x1, y1, x2, y2], ...]}, ...]
+        reference: (名稱, 設定)，candidates: [(名稱, 設定), ...]
+    Returns:
+        (每個設定的彙總列表, 每個片段的詳細結果)
+    """
+    context = multiprocessing.get_context("spawn")
+    settings = [reference] + list(candidates)
+    details = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for clip_index, clip in enumerate(clips):
+            clip_result = {'video': clip['video'], 'settings': {}}
+            reference_archive = None
+            for index, (name, setting) in enumerate(settings):
+                archive_path = os.path.join(tmp_dir, f"clip{clip_index}_setting{index}")
+                print(f"[{os.path.basename(clip['video'])}] 執行設定: {name}")
+                try:
+                    stats = run_setting_process(context, (clip['video'], clip['boxes'], model, device, setting,
+                                                          frames or None, archive_path, motion_gate_config))
+                except Exception as e:
+                    print(f"設定 {name} 執行失敗: {e}")
+                    clip_result['settings'][name] = {'error': str(e)}
+                    if index == 0:
+                        break  # 參考設定失敗時無法比較
+                    continue
+                if index == 0:
+                    reference_archive = archive_path
+                stats['objects'] = compare_archives(reference_archive, archive_path, loss_iou)
+                clip_result['settings'][name] = stats
+            details.append(clip_result)
+
+    # 彙總所有片段: FPS為總幀數/總時間，IoU和邊界F值為所有物件的平均，追蹤遺失幀數為總和
+    rows = []
+    for name, _ in settings:
+        results = [clip['settings'].get(name) for clip in details]
+        if not results or any(result is None or 'error' in result for result in results):
+            rows.append({'name': name, 'error': next((result['error'] for result in results
+                                                      if result and 'error' in result), "參考設定失敗")})
+            continue
+        objects = [obj for result in results for obj in result['objects'].values()]
+        frames_total = sum(result['frames'] - 1 for result in results)
+        seconds = sum(result['seconds'] for result in results)
+        rows.append({
+            'name': name,
+            'fps': round(frames_total / seconds, 2) if seconds > 0 else 0.0,
+            'inferred_ratio': round(sum(result['inferred_frames'] for result in results)
+                                    / max(1, sum(result['frames'] for result in results)), 3),
+            'mean_iou': round(float(np.mean([obj['mean_iou'] for obj in objects])), 4) if objects else 1.0,
+            'boundary_f': round(float(np.mean([obj['boundary_f'] for obj in objects])), 4) if objects else 1.0,
+            'loss_frames': sum(obj['loss_frames'] for obj in objects)
+        })
+
+    valid = [row for row in rows if 'error' not in row]
+    front = pareto_front(valid)
+    reference_fps = valid[0]['fps'] if valid and valid[0]['name'] == reference[0] else None
+    for row in valid:
+        row['speedup'] = round(row['fps'] / reference_fps, 2) if reference_fps else None
+        row['pareto'] = row['name'] in front
+    return rows, details
+
+
+def format_table(rows):
+    """FPS對品質的Pareto表 (Markdown)，依FPS由高到低排列"""
+    lines = ["| 設定 | FPS | 加速比 | 推論幀比例 | 平均IoU | 邊界F值 | 追蹤遺失幀數 | Pareto |",
+             "|---|---:|---:|---:|---:|---:|---:|:---:|"]
+    for row in sorted(rows, key=lambda row: -row.get('fps', -1)):
+        if 'error' in row:
+            lines.append(f"| `{row['name']}` | 失敗: {row['error']} | | | | | | |")
+            continue
+        speedup = f"{row['speedup']:.2f}x" if row['speedup'] is not None else "-"
+        lines.append(f"| `{row['name']}` | {row['fps']:.2f} | {speedup} | {row['inferred_ratio']:.2f} | "
+                     f"{row['mean_iou']:.4f} | {row['boundary_f']:.4f} | {row['loss_frames']} | "
+                     f"{'✓' if row['pareto'] else ''} |")
+    return "\n".join(lines)
+
+
+def load_clips(paths, boxes, clips_file):
+    """由命令列的片段和框提示，以及片段JSON檔案組成片段列表"""
+    clips = [{'video': path, 'boxes': boxes} for path in paths]
+    if clips_file:
+        with open(clips_file, 'r', encoding='utf-8') as f:
+            clips += json.load(f)
+    return clips
+
+
+def main():
+    """在相同片段上比較加速設定與參考設定的mask品質和吞吐量，輸出FPS對品質的Pareto表"""
+    from soak_test import make_synthetic_video
+
+    parser = argparse.ArgumentParser(description="SAM2加速設定的速度/品質評估")
+    parser.add_argument("clips", nargs="*", help="測試片段 (視頻或影像序列目錄)，共用 --box 指定的框提示")
+    parser.add_argument("--box", action="append", default=[], help='框提示 "x1,y1,x2,y2" (可重複)')
+    parser.add_argument("--clips-file", help='片段JSON檔案 ([{"video": 路徑, "boxes": [[x1, y1, x2, y2], ...]}, ...])')
+    parser.add_argument("--reference", default="", help='參考設定 (預設 "imgsz=1024,mode=baseline")')
+    parser.add_argument("--candidate", action="append", default=[],
+                        help='候選設定 "鍵=值,..." (可重複)，可用的鍵: ' + ", ".join(DEFAULT_EVAL_SETTING))
+    parser.add_argument("--frames", type=int, default=0, help="每個片段只使用前N幀 (0為全部)")
+    parser.add_argument("--loss-iou", type=float, default=0.1, help="與參考相比IoU低於此值的幀計為追蹤遺失")
+    parser.add_argument("--config", default="./sam2_config.json", help="配置檔案 (motion_gate參數)")
+    parser.add_argument("--model", default="./models/sam2.1_t.pt", help="SAM2模型路徑")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="裝置")
+    parser.add_argument("--output", default="./output", help="報告輸出目錄")
+    args = parser.parse_args()
+
+    boxes = [[int(float(v)) for v in box.split(',')[:4]] for box in args.box]
+    if args.clips and not boxes:
+        print("請以 --box 指定命令列片段的框提示")
+        return
+    candidates = args.candidate or ["imgsz=768", "imgsz=512", "mode=bf16", "stride=2", "gate=1",
+                                    "max_side=640", "crop=0.5"]
+    reference = parse_setting(args.reference)
+    settings = [(args.reference or "reference", reference)]
+    settings += [(spec, parse_setting(spec, reference)) for spec in candidates]
+
+    motion_gate_config = None
+    if os.path.exists(args.config):
+        with open(args.config, 'r', encoding='utf-8') as f:
+            motion_gate_config = json.load(f).get('motion_gate')
+
+    os.makedirs(args.output, exist_ok=True)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        clips = load_clips(args.clips, boxes, args.clips_file)
+        if not clips:
+            # 沒有指定片段時使用合成片段
+            video_path = os.path.join(tmp_dir, "synthetic.mp4")
+            clips = [{'video': video_path, 'boxes': make_synthetic_video(video_path, args.frames or 60, 640, 480, 3)}]
+            print("未指定片段，使用合成片段")
+        rows, details = evaluate(clips, args.model, args.device, settings[0], settings[1:], args.frames,
+                                 args.loss_iou, motion_gate_config)
+
+    table = format_table(rows)
+    print(table)
+
+    timestamp = time.strftime('%Y%m%d_%H%M%S')
+    report_path = os.path.join(args.output, f"quality_eval_{timestamp}.json")
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump({'settings': {name: setting for name, setting in settings}, 'summary': rows, 'clips': details,
+                   'loss_iou': args.loss_iou, 'device': args.device, 'model': args.model}, f,
+                  ensure_ascii=False, indent=2)
+    table_path = os.path.join(args.output, f"quality_eval_{timestamp}.md")
+    with open(table_path, 'w', encoding='utf-8') as f:
+        f.write(f"# SAM2速度/品質評估 ({time.strftime('%Y-%m-%d')})\n\n")
+        f.write(f"- 參考設定: `{settings[0][0]}` ({json.dumps(reference, ensure_ascii=False)})\n")
+        f.write(f"- 片段: {', '.join(os.path.basename(clip['video']) for clip in details)}\n")
+        f.write(f"- 裝置: {args.device}, 模型: {os.path.basename(args.model)}, 追蹤遺失IoU閾值: {args.loss_iou}\n\n")
+        f.write(table + "\n")
+    print(f"報告已儲存: {report_path}, {table_path}")
+
+
+if __name__ == "__main__":
+    main()
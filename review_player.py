@@ -0,0 +1,388 @@
+import argparse
+import collections
+import json
+import os
+import random
+import threading
+import time
+
+import cv2
+import tkinter as tk
+from tkinter import ttk
+
+from frame_display import FrameDisplay, DEFAULT_DISPLAY_CONFIG
+from mask_archive import MaskArchive
+from sharded_tracking import class_luts, load_style
+from video_source import downscale_frame, is_frame_sequence, list_sequence_frames, load_image_frame
+
+
+# 追蹤結果檢視的預設配置 (可在sam2_config.json的"review"區段覆寫)
+DEFAULT_REVIEW_CONFIG = {
+    "save_archive": True,  # 追蹤時把標籤圖存入mask存檔 (檢視視窗的資料來源)
+    "open_after_tracking": True,  # 視頻追蹤完成後自動開啟檢視視窗
+    "cache_frames": 32,  # 快取的已解碼幀數 (畫面和標籤圖)
+    "max_side": 0,  # 快取的畫面把長邊縮小到此尺寸以節省記憶體 (0為不縮小，縮小會增加解碼時間)
+    "read_ahead": 12  # 目前位置之後 (倒退時為之前) 預先讀取的幀數
+}
+
+
+class ReviewCache:
+    """mask存檔加來源視頻的隨機存取幀快取
+
+    位置為存檔中幀的順序 (0..len-1)。背景執行緒依最新的請求預先解碼目前位置附近的幀
+    (畫面和標籤圖)，放入LRU快取: 前進時讀取之後的read_ahead幀，視頻依序解碼不需要seek；
+    倒退時一次讀取之前的一整段，每read_ahead/2步才seek一次。呼叫端只從快取取幀，不會等待解碼。
+    """
+
+    def __init__(self, archive_path, video_path=None, cache_frames=DEFAULT_REVIEW_CONFIG["cache_frames"],
+                 read_ahead=DEFAULT_REVIEW_CONFIG["read_ahead"], max_side=DEFAULT_REVIEW_CONFIG["max_side"]):
+        self.archive = MaskArchive(archive_path)
+        self.video_path = video_path or self.archive.meta.get('video')
+        if not self.video_path:
+            self.archive.close()
+            raise ValueError("存檔沒有記錄來源視頻，請指定視頻路徑")
+        self.frame_indices = self.archive.frame_indices
+        self.cache_frames = max(2, int(cache_frames))
+        self.read_ahead = max(1, min(int(read_ahead), self.cache_frames - 1))
+        self.max_side = max_side  # 標籤圖可以是任意解析度 (例如模型解析度)，顯示時各自縮放
+        self._paths = list_sequence_frames(self.video_path) if is_frame_sequence(self.video_path) else None
+        self._capture = None
+        self._next_frame = None  # VideoCapture下一個會解碼的幀編號
+
+        self._cache = collections.OrderedDict()  # frame_idx -> (畫面, 標籤圖)
+        self._cond = threading.Condition()
+        self._target = None  # (位置, 方向)
+        self._stopped = False
+        self.error = None
+
+        # 統計
+        self.hits = 0
+        self.misses = 0
+        self.decoded = 0
+        self.seeks = 0
+        self.decode_seconds = 0.0
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return len(self.frame_indices)
+
+    def _window(self, target):
+        """請求位置附近需要讀取的幀編號 (遞增順序)"""
+        position, direction = target
+        if direction >= 0:
+            positions = range(position, min(len(self), position + self.read_ahead + 1))
+        else:
+            # 倒退時目前位置之前的一半都還在快取中就不需要讀取
+            near = range(max(0, position - self.read_ahead // 2), position + 1)
+            if all(self.frame_indices[p] in self._cache for p in near):
+                return []
+            positions = range(max(0, position - self.read_ahead), position + 1)
+        return [self.frame_indices[p] for p in positions if self.frame_indices[p] not in self._cache]
+
+    def request(self, position, direction=1):
+        """要求讀取指定位置附近的幀 (direction為播放或拖動的方向)"""
+        with self._cond:
+            if self.frame_indices[position] in self._cache:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._target = (position, direction)
+            self._cond.notify_all()
+
+    def get(self, position):
+        """回傳快取中的 (畫面, 標籤圖)，尚未讀取時回傳None"""
+        with self._cond:
+            item = self._cache.get(self.frame_indices[position])
+            if item is not None:
+                self._cache.move_to_end(self.frame_indices[position])
+            return item
+
+    def wait(self, position, direction=1, timeout=None):
+        """要求並等待指定位置的幀 (不經過GUI時使用)"""
+        self.request(position, direction)
+        frame_idx = self.frame_indices[position]
+        with self._cond:
+            self._cond.wait_for(lambda: frame_idx in self._cache or self.error is not None or self._stopped,
+                                timeout)
+            if self.error is not None:
+                raise self.error
+            return self._cache.get(frame_idx)
+
+    def _decode(self, frame_idx):
+        if self._paths is not None:
+            return load_image_frame(self._paths[frame_idx], self.max_side)
+        if self._capture is None:
+            self._capture = cv2.VideoCapture(self.video_path)
+            self._next_frame = 0
+        gap = frame_idx - self._next_frame
+        if 0 < gap <= self.read_ahead:
+            # 小間隔只grab不解碼，比seek便宜
+            for _ in range(gap):
+                self._capture.grab()
+        elif gap != 0:
+            self._capture.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+            self.seeks += 1
+        success, frame = self._capture.read()
+        if not success:
+            raise IOError(f"無法讀取第 {frame_idx} 幀: {self.video_path}")
+        self._next_frame = frame_idx + 1
+        return downscale_frame(frame, self.max_side)
+
+    def _run(self):
+        try:
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._stopped or (self._target is not None
+                                                                  and self._window(self._target)))
+                    if self._stopped:
+                        return
+                    target = self._target
+                    frames = self._window(target)
+                for frame_idx in frames:
+                    start = time.perf_counter()
+                    item = (self._decode(frame_idx), self.archive.read(frame_idx))
+                    self.decode_seconds += time.perf_counter() - start
+                    self.decoded += 1
+                    with self._cond:
+                        self._cache[frame_idx] = item
+                        while len(self._cache) > self.cache_frames:
+                            self._cache.popitem(last=False)
+                        self._cond.notify_all()
+                        if self._stopped or self._target != target:
+                            break  # 有新的請求，改讀新位置附近的幀
+        except Exception as e:
+            with self._cond:
+                self.error = e
+                self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join(timeout=2)
+        if self._capture is not None:
+            self._capture.release()
+        self.archive.close()
+        self._cache.clear()
+
+    def summary(self):
+        return {
+            'frames': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'decoded': self.decoded,
+            'seeks': self.seeks,
+            'decode_ms': round(self.decode_seconds * 1e3 / self.decoded, 2) if self.decoded else 0.0
+        }
+
+    def format(self):
+        summary = self.summary()
+        return (f"結果檢視快取: 命中 {summary['hits']} 次, 未命中 {summary['misses']} 次, "
+                f"解碼 {summary['decoded']} 幀 (seek {summary['seeks']} 次), 平均每幀 {summary['decode_ms']:.1f} ms")
+
+
+class ReviewWindow:
+    """從mask存檔重播追蹤結果的檢視視窗，不需要重新推論
+
+    支援拖動時間軸、逐幀前進/倒退、播放，以及依類別切換顯示。畫面在顯示時才以目前的類別
+    顏色和透明度混合，get_style回傳最新的 (color_map, alpha_map)，修改顏色後呼叫refresh即可。
+    """
+
+    def __init__(self, master, archive_path, get_style, video_path=None, config=None,
+                 display_config=None, on_close=None):
+        self.config = dict(DEFAULT_REVIEW_CONFIG)
+        self.config.update(config or {})
+        display_config = dict(DEFAULT_DISPLAY_CONFIG, **(display_config or {}))
+        self.cache = ReviewCache(archive_path, video_path, self.config['cache_frames'], self.config['read_ahead'],
+                                 self.config['max_side'])
+        self.get_style = get_style
+        self.on_close = on_close
+
+        meta = self.cache.archive.meta
+        classes_by_id = meta.get('classes', {})
+        self.label_classes = [classes_by_id.get(str(obj_id), "Object") for obj_id in self.cache.archive.obj_ids]
+        self.interval_ms = max(1, int(round(1000 / (meta.get('fps') or 30))))
+        self.position = 0
+        self.playing = False
+        self._shown = None
+        self._after_id = None
+
+        self.window = tk.Toplevel(master)
+        self.window.title(f"追蹤結果檢視 - {archive_path}")
+        self.window.geometry("800x650")
+
+        control_frame = ttk.Frame(self.window)
+        control_frame.pack(fill=tk.X, pady=(5, 0))
+        ttk.Button(control_frame, text="◀", width=3, command=lambda: self.step(-1)).pack(side=tk.LEFT, padx=5)
+        self.play_btn = ttk.Button(control_frame, text="播放", command=self.toggle_play)
+        self.play_btn.pack(side=tk.LEFT)
+        ttk.Button(control_frame, text="▶", width=3, command=lambda: self.step(1)).pack(side=tk.LEFT, padx=5)
+        self.frame_var = tk.StringVar(value="")
+        ttk.Label(control_frame, textvariable=self.frame_var).pack(side=tk.LEFT, padx=10)
+
+        # 依類別切換顯示
+        self.visible = {}
+        for class_name in dict.fromkeys(self.label_classes):
+            self.visible[class_name] = tk.BooleanVar(value=True)
+            ttk.Checkbutton(control_frame, text=class_name, variable=self.visible[class_name],
+                            command=self.refresh).pack(side=tk.LEFT, padx=(0, 5))
+
+        self.scale = tk.Scale(self.window, from_=0, to=max(0, len(self.cache) - 1), orient=tk.HORIZONTAL,
+                              showvalue=False, command=self.on_scrub)
+        self.scale.pack(fill=tk.X, padx=5)
+
+        canvas = tk.Canvas(self.window, bg='black')
+        canvas.pack(fill=tk.BOTH, expand=True)
+        self.display = FrameDisplay(canvas, display_config['fps'], display_config['interpolation'])
+
+        self.window.bind("<Left>", lambda event: self.step(-1))
+        self.window.bind("<Right>", lambda event: self.step(1))
+        self.window.bind("<space>", lambda event: self.toggle_play())
+        self.window.bind("<Home>", lambda event: self.seek(0, -1))
+        self.window.bind("<End>", lambda event: self.seek(len(self.cache) - 1, -1))
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+
+        self.cache.request(0)
+        self.display.start()
+        self._tick()
+
+    def luts(self):
+        """依目前的類別顏色建立查找表，隱藏的類別透明度為0"""
+        colors, alphas = class_luts(self.label_classes, *self.get_style())
+        for label, class_name in enumerate(self.label_classes, start=1):
+            if not self.visible[class_name].get():
+                alphas[label] = 0.0
+        return colors, alphas
+
+    def _show(self, force=False):
+        if self._shown == self.position and not force:
+            return
+        item = self.cache.get(self.position)
+        if item is None:
+            return  # 尚未讀取，下一次計時器再顯示
+        frame, label_map = item
+        self.display.submit(frame, label_map, *self.luts())
+        self._shown = self.position
+        self.frame_var.set(f"幀 {self.cache.frame_indices[self.position]} ({self.position + 1}/{len(self.cache)})")
+
+    def refresh(self):
+        """以目前的顏色和顯示的類別重新繪製目前的幀"""
+        self._show(force=True)
+        self.display.flush()
+
+    def seek(self, position, direction=1):
+        self.position = max(0, min(len(self.cache) - 1, position))
+        self.cache.request(self.position, direction)
+        self.scale.set(self.position)
+        self._show()
+
+    def step(self, delta):
+        self.set_playing(False)
+        self.seek(self.position + delta, delta)
+
+    def on_scrub(self, value):
+        position = int(float(value))
+        if position != self.position:
+            self.seek(position, 1 if position > self.position else -1)
+
+    def set_playing(self, playing):
+        self.playing = playing
+        self.play_btn.config(text="暫停" if playing else "播放")
+
+    def toggle_play(self):
+        if not self.playing and self.position >= len(self.cache) - 1:
+            self.seek(0)
+        self.set_playing(not self.playing)
+
+    def _tick(self):
+        """以來源的幀率播放: 下一幀已在快取中才前進，解碼跟不上時放慢而不跳幀"""
+        self._after_id = None
+        if self.cache.error is not None:
+            print(f"結果檢視讀取失敗: {self.cache.error}")
+            self.close()
+            return
+        if self.playing:
+            if self.position >= len(self.cache) - 1:
+                self.set_playing(False)
+            elif self.cache.get(self.position + 1) is not None:
+                self.seek(self.position + 1)
+            else:
+                self.cache.request(self.position + 1)
+        self._show()
+        self._after_id = self.window.after(self.interval_ms, self._tick)
+
+    def close(self):
+        if self._after_id is not None:
+            self.window.after_cancel(self._after_id)
+            self._after_id = None
+        self.display.stop()
+        print(self.cache.format())
+        self.cache.close()
+        self.window.destroy()
+        if self.on_close is not None:
+            self.on_close()
+
+
+def benchmark(archive_path, video_path=None, cache_frames=DEFAULT_REVIEW_CONFIG["cache_frames"],
+              read_ahead=DEFAULT_REVIEW_CONFIG["read_ahead"], max_side=DEFAULT_REVIEW_CONFIG["max_side"],
+              seeks=20, seed=0):
+    """量測依序播放、逐幀倒退和隨機跳轉時取得一幀的等待時間 (ms)"""
+    cache = ReviewCache(archive_path, video_path, cache_frames, read_ahead, max_side)
+    try:
+        count = len(cache)
+        results = {'frames': count}
+
+        def timed(positions, direction, frame_seconds=0.0):
+            waits = []
+            for position in positions:
+                start = time.perf_counter()
+                cache.wait(position, direction)
+                waits.append(time.perf_counter() - start)
+                time.sleep(frame_seconds)  # 模擬播放時兩幀之間的顯示間隔
+            return sum(waits) * 1e3 / max(len(waits), 1)
+
+        results['play_ms'] = timed(range(count), 1, 1 / 30)
+        results['step_back_ms'] = timed(range(count - 1, max(-1, count - 1 - 3 * read_ahead), -1), -1, 1 / 30)
+        rng = random.Random(seed)
+        results['random_seek_ms'] = timed([rng.randrange(count) for _ in range(seeks)], 1)
+        results.update(cache.summary())
+        return results
+    finally:
+        cache.close()
+
+
+def main():
+    """開啟mask存檔的結果檢視視窗，或以--benchmark量測快取的存取時間"""
+    parser = argparse.ArgumentParser(description="從mask存檔檢視追蹤結果 (不重新推論)")
+    parser.add_argument("archive", help="mask存檔目錄")
+    parser.add_argument("--video", help="來源視頻或影像序列目錄 (預設使用存檔中記錄的路徑)")
+    parser.add_argument("--config", default="./sam2_config.json", help="配置檔案 (類別顏色和review區段)")
+    parser.add_argument("--benchmark", action="store_true", help="不開啟視窗，量測播放、倒退和隨機跳轉的等待時間")
+    args = parser.parse_args()
+
+    config = {}
+    if os.path.exists(args.config):
+        with open(args.config, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    review_config = dict(DEFAULT_REVIEW_CONFIG, **config.get('review', {}))
+
+    if args.benchmark:
+        r = benchmark(args.archive, args.video, review_config['cache_frames'], review_config['read_ahead'],
+                      review_config['max_side'])
+        print(f"{r['frames']} 幀: 依序播放每幀等待 {r['play_ms']:.2f} ms, 逐幀倒退 {r['step_back_ms']:.2f} ms, "
+              f"隨機跳轉 {r['random_seek_ms']:.1f} ms (解碼 {r['decoded']} 幀, seek {r['seeks']} 次, "
+              f"平均每幀解碼 {r['decode_ms']:.1f} ms)")
+        return
+
+    root = tk.Tk()
+    root.withdraw()
+    style = load_style(args.config)
+    ReviewWindow(root, args.archive, lambda: style, args.video, review_config, config.get('display'),
+                 on_close=root.destroy)
+    root.mainloop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+import types
+
+import cv2
+import torch
+from ultralytics.engine.results import Boxes, Masks
+from ultralytics.models.sam import SAM2VideoPredictor
+from ultralytics.models.sam.amg import batched_mask_to_box
+from ultralytics.utils import ops
+
+from label_map import LabelMapReducer, build_label_map, valid_mask_region
+from model_optimization import apply_optimizations
+
+
+# 未知長度的來源 (即時影像) 使用的幀數上限，SAM2的記憶選取需要一個有限的幀數
+UNBOUNDED_NUM_FRAMES = 2 ** 31 - 1
+
+
+def read_video_frames(video_path, start=0, end=None, stride=1, capture=None, first_frame=None):
+    """逐幀讀取視頻，產生 (frame_idx, frame)
+
+    start/end/stride 用於只讀取部分幀，跳過的幀只grab不解碼為圖像，
+    避免依賴編碼器不一定精確的seek。capture/first_frame為已讀過第一幀的VideoCapture
+    和該幀 (video_source.probe_source保留)，由第二幀繼續讀取。
+    """
+    cap = capture if capture is not None else cv2.VideoCapture(video_path)
+    try:
+        frame_idx = 0
+        if first_frame is not None:
+            if start == 0 and (end is None or end > 0):
+                yield 0, first_frame
+            frame_idx = 1
+        while end is None or frame_idx < end:
+            if frame_idx < start or (frame_idx - start) % stride:
+                if not cap.grab():
+                    break
+                frame_idx += 1
+                continue
+            success, frame = cap.read()
+            if not success:
+                break
+            yield frame_idx, frame
+            frame_idx += 1
+    finally:
+        cap.release()
+
+
+class FrameResult:
+    """單幀追蹤結果
+
+    mask在內部保持模型解析度的logits，標籤圖 (uint8，0為背景，i+1對應obj_ids[i]) 在使用端
+    需要時才建立: label_map為原始尺寸 (寫入器和存檔)，label_map_at為任意尺寸，
+    low_res_label_map為模型解析度 (顯示以最近鄰放大、低解析度統計)。每個尺寸每幀只建立一次。
+    orig_img/masks/boxes 與ultralytics的Results介面相容，masks和boxes只在被存取時
+    才從裝置上的logits計算；masks中第i個mask固定對應obj_ids[i]，即使物件在該幀
+    消失也會保留一個空mask，不會造成索引錯位。
+    """
+
+    def __init__(self, frame_idx, orig_img, logits, obj_ids, label_map=None, mask_threshold=0.0, reducer=None):
+        self.frame_idx = frame_idx
+        self.orig_img = orig_img
+        self.obj_ids = list(obj_ids)  # 每個mask對應的物件編號
+        self.capture_time = None  # 即時來源的擷取時間 (用於計算端到端延遲)
+        self.inferred = True  # False表示沿用前一幀的mask (未執行推論)
+        self.logits = logits  # (N, h, w) 裝置上模型解析度的logits
+        self.mask_threshold = mask_threshold
+        self._reducer = reducer  # 建立原始尺寸標籤圖並傳回主機的LabelMapReducer (共用主機緩衝區和統計)
+        self._label_maps = {}  # (H, W) -> 主機上的標籤圖
+        self._stored_label_map = label_map  # 沒有logits時其他尺寸由此最近鄰縮放
+        if label_map is not None:
+            self._label_maps[label_map.shape[:2]] = label_map
+        self._low_res_label_map = None
+        self._masks = None
+        self._boxes = None
+
+    @property
+    def label_map(self):
+        """原始尺寸的標籤圖，首次存取時才在裝置上上採樣並傳回主機
+
+        經由LabelMapReducer傳回時是輪替緩衝區的視圖，需要長期保留時請自行copy。
+        """
+        return self.label_map_at(self.orig_img.shape[:2])
+
+    def label_map_at(self, shape):
+        """指定尺寸 (H, W) 的標籤圖 (logits雙線性上採樣到該尺寸後取最高的物件)，每個尺寸只建立一次
+
+        沒有logits但有標籤圖時 (例如由標籤圖合併的結果)，以最近鄰縮放該標籤圖。
+        """
+        shape = tuple(shape)
+        if shape not in self._label_maps:
+            reducer = self._reducer if self._reducer is not None else LabelMapReducer(self.mask_threshold)
+            if self.logits is None and self._stored_label_map is not None:
+                self._label_maps[shape] = cv2.resize(self._stored_label_map, (shape[1], shape[0]),
+                                                     interpolation=cv2.INTER_NEAREST)
+            elif self.logits is None or len(self.logits) == 0:
+                self._label_maps[shape] = reducer.empty(shape)
+            else:
+                self._label_maps[shape] = reducer.reduce(self.logits, shape)
+        return self._label_maps[shape]
+
+    @property
+    def low_res_label_map(self):
+        """模型解析度的標籤圖 (不上採樣，已去除LetterBox補齊的區域，長寬比與畫面相同)
+
+        沒有logits時 (例如由標籤圖合併的結果) 為原始尺寸的標籤圖。
+        """
+        if self._low_res_label_map is None:
+            if self.logits is None or len(self.logits) == 0:
+                return self.label_map
+            height, width = valid_mask_region(self.logits.shape[-2:], self.orig_img.shape)
+            labels, _ = build_label_map(self.logits[:, :height, :width], (height, width), self.mask_threshold)
+            self._low_res_label_map = labels.cpu().numpy()
+        return self._low_res_label_map
+
+    @property
+    def masks(self):
+        """原始尺寸的二值mask (在裝置上，首次存取時計算)"""
+        if self._masks is None and self.logits is not None and len(self.logits) > 0:
+            orig_shape = self.orig_img.shape[:2]
+            mask_data = ops.scale_masks(self.logits[None].float(), orig_shape, padding=False)[0]
+            self._masks = Masks(mask_data > self.mask_threshold, orig_shape)
+        return self._masks
+
+    @property
+    def boxes(self):
+        """由mask計算的xyxy框，cls欄位為物件編號"""
+        if self._boxes is None and self.masks is not None:
+            mask_data = self.masks.data
+            xyxy = batched_mask_to_box(mask_data).float()
+            conf = torch.ones(len(mask_data), 1, device=mask_data.device)
+            cls = torch.tensor(self.obj_ids, dtype=torch.float32, device=mask_data.device)[:, None]
+            self._boxes = Boxes(torch.cat([xyxy, conf, cls], dim=1), self.orig_img.shape[:2])
+        return self._boxes
+
+
+class TrackGroup:
+    """共用一個SAM2 inference_state的一組物件 (在同一幀上一起加入追蹤)"""
+
+    def __init__(self, obj_ids, bboxes, start_frame, num_frames):
+        self.obj_ids = list(obj_ids)
+        self.bboxes = [list(map(float, box)) for box in bboxes]
+        self.start_frame = start_frame
+        self.state = SAM2VideoPredictor._init_state(num_frames or UNBOUNDED_NUM_FRAMES)
+        self.started = False
+
+
+class SAM2FrameEngine:
+    """逐幀驅動SAM2VideoPredictor的追蹤引擎
+
+    由呼叫端提供解碼後的幀，而不是讓predictor自己讀取視頻。SAM2在追蹤開始後不允許
+    加入新物件，因此每一批在同一幀加入的物件使用獨立的inference_state (TrackGroup)，
+    所有組共用同一次圖像編碼器的輸出，新物件可以在任意幀加入追蹤。
+
+    SAM2依幀編號選取前幾幀的記憶，引擎內部以連續的處理序號作為SAM2的幀編號，
+    因此呼叫端傳入的frame_idx可以跳號 (例如略過靜止的幀)，不會減少可用的記憶。
+    """
+
+    def __init__(self, overrides, num_frames=None, source_name="frames", optimization=None, feature_store=None):
+        self.predictor = SAM2VideoPredictor(overrides=dict(overrides))
+        self.num_frames = num_frames  # 即時影像等未知長度的來源為None
+        self.source_name = source_name
+        self.optimization = dict(optimization or {})  # int8/bf16/compile 最佳化配置
+        self.applied_optimizations = []
+        self.feature_store = feature_store  # 圖像編碼器特徵存放區 (feature_store.FeatureStore)，None表示每幀重新編碼
+        self.groups = []
+        self.next_obj_id = 0
+        self.state_frames = 0  # 已處理的幀數，即下一幀在SAM2狀態中的幀編號
+        self.retired = set()  # 已停止追蹤 (被修正取代) 的物件編號
+        self.reducer = LabelMapReducer()
+        self._ready = False
+
+    def load_model(self):
+        """載入模型並套用最佳化 (已載入時不重複載入)"""
+        predictor = self.predictor
+        if predictor.model is None:
+            predictor.setup_model(verbose=False)
+            self.applied_optimizations = apply_optimizations(predictor.model, self.optimization, predictor.device)
+            if self.applied_optimizations:
+                print(f"SAM2已套用最佳化: {'+'.join(self.applied_optimizations)}")
+
+    def _setup(self, frame):
+        """以第一幀設定模型和圖像尺寸"""
+        predictor = self.predictor
+        self.load_model()
+        # 借用ultralytics的numpy來源設定imgsz和特徵尺寸，隨後替換為逐幀的視頻狀態
+        predictor.setup_source(frame)
+        predictor.dataset = types.SimpleNamespace(mode="video", frame=0, frames=self.num_frames or UNBOUNDED_NUM_FRAMES)
+        self._ready = True
+
+    @property
+    def num_objects(self):
+        return self.next_obj_id
+
+    def add_objects(self, bboxes, frame_idx=0):
+        """在指定幀加入新的框提示，回傳分配的物件編號"""
+        if len(bboxes) == 0:
+            return []
+        obj_ids = list(range(self.next_obj_id, self.next_obj_id + len(bboxes)))
+        self.next_obj_id += len(bboxes)
+        self.groups.append(TrackGroup(obj_ids, bboxes, frame_idx, self.num_frames))
+        return obj_ids
+
+    def remove_objects(self, obj_ids):
+        """停止追蹤指定的物件，整組都停止的TrackGroup直接移除"""
+        self.retired.update(obj_ids)
+        self.groups = [group for group in self.groups if not self.retired.issuperset(group.obj_ids)]
+
+    def _active_logits(self, group, group_logits):
+        """去除已停止追蹤的物件，回傳 (logits, obj_ids)"""
+        keep = [i for i, obj_id in enumerate(group.obj_ids) if obj_id not in self.retired]
+        if len(keep) < len(group.obj_ids):
+            group_logits = group_logits[keep]
+        return group_logits, [group.obj_ids[i] for i in keep]
+
+    @torch.inference_mode()
+    def step(self, frame, frame_idx, encoded=None):
+        """對單幀執行追蹤，回傳FrameResult
+
+        encoded為預先計算的 (預處理後的圖像, 圖像編碼器輸出或None) (encoder_lookahead)，
+        提供時略過這一幀的預處理和圖像編碼器。
+        """
+        if not self._ready:
+            self._setup(frame)
+            self.reducer.threshold = self.predictor.model.mask_threshold
+
+        predictor = self.predictor
+        state_idx = self.state_frames
+        self.state_frames += 1
+        predictor.dataset.frame = state_idx
+        predictor.batch = ([self.source_name], [frame], [""])
+        im, backbone_out = encoded if encoded is not None else (predictor.preprocess([frame]), None)
+
+        # 圖像編碼器每幀只執行一次 (或由特徵存放區讀取)，所有組透過backbone_out共用特徵
+        predictor.backbone_out = self._image_features(im, frame_idx, backbone_out)
+        logits = []
+        obj_ids = []
+        try:
+            for group in self.groups:
+                if frame_idx < group.start_frame:
+                    continue
+                group_logits, group_ids = self._active_logits(group, self._track_group(group, im, state_idx))
+                logits.append(group_logits)
+                obj_ids.extend(group_ids)
+        finally:
+            predictor.backbone_out = None
+
+        # 標籤圖在使用端需要時才以reducer在裝置上建立 (閾值、重疊處理和上採樣)，只傳回需要的尺寸
+        logits = torch.cat(logits).flatten(0, 1) if logits else None  # (N, 1, h, w) -> (N, h, w)
+        return FrameResult(frame_idx, frame, logits, obj_ids, mask_threshold=predictor.model.mask_threshold,
+                           reducer=self.reducer)
+
+    @torch.inference_mode()
+    def correct(self, result, bboxes, replace_ids=()):
+        """在最後處理的一幀上修正提示，回傳 (該幀修正後的FrameResult, 新物件編號)
+
+        replace_ids中的物件停止追蹤，bboxes作為新物件從這一幀開始傳播 (新的TrackGroup與其他組
+        使用同一個SAM2幀編號)，之後的幀照常以step處理，不需要從頭重新追蹤。
+        """
+        if self.state_frames == 0:
+            raise RuntimeError("尚未處理任何幀，無法修正")
+        self.remove_objects(replace_ids)
+        new_ids = self.add_objects(bboxes, result.frame_idx)
+
+        # 保留原結果中仍在追蹤的物件
+        keep = [i for i, obj_id in enumerate(result.obj_ids) if obj_id not in self.retired]
+        logits = [result.logits[keep]] if keep and result.logits is not None else []
+        obj_ids = [result.obj_ids[i] for i in keep]
+
+        frame = result.orig_img
+        if new_ids:
+            predictor = self.predictor
+            state_idx = self.state_frames - 1
+            predictor.dataset.frame = state_idx
+            predictor.batch = ([self.source_name], [frame], [""])
+            im = predictor.preprocess([frame])
+            predictor.backbone_out = self._image_features(im, result.frame_idx)
+            try:
+                group_logits = self._track_group(self.groups[-1], im, state_idx)
+            finally:
+                predictor.backbone_out = None
+            logits.append(group_logits.flatten(0, 1))
+            obj_ids.extend(new_ids)
+
+        logits = torch.cat(logits) if logits else None
+        corrected = FrameResult(result.frame_idx, frame, logits, obj_ids,
+                                mask_threshold=self.predictor.model.mask_threshold, reducer=self.reducer)
+        corrected.capture_time = result.capture_time
+        return corrected, new_ids
+
+    def _image_features(self, im, frame_idx, backbone_out=None):
+        """圖像編碼器的輸出；有特徵存放區時優先讀取已儲存的特徵，新計算 (或預先計算) 的特徵寫入存放區"""
+        store = self.feature_store
+        if backbone_out is None:
+            if store is not None:
+                backbone_out = store.load(frame_idx, self.predictor.model, im.device)
+                if backbone_out is not None:
+                    return backbone_out
+            backbone_out = self.predictor.model.forward_image(im)
+        if store is not None:
+            store.save(frame_idx, backbone_out)
+        return backbone_out
+
+    def _track_group(self, group, im, state_idx):
+        """以組的inference_state追蹤一幀，回傳該組所有物件的低解析度logits"""
+        predictor = self.predictor
+        predictor.inference_state = group.state
+        predictor.prompts = {}
+        predictor.inference(im, bboxes=None if group.started else group.bboxes)
+        group.started = True
+
+        output_dict = group.state["output_dict"]
+        current_out = output_dict["cond_frame_outputs"].get(state_idx)
+        if current_out is None:
+            current_out = output_dict["non_cond_frame_outputs"][state_idx]
+        return current_out["pred_masks"]
+
+    def track(self, frames):
+        """對 (frame_idx, frame) 或 (frame_idx, frame, capture_time) 疊代器逐幀追蹤，產生FrameResult
+
+        frame_idx必須遞增，但可以跳號。
+        """
+        for item in frames:
+            result = self.step(item[1], item[0])
+            if len(item) > 2:
+                result.capture_time = item[2]
+            yield result
+
+    def close(self):
+        """釋放所有追蹤狀態"""
+        self.groups = []
+        self.predictor.inference_state = {}
+        self.predictor.backbone_out = None
+
+    def reset(self, num_frames=None, source_name="frames"):
+        """釋放追蹤狀態並改為追蹤新的來源，已載入的模型保留重複使用"""
+        self.close()
+        self.num_frames = num_frames
+        self.source_name = source_name
+        self.next_obj_id = 0
+        self.state_frames = 0
+        self.retired = set()
+        self._ready = False
@@ -0,0 +1,265 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+import cv2
+
+
+# 分段輸出視頻的預設配置 (可在sam2_config.json的"segmented_output"區段覆寫)
+DEFAULT_SEGMENTED_OUTPUT_CONFIG = {
+    "enabled": True,  # False時直接以cv2.VideoWriter寫入單一檔案
+    "segment_seconds": 10,  # 每段的長度 (秒)
+    "keep_segments": False,  # 合併成功後保留分段目錄
+    "ffmpeg": "ffmpeg"  # 無損合併使用的ffmpeg執行檔；找不到時直接串接分段位元組輸出.ts
+}
+
+MANIFEST_NAME = "manifest.json"
+
+
+def segments_dir(output_path):
+    """最終輸出檔案對應的分段目錄"""
+    return os.path.splitext(output_path)[0] + "_segments"
+
+
+def write_manifest(directory, manifest):
+    """以暫存檔加os.replace寫入清單，當機時清單不會只寫一半"""
+    path = os.path.join(directory, MANIFEST_NAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_manifest(directory):
+    with open(os.path.join(directory, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def find_ffmpeg(ffmpeg=DEFAULT_SEGMENTED_OUTPUT_CONFIG["ffmpeg"]):
+    return shutil.which(ffmpeg) if ffmpeg else None
+
+
+def concat_segments(segment_paths, output_path, ffmpeg=DEFAULT_SEGMENTED_OUTPUT_CONFIG["ffmpeg"]):
+    """無損合併MPEG-TS分段，回傳實際輸出的路徑
+
+    有ffmpeg時以concat demuxer串流複製 (-c copy，不重新編碼) 到output_path的容器；
+    沒有ffmpeg或輸出為.ts時直接串接分段的位元組 (MPEG-TS可直接串接)，輸出改為.ts副檔名。
+    """
+    ffmpeg_path = find_ffmpeg(ffmpeg)
+    if ffmpeg_path and not output_path.endswith(".ts"):
+        with tempfile.NamedTemporaryFile('w', suffix=".txt", delete=False, encoding='utf-8') as f:
+            for path in segment_paths:
+                f.write("file '{}'\n".format(os.path.abspath(path).replace("'", "'\\''")))
+            list_path = f.name
+        try:
+            subprocess.run([ffmpeg_path, "-y", "-v", "error", "-f", "concat", "-safe", "0", "-i", list_path,
+                            "-c", "copy", output_path], check=True)
+        finally:
+            os.remove(list_path)
+        return output_path
+
+    output_path = os.path.splitext(output_path)[0] + ".ts"
+    with open(output_path, 'wb') as out:
+        for path in segment_paths:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, out)
+    return output_path
+
+
+class SegmentedVideoWriter:
+    """以固定長度的MPEG-TS分段寫入視頻，可取代cv2.VideoWriter (write/release/isOpened)
+
+    每段寫滿segment_seconds後立即關閉，並以原子寫入更新分段目錄中的manifest.json，
+    因此行程當機時已完成的分段仍然完整可播放 (進行中的分段也可解碼到當機前的位置)。
+    release時以concat_segments無損合併所有分段為最終檔案；當機後可用本模組的命令列
+    由分段目錄合併。start_frame讓平行或續跑的行程各自輸出分段，merge為False時release
+    只關閉最後一段並保留分段目錄，之後由merge_segment_dirs依起始幀合併。
+
+    MPEG-TS容器沒有fourcc對照表，OpenCV開啟每一段時都會印出 "tag ... is not supported
+    with codec id ... and format 'mpegts'"，之後改用編碼器本身的串流類型寫入，可忽略；
+    fourcc只用來選擇編碼器 (mp4v為MPEG-4 Part 2)。
+    """
+
+    def __init__(self, path, fps, size, fourcc="mp4v",
+                 segment_seconds=DEFAULT_SEGMENTED_OUTPUT_CONFIG["segment_seconds"],
+                 keep_segments=DEFAULT_SEGMENTED_OUTPUT_CONFIG["keep_segments"],
+                 ffmpeg=DEFAULT_SEGMENTED_OUTPUT_CONFIG["ffmpeg"], start_frame=0, merge=True):
+        self.path = path  # 最終輸出路徑 (沒有ffmpeg時合併後改為.ts)
+        self.fps = fps
+        self.size = tuple(size)
+        self.fourcc = fourcc
+        self.segment_frames = max(1, int(round(segment_seconds * fps)))
+        self.keep_segments = keep_segments
+        self.ffmpeg = ffmpeg
+        self.merge = merge
+        self.directory = segments_dir(path)
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.frame_idx = start_frame  # 下一幀的全域幀編號
+        self._writer = None
+        self._segment = None
+        self._closed = False
+        self.manifest = {
+            'output': os.path.abspath(path),
+            'fps': fps,
+            'size': list(self.size),
+            'fourcc': fourcc,
+            'segment_frames': self.segment_frames,
+            'start_frame': start_frame,
+            'segments': [],
+            'finalized': False
+        }
+        write_manifest(self.directory, self.manifest)
+
+    def isOpened(self):
+        return not self._closed
+
+    def _open_segment(self):
+        name = f"segment_{self.frame_idx:08d}.ts"
+        self._writer = cv2.VideoWriter(os.path.join(self.directory, name), cv2.VideoWriter_fourcc(*self.fourcc),
+                                       self.fps, self.size)
+        if not self._writer.isOpened():
+            raise RuntimeError(f"無法建立視頻分段: {name}")
+        # 進行中的分段先記錄在清單中 (complete為False)，當機後仍可選擇救回
+        self._segment = {'file': name, 'start_frame': self.frame_idx, 'frames': 0, 'complete': False}
+        self.manifest['segments'].append(self._segment)
+        write_manifest(self.directory, self.manifest)
+
+    def _close_segment(self):
+        if self._writer is None:
+            return
+        self._writer.release()
+        self._writer = None
+        self._segment['complete'] = True
+        self._segment = None
+        write_manifest(self.directory, self.manifest)
+
+    def write(self, frame):
+        if self._writer is None:
+            self._open_segment()
+        self._writer.write(frame)
+        self._segment['frames'] += 1
+        self.frame_idx += 1
+        if self._segment['frames'] >= self.segment_frames:
+            self._close_segment()
+
+    def release(self):
+        """關閉最後一段並合併為最終檔案 (重複呼叫不會重複合併；merge為False時保留分段目錄)"""
+        if self._closed:
+            return
+        self._closed = True
+        self._close_segment()
+        if not self.merge:
+            return
+        segments = [os.path.join(self.directory, segment['file']) for segment in self.manifest['segments']]
+        if not segments:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            return
+        self.path = concat_segments(segments, self.path, self.ffmpeg)
+        self.manifest['finalized'] = True
+        self.manifest['output'] = os.path.abspath(self.path)
+        write_manifest(self.directory, self.manifest)
+        if not self.keep_segments:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def open_video_writer(path, fps, size, config=None, start_frame=0, merge=True):
+    """依segmented_output配置建立分段寫入器或單一檔案的cv2.VideoWriter
+
+    start_frame和merge只用於分段寫入器 (見SegmentedVideoWriter)。
+    """
+    config = dict(DEFAULT_SEGMENTED_OUTPUT_CONFIG, **(config or {}))
+    if not config['enabled']:
+        return cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    return SegmentedVideoWriter(path, fps, size, segment_seconds=config['segment_seconds'],
+                                keep_segments=config['keep_segments'], ffmpeg=config['ffmpeg'],
+                                start_frame=start_frame, merge=merge)
+
+
+def count_frames(path):
+    """逐幀解碼計算可解碼的幀數 (未完成分段的幀數沒有記錄在清單中)"""
+    capture = cv2.VideoCapture(path)
+    count = 0
+    while capture.grab():
+        count += 1
+    capture.release()
+    return count
+
+
+def collect_segments(directories, include_partial=False):
+    """收集多個分段目錄中的分段，依起始幀排序並去除重疊，回傳 (分段路徑列表, 略過的分段說明)
+
+    未完成的分段 (當機時正在寫入) 預設略過；include_partial時一併合併 (只保留可解碼的部分)。
+    與前面分段重疊的分段 (例如續跑時重複輸出的幀) 整段略過。
+    """
+    segments = []
+    for directory in directories:
+        for segment in read_manifest(directory)['segments']:
+            path = os.path.join(directory, segment['file'])
+            if os.path.exists(path):
+                segments.append((segment['start_frame'], segment, path))
+    segments.sort(key=lambda item: item[0])
+
+    selected = []
+    skipped = []
+    next_frame = None
+    for start_frame, segment, path in segments:
+        if not segment['complete'] and not include_partial:
+            skipped.append(f"{path} (未完成)")
+            continue
+        if next_frame is not None and start_frame < next_frame:
+            skipped.append(f"{path} (與前面的分段重疊)")
+            continue
+        frames = segment['frames'] if segment['complete'] else count_frames(path)
+        if frames == 0:
+            continue
+        if next_frame is not None and start_frame > next_frame:
+            print(f"警告: 第 {next_frame} 到 {start_frame - 1} 幀沒有分段")
+        selected.append(path)
+        next_frame = start_frame + frames
+    return selected, skipped
+
+
+def merge_segment_dirs(directories, output_path, ffmpeg=DEFAULT_SEGMENTED_OUTPUT_CONFIG["ffmpeg"],
+                       include_partial=False, remove=False):
+    """依起始幀合併多個分段目錄 (平行或續跑的輸出) 為output_path，回傳 (實際輸出路徑, 略過的分段說明)
+
+    沒有可合併的分段時輸出路徑為None。
+    """
+    segments, skipped = collect_segments(directories, include_partial)
+    if not segments:
+        return None, skipped
+    output_path = concat_segments(segments, output_path, ffmpeg)
+    if remove:
+        for directory in directories:
+            shutil.rmtree(directory, ignore_errors=True)
+    return output_path, skipped
+
+
+def main():
+    """由一個或多個分段目錄 (當機、續跑或平行輸出) 無損合併出最終視頻"""
+    parser = argparse.ArgumentParser(description="分段視頻的無損合併")
+    parser.add_argument("directories", nargs="+", help="分段目錄 (包含manifest.json)")
+    parser.add_argument("--output", help="輸出路徑 (預設為第一個清單記錄的輸出路徑)")
+    parser.add_argument("--partial", action="store_true", help="一併合併當機時未完成的分段")
+    parser.add_argument("--ffmpeg", default=DEFAULT_SEGMENTED_OUTPUT_CONFIG["ffmpeg"], help="ffmpeg執行檔")
+    parser.add_argument("--remove", action="store_true", help="合併成功後刪除分段目錄")
+    args = parser.parse_args()
+
+    output_path = args.output or read_manifest(args.directories[0])['output']
+    output_path, skipped = merge_segment_dirs(args.directories, output_path, args.ffmpeg, args.partial, args.remove)
+    for item in skipped:
+        print(f"略過分段: {item}")
+    if output_path is None:
+        print("沒有可合併的分段")
+        return
+    print(f"已合併分段: {output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+from label_map import build_label_luts, blend_label_map, render_label_map
+from memory_monitor import MemoryMonitor, SessionHistory, DEFAULT_MEMORY_CONFIG
+from sam2_engine import SAM2FrameEngine
+from video_source import PrefetchFrameReader, source_frame_count
+
+
+def make_synthetic_video(path, frames, width, height, objects, fps=30):
+    """產生物件在畫面中移動的合成視頻，回傳每個物件在第一幀的框"""
+    rng = np.random.default_rng(0)
+    size = min(width, height) // 6
+    positions = rng.uniform([0, 0], [width - size, height - size], size=(objects, 2))
+    velocities = rng.uniform(-4, 4, size=(objects, 2))
+    colors = rng.integers(64, 255, size=(objects, 3))
+
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    boxes = []
+    for frame_idx in range(frames):
+        frame = np.full((height, width, 3), 40, dtype=np.uint8)
+        for i in range(objects):
+            x, y = positions[i]
+            cv2.rectangle(frame, (int(x), int(y)), (int(x) + size, int(y) + size), tuple(int(c) for c in colors[i]), -1)
+            if frame_idx == 0:
+                boxes.append([int(x), int(y), int(x) + size, int(y) + size])
+        writer.write(frame)
+        # 碰到邊界時反彈
+        positions += velocities
+        for axis, limit in ((0, width - size), (1, height - size)):
+            hit = (positions[:, axis] < 0) | (positions[:, axis] > limit)
+            velocities[hit, axis] *= -1
+            positions[:, axis] = np.clip(positions[:, axis], 0, limit)
+    writer.release()
+    return boxes
+
+
+def run_session(video_path, boxes, overrides, monitor):
+    """以GUI相同的流程 (追蹤、合成、轉為PIL影像) 處理整個視頻一次"""
+    engine = SAM2FrameEngine(overrides, num_frames=source_frame_count(video_path), source_name=video_path)
+    obj_ids = engine.add_objects(boxes, frame_idx=0)
+    colors, alphas = build_label_luts([((0, 0, 255), 0.5)] * len(obj_ids))
+    frame_idx = 0
+    annotated = None
+    for result in engine.track(PrefetchFrameReader(video_path)):
+        if annotated is None:
+            annotated = np.empty_like(result.orig_img)
+        blend_label_map(result.orig_img, result.label_map, colors, alphas, out=annotated)
+        render_label_map(result.label_map, colors, alphas, (35, 142, 107))
+        Image.fromarray(cv2.cvtColor(annotated, cv2.COLOR_BGR2RGB))
+        frame_idx = result.frame_idx
+        monitor.sample(frame_idx)
+    engine.close()
+    return frame_idx + 1
+
+
+def main():
+    """以合成視頻重複長時間追蹤，檢查逐幀和跨追蹤的記憶體增長"""
+    parser = argparse.ArgumentParser(description="SAM2追蹤記憶體浸泡測試")
+    parser.add_argument("--video", help="使用現有視頻 (需同時指定 --box)，預設產生合成視頻")
+    parser.add_argument("--box", action="append", default=[], help='框提示 "x1,y1,x2,y2" (可重複)')
+    parser.add_argument("--frames", type=int, default=600, help="合成視頻幀數")
+    parser.add_argument("--width", type=int, default=640, help="合成視頻寬度")
+    parser.add_argument("--height", type=int, default=480, help="合成視頻高度")
+    parser.add_argument("--objects", type=int, default=3, help="合成視頻物件數量")
+    parser.add_argument("--sessions", type=int, default=3, help="重複追蹤次數")
+    parser.add_argument("--interval", type=int, default=DEFAULT_MEMORY_CONFIG["sample_interval"], help="取樣間隔 (幀)")
+    parser.add_argument("--top", type=int, default=DEFAULT_MEMORY_CONFIG["tracemalloc_top"], help="報告的Python配置位置數量")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_MEMORY_CONFIG["growth_threshold_mb"], help="洩漏判定的增長閾值 (MB)")
+    parser.add_argument("--model", default="./models/sam2.1_t.pt", help="SAM2模型路徑")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="裝置")
+    parser.add_argument("--imgsz", type=int, default=1024, help="輸入尺寸")
+    parser.add_argument("--output", default="./output", help="報告輸出目錄")
+    args = parser.parse_args()
+
+    overrides = dict(conf=0.25, device=args.device, task="segment", mode="predict", imgsz=args.imgsz, model=args.model)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        video_path = args.video
+        boxes = [[int(float(v)) for v in box.split(',')] for box in args.box]
+        if video_path is None:
+            video_path = os.path.join(tmp_dir, "soak.mp4")
+            boxes = make_synthetic_video(video_path, args.frames, args.width, args.height, args.objects)
+        if not boxes:
+            print("請以 --box 指定至少一個框提示")
+            return 2
+
+        history = SessionHistory(args.threshold)
+        reports = []
+        leak = False
+        for session in range(args.sessions):
+            monitor = MemoryMonitor(args.interval, args.top, args.threshold)
+            monitor.start()
+            start = time.perf_counter()
+            frames = run_session(video_path, boxes, overrides, monitor)
+            report = monitor.stop(frames - 1)
+            report['session_end'] = history.record()
+            report['seconds'] = round(time.perf_counter() - start, 2)
+            reports.append(report)
+
+            print(f"第 {session + 1} 次追蹤: {frames} 幀, {report['seconds']:.1f} 秒")
+            print(MemoryMonitor.format(report))
+            leak |= any(result['leak'] for result in report['growth'].values())
+
+        cross_session = history.check()
+        for key, result in cross_session.items():
+            print(f"跨追蹤 {key}: 增長 {result['growth_mb']:.1f} MB, 單調比例 {result['monotonic_ratio']:.2f}")
+            if result['leak']:
+                print(f"疑似記憶體洩漏: {key} 在多次追蹤之間持續增長")
+                leak = True
+
+    os.makedirs(args.output, exist_ok=True)
+    report_path = os.path.join(args.output, f"soak_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump({'sessions': reports, 'cross_session': cross_session, 'leak': leak}, f, ensure_ascii=False, indent=2)
+    print(f"報告已儲存: {report_path}")
+    print("結果: 疑似記憶體洩漏" if leak else "結果: 未發現持續增長")
+    return 1 if leak else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
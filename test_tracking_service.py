@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+追蹤服務的本機測試: 以替身引擎取代SAM2，在臨時埠上走完TrackingClient的完整流程
+(提交、串流事件、查詢狀態)，以及模型載入失敗時的回報。
+
+    python -m pytest -q test_tracking_service.py
+    python test_tracking_service.py
+"""
+import os
+import shutil
+import tempfile
+import threading
+import types
+
+import cv2
+import numpy as np
+
+import tracking_service
+from mask_archive import MaskArchive
+from tracking_service import TrackingClient, TrackingService, make_server
+
+FRAMES = 6
+HEIGHT, WIDTH = 48, 64
+
+
+class StubEngine:
+    """與SAM2FrameEngine介面相同的替身: 每個框提示在框內產生固定的mask"""
+
+    def __init__(self, overrides, optimization=None):
+        self.overrides = overrides
+        self.boxes = []
+
+    def load_model(self):
+        if self.overrides.get('fail'):
+            raise RuntimeError("模型檔案不存在")
+
+    def reset(self, num_frames=None, source_name=None):
+        self.boxes = []
+
+    def add_objects(self, bboxes, frame_idx=0):
+        start = len(self.boxes)
+        self.boxes.extend(bboxes)
+        return list(range(start, len(self.boxes)))
+
+    def track(self, frames):
+        for frame_idx, frame in frames:
+            label_map = np.zeros(frame.shape[:2], dtype=np.uint8)
+            for label, (x1, y1, x2, y2) in enumerate(self.boxes, 1):
+                label_map[y1:y2, x1:x2] = label
+            yield types.SimpleNamespace(frame_idx=frame_idx, orig_img=frame, label_map=label_map)
+
+
+def run_service(overrides, work_dir):
+    """以替身引擎啟動服務和HTTP伺服器 (埠0由系統分配)，回傳 (service, server, client, 啟動錯誤)"""
+    tracking_service.SAM2FrameEngine = StubEngine
+    service = TrackingService(overrides, {'max_concurrent': 1, 'output_dir': os.path.join(work_dir, "output")},
+                              config_path=None)
+    start_error = None
+    try:
+        service.start()
+    except RuntimeError as e:
+        start_error = e
+    server = make_server(service, "127.0.0.1", 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return service, server, TrackingClient(f"http://127.0.0.1:{server.server_address[1]}"), start_error
+
+
+def make_sequence(work_dir):
+    """產生一個小的影像序列作為追蹤來源"""
+    sequence = os.path.join(work_dir, "frames")
+    os.makedirs(sequence)
+    for i in range(FRAMES):
+        cv2.imwrite(os.path.join(sequence, f"frame_{i}.png"), np.full((HEIGHT, WIDTH, 3), i * 20, dtype=np.uint8))
+    return sequence
+
+
+def test_round_trip():
+    work_dir = tempfile.mkdtemp()
+    original_engine = tracking_service.SAM2FrameEngine
+    service = server = None
+    try:
+        service, server, client, start_error = run_service({}, work_dir)
+        assert start_error is None and client.health()['status'] == 'ok'
+        job = client.submit(make_sequence(work_dir), [{'bbox': [4, 4, 20, 16], 'class': "Person"}])
+        events = list(client.events(job['id']))
+        frames = [event for event in events if event['type'] == 'frame']
+        assert [event['frame'] for event in frames] == list(range(FRAMES))
+        assert frames[0]['objects'] == [{'id': 0, 'class': "Person", 'box': [4, 4, 20, 16]}]
+        assert events[-1]['type'] == 'status' and events[-1]['status'] == tracking_service.DONE
+
+        status = client.status(job['id'])
+        assert status['status'] == tracking_service.DONE and status['frame'] == FRAMES
+        with MaskArchive(status['outputs']['archive']) as archive:
+            assert len(archive) == FRAMES and archive.read(0)[4:16, 4:20].all()
+    finally:
+        tracking_service.SAM2FrameEngine = original_engine
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        if service is not None:
+            service.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def test_load_failure():
+    work_dir = tempfile.mkdtemp()
+    original_engine = tracking_service.SAM2FrameEngine
+    service = server = None
+    try:
+        service, server, client, start_error = run_service({'fail': True}, work_dir)
+        assert start_error is not None and service.dead
+        try:
+            client.health()
+            assert False, "健康檢查應回傳錯誤"
+        except RuntimeError as e:
+            assert "模型檔案不存在" in str(e)
+
+        # 沒有可用的工作槽時，工作直接失敗而不是永遠排隊
+        job = client.submit(make_sequence(work_dir), [{'bbox': [4, 4, 20, 16], 'class': "Person"}])
+        assert job['status'] == tracking_service.FAILED
+        events = list(client.events(job['id']))
+        assert events[-1]['status'] == tracking_service.FAILED
+        assert client.status(job['id'])['status'] == tracking_service.FAILED
+    finally:
+        tracking_service.SAM2FrameEngine = original_engine
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        if service is not None:
+            service.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    test_round_trip()
+    print("✓ 提交、事件串流和狀態查詢")
+    test_load_failure()
+    print("✓ 模型載入失敗的回報")
@@ -0,0 +1,344 @@
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+# 預設的文字嵌入快取目錄
+DEFAULT_CACHE_DIR = "./cache/text_pe"
+
+# 查找索引的每筆記錄: 鍵 (類別字串SHA256的前8個位元組) 和行號，依鍵排序
+INDEX_DTYPE = np.dtype([('key', '<u8'), ('row', '<u8')])
+DIGEST_SIZE = 32
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    """計算檔案的SHA256雜湊值"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def name_digest(name):
+    """類別字串的SHA256 (32個位元組)，前8個位元組作為查找索引的鍵"""
+    return hashlib.sha256(name.encode('utf-8')).digest()
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """跨程序的獨占檔案鎖 (多個程序同時追加同一個快取時依序進行)"""
+    with open(path, 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def replace_file(path, data):
+    """寫入同目錄的臨時檔案後以原子替換的方式覆寫 (讀取端只會看到完整的舊檔或新檔)"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class TextEmbeddingCache:
+    """YOLOE文字提示嵌入的持久化快取
+
+    以模型檔案雜湊與類別字串作為鍵，嵌入向量以追加方式寫入單一float32檔案。
+    查找索引是依鍵排序的固定寬度記錄，透過記憶體映射以二分搜尋查找，啟動時不解析
+    整個索引，啟動時間不隨詞彙量增長；只有新的類別名稱才需要經過文字編碼器。
+
+    檔案 (每個模型一個目錄):
+        meta.json       模型和嵌入維度
+        embeddings.f32  (count, dim) float32，依追加順序
+        digests.bin     每行類別字串的完整SHA256 (驗證查找結果)
+        index.bin       依鍵排序的 (鍵, 行號)，記錄數即為已提交的行數
+        names.txt       每行的類別字串 (方便人工檢查)
+
+    追加時持有檔案鎖，先寫入資料，最後以原子替換index.bin提交，中途中斷時
+    已提交的部分不受影響。
+    """
+
+    def __init__(self, model_path, cache_dir=DEFAULT_CACHE_DIR):
+        self.model_path = model_path
+        self.cache_dir = cache_dir
+        self.model_hash = self._model_hash(model_path)
+
+        # 每個模型檔案擁有獨立的快取目錄
+        self.store_dir = os.path.join(cache_dir, self.model_hash[:16])
+        self.meta_path = os.path.join(self.store_dir, "meta.json")
+        self.index_path = os.path.join(self.store_dir, "index.bin")
+        self.digests_path = os.path.join(self.store_dir, "digests.bin")
+        self.data_path = os.path.join(self.store_dir, "embeddings.f32")
+        self.names_path = os.path.join(self.store_dir, "names.txt")
+        self.lock_path = os.path.join(self.store_dir, "lock")
+        self.dim = self._load_meta()
+
+    def _model_hash(self, model_path):
+        """取得模型檔案雜湊 (以路徑、大小和修改時間快取，避免每次啟動重新讀取整個檔案)"""
+        stat = os.stat(model_path)
+        stamp = f"{os.path.abspath(model_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+        hashes_path = os.path.join(self.cache_dir, "model_hashes.json")
+
+        hashes = {}
+        if os.path.exists(hashes_path):
+            try:
+                with open(hashes_path, 'r', encoding='utf-8') as f:
+                    hashes = json.load(f)
+            except Exception as e:
+                print(f"讀取模型雜湊快取時出錯: {e}")
+                hashes = {}
+
+        if stamp in hashes:
+            return hashes[stamp]
+
+        model_hash = file_sha256(model_path)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with file_lock(hashes_path + ".lock"):
+            # 重新讀取，保留其他程序同時寫入的項目
+            if os.path.exists(hashes_path):
+                try:
+                    with open(hashes_path, 'r', encoding='utf-8') as f:
+                        hashes = json.load(f)
+                except Exception:
+                    hashes = {}
+            hashes[stamp] = model_hash
+            self._write_json(hashes_path, hashes)
+        return model_hash
+
+    def _load_meta(self):
+        """讀取嵌入維度 (尚未有快取或與模型雜湊不符時為None)"""
+        if os.path.exists(self.meta_path):
+            try:
+                with open(self.meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                if meta.get('model_sha256') == self.model_hash:
+                    return meta.get('dim')
+                print(f"快取與模型雜湊不符，將重新建立: {self.store_dir}")
+            except Exception as e:
+                print(f"讀取文字嵌入快取時出錯: {e}")
+        return None
+
+    @staticmethod
+    def _write_json(path, data):
+        """以原子替換的方式寫入JSON檔案"""
+        replace_file(path, json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8'))
+
+    def _committed(self):
+        """已提交的行數 (index.bin的記錄數)"""
+        if self.dim is None or not os.path.exists(self.index_path):
+            return 0
+        return os.path.getsize(self.index_path) // INDEX_DTYPE.itemsize
+
+    def _open_index(self):
+        """記憶體映射查找索引和完整雜湊，回傳 (index, digests)，沒有快取時回傳 (None, None)"""
+        count = self._committed()
+        if count == 0:
+            return None, None
+        index = np.memmap(self.index_path, dtype=INDEX_DTYPE, mode='r', shape=(count,))
+        digests = np.memmap(self.digests_path, dtype=np.uint8, mode='r', shape=(count, DIGEST_SIZE))
+        return index, digests
+
+    @staticmethod
+    def _find(index, digests, digest):
+        """在排序的索引中二分搜尋類別字串的行號 (找不到時回傳None)"""
+        if index is None:
+            return None
+        key = int.from_bytes(digest[:8], 'little')
+        keys = index['key']
+        i = int(np.searchsorted(keys, np.uint64(key)))
+        # 鍵只取雜湊的前8個位元組，以完整雜湊確認 (相同的鍵依序比對)
+        while i < len(index) and int(keys[i]) == key:
+            row = int(index['row'][i])
+            if digests[row].tobytes() == digest:
+                return row
+            i += 1
+        return None
+
+    def rows(self, names):
+        """回傳每個類別的行號 (未快取的為None)"""
+        index, digests = self._open_index()
+        return [self._find(index, digests, name_digest(name)) for name in names]
+
+    def __len__(self):
+        return self._committed()
+
+    def __contains__(self, name):
+        return self.rows([name])[0] is not None
+
+    def missing(self, names):
+        """回傳尚未快取的類別名稱 (保持順序並去除重複)"""
+        seen = set()
+        result = []
+        for name, row in zip(names, self.rows(names)):
+            if row is None and name not in seen:
+                seen.add(name)
+                result.append(name)
+        return result
+
+    def load(self, names):
+        """以記憶體映射讀取已快取類別的嵌入，回傳 (N, D) 的numpy陣列"""
+        rows = self.rows(names)
+        missing = [name for name, row in zip(names, rows) if row is None]
+        if missing:
+            raise KeyError(f"以下類別尚未快取: {missing}")
+
+        if not names:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+
+        # 只映射檔案，實際讀取的僅有需要的行，啟動時間不隨詞彙量增長
+        table = np.memmap(self.data_path, dtype=np.float32, mode='r', shape=(self._committed(), self.dim))
+        embeddings = np.array(table[rows])
+        del table
+        return embeddings
+
+    def add(self, names, embeddings):
+        """追加新的類別嵌入到快取檔案 (已由其他程序加入的類別略過)"""
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(len(names), -1)
+        os.makedirs(self.store_dir, exist_ok=True)
+
+        with file_lock(self.lock_path):
+            # 持有鎖後重新讀取，其他程序可能已追加資料或建立快取
+            self.dim = self._load_meta()
+            if self.dim is None:
+                # 新快取 (或模型不符的舊快取): 從頭建立
+                self.dim = int(embeddings.shape[1])
+                for path in (self.index_path, self.digests_path, self.data_path, self.names_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self._write_json(self.meta_path, {
+                    'model': os.path.basename(self.model_path),
+                    'model_sha256': self.model_hash,
+                    'dim': self.dim
+                })
+            elif embeddings.shape[1] != self.dim:
+                raise ValueError(f"嵌入維度不一致: {embeddings.shape[1]} != {self.dim}")
+
+            index, digests = self._open_index()
+            count = 0 if index is None else len(index)
+            new_rows, new_digests, new_names = [], [], []
+            seen = set()
+            for name, embedding in zip(names, embeddings):
+                digest = name_digest(name)
+                if digest in seen or self._find(index, digests, digest) is not None:
+                    continue
+                seen.add(digest)
+                new_rows.append(embedding)
+                new_digests.append(digest)
+                new_names.append(name)
+            if not new_rows:
+                return
+
+            # 丟棄上次未完成寫入時殘留在檔案尾端的資料，再追加
+            row_bytes = self.dim * 4
+            for path, size, data in ((self.data_path, count * row_bytes, np.stack(new_rows).tobytes()),
+                                     (self.digests_path, count * DIGEST_SIZE, b''.join(new_digests))):
+                with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+                    f.truncate(size)
+                    f.seek(0, os.SEEK_END)
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            # 合併新的鍵並以原子替換提交索引
+            added = np.zeros(len(new_digests), dtype=INDEX_DTYPE)
+            added['key'] = [int.from_bytes(digest[:8], 'little') for digest in new_digests]
+            added['row'] = np.arange(count, count + len(new_digests))
+            merged = added if index is None else np.concatenate([np.array(index), added])
+            merged = merged[np.argsort(merged['key'], kind='stable')]
+            del index, digests
+            replace_file(self.index_path, merged.tobytes())
+
+            with open(self.names_path, 'a', encoding='utf-8') as f:
+                f.writelines(name.replace('\n', ' ') + '\n' for name in new_names)
+
+    def encode_missing(self, model, names, batch=80):
+        """只對尚未快取的類別執行文字編碼器，回傳新編碼的數量"""
+        missing = self.missing(names)
+        for start in range(0, len(missing), batch):
+            chunk = missing[start:start + batch]
+            pe = model.get_text_pe(chunk)  # (1, N, D)
+            self.add(chunk, pe.detach().float().cpu().numpy()[0])
+        return len(missing)
+
+    def get_text_pe(self, model, names):
+        """取得類別的文字嵌入，格式與 model.get_text_pe(names) 相同 (1, N, D)"""
+        import torch
+
+        encoded = self.encode_missing(model, names)
+        if encoded:
+            print(f"已編碼 {encoded} 個新類別的文字嵌入 (快取共 {len(self)} 個)")
+
+        embeddings = torch.from_numpy(self.load(names)).unsqueeze(0)
+        device = next(model.model.parameters()).device
+        return embeddings.to(device)
+
+
+def read_names_file(path):
+    """讀取類別名稱檔案 (每行一個類別，忽略空行和#開頭的註解)"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+
+
+def main():
+    """批量預先計算文字嵌入"""
+    parser = argparse.ArgumentParser(description="預先計算YOLOE文字提示嵌入並寫入快取")
+    parser.add_argument("--model", default="./models/yoloe-26x-seg.pt", help="YOLOE模型路徑")
+    parser.add_argument("--names", nargs="*", default=[], help="類別名稱")
+    parser.add_argument("--names-file", help="類別名稱檔案 (每行一個類別)")
+    parser.add_argument("--config", help="從sam2_config.json讀取classes")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="快取目錄")
+    parser.add_argument("--batch", type=int, default=80, help="每批編碼的類別數量")
+    args = parser.parse_args()
+
+    names = list(args.names)
+    if args.names_file:
+        names += read_names_file(args.names_file)
+    if args.config:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            names += json.load(f).get('classes', [])
+
+    if not names:
+        print("未指定任何類別名稱")
+        return
+
+    from ultralytics import YOLO
+
+    cache = TextEmbeddingCache(args.model, cache_dir=args.cache_dir)
+    missing = cache.missing(names)
+    print(f"共 {len(names)} 個類別，其中 {len(missing)} 個需要編碼")
+    if missing:
+        model = YOLO(args.model)
+        cache.encode_missing(model, missing, batch=args.batch)
+    print(f"快取已更新: {cache.store_dir} (共 {len(cache)} 個類別)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+import json
+
+import numpy as np
+import torch
+
+from mask_archive import label_map_boxes
+from yoloe_auto_prompt import box_iou_matrix
+
+
+# 追蹤健康監測的預設配置 (可在sam2_config.json的"track_health"區段覆寫)
+DEFAULT_TRACK_HEALTH_CONFIG = {
+    "enabled": False,
+    "area_ratio": 3.0,  # 面積縮小或放大超過此倍數 (相對於健康時的平均面積) 視為異常
+    "min_area": 16,  # 面積低於此像素數視為物件遺失
+    "min_confidence": 0.6,  # mask前景的平均機率低於此值視為異常
+    "confidence_drop": 0.2,  # 平均機率比健康時的平均低超過此值視為異常
+    "box_jump": 0.5,  # 框中心相對上一個健康框的位移超過其對角線長度的此比例視為異常
+    "smoothing": 0.2,  # 健康時面積和機率平均值的更新比例 (指數移動平均)
+    "patience": 2,  # 連續異常達到此幀數才重新提示
+    "cooldown": 15,  # 重新提示後至少經過此幀數才會再次重新提示同一物件
+    "reseed": "box",  # 重新提示的來源: "box" (最後的健康框)、"yoloe" (同類別的YOLOE偵測，找不到時用最後的健康框)、"off" (只記錄)
+    "yoloe_min_iou": 0.1  # YOLOE偵測框與最後的健康框IoU達到此值才採用
+}
+
+
+def mask_confidence(result):
+    """每個物件mask前景的平均機率 (在裝置上計算，只傳回N個數值)；沒有logits時回傳None"""
+    logits = result.logits
+    if logits is None or len(logits) == 0:
+        return None
+    with torch.inference_mode():
+        logits = logits.float()
+        foreground = logits > result.mask_threshold
+        probs = torch.sigmoid(logits) * foreground
+        count = foreground.sum(dim=(1, 2))
+        confidence = probs.sum(dim=(1, 2)) / count.clamp(min=1)
+        confidence = torch.where(count > 0, confidence, torch.full_like(confidence, float('nan')))
+    return confidence.cpu().numpy()
+
+
+def _smooth(average, value, alpha):
+    return value if average is None else (1 - alpha) * average + alpha * value
+
+
+def box_center_jump(box, reference):
+    """框中心相對reference框的位移 (以reference的對角線長度為單位)"""
+    center = np.array([box[0] + box[2], box[1] + box[3]]) / 2
+    ref_center = np.array([reference[0] + reference[2], reference[1] + reference[3]]) / 2
+    diagonal = max(np.hypot(reference[2] - reference[0], reference[3] - reference[1]), 1.0)
+    return float(np.hypot(*(center - ref_center)) / diagonal)
+
+
+class TrackHealthMonitor:
+    """在追蹤迴圈中監測每個物件的健康狀態，追蹤退化時重新提示並記錄事件
+
+    每幀由標籤圖計算面積和框，由logits計算mask前景的平均機率，與物件健康時的平均值
+    和最後的健康框比較: 面積驟減 (或遺失)/驟增、機率下降、框中心跳動。連續patience幀
+    異常時，以最後的健康框 (或同類別的YOLOE偵測) 透過engine.correct取代該物件，
+    從這一幀重新傳播。所有事件 (degraded/recovered/reseeded) 記錄在events中供檢視。
+    """
+
+    def __init__(self, config=None, fps=None):
+        self.config = dict(DEFAULT_TRACK_HEALTH_CONFIG)
+        self.config.update(config or {})
+        self.fps = fps  # 事件時間 (秒) 的換算，None時只記錄幀編號
+        self.tracks = {}  # 物件編號 -> 狀態
+        self.events = []
+        self.frames = 0
+
+    def _state(self, obj_id):
+        if obj_id not in self.tracks:
+            self.tracks[obj_id] = {
+                'area': None,  # 健康時的平均面積
+                'confidence': None,  # 健康時的平均機率
+                'good_box': None,  # 最後的健康框
+                'good_frame': None,
+                'bad_frames': 0,
+                'reasons': [],
+                'cooldown_until': -1,
+                'origin': obj_id  # 重新提示前的原始物件編號
+            }
+        return self.tracks[obj_id]
+
+    def _log(self, event, frame_idx, obj_id, **fields):
+        entry = {'event': event, 'frame': int(frame_idx), 'obj_id': int(obj_id),
+                 'origin': int(self.tracks[obj_id]['origin'])}
+        if self.fps:
+            entry['time'] = round(frame_idx / self.fps, 3)
+        entry.update(fields)
+        self.events.append(entry)
+        return entry
+
+    def _reasons(self, state, area, confidence, box):
+        """與健康時的基準比較，回傳 (異常原因列表, 訊號)"""
+        config = self.config
+        signals = {'area': int(area)}
+        reasons = []
+        if area < config['min_area']:
+            if state['good_box'] is not None:
+                reasons.append('lost')
+        elif state['area']:
+            ratio = area / state['area']
+            signals['area_ratio'] = round(float(ratio), 3)
+            if ratio < 1 / config['area_ratio']:
+                reasons.append('area_collapse')
+            elif ratio > config['area_ratio']:
+                reasons.append('area_explosion')
+        if confidence is not None and not np.isnan(confidence):
+            signals['confidence'] = round(float(confidence), 4)
+            if confidence < config['min_confidence']:
+                reasons.append('low_confidence')
+            elif state['confidence'] is not None and state['confidence'] - confidence > config['confidence_drop']:
+                reasons.append('confidence_drop')
+        if box is not None and state['good_box'] is not None:
+            jump = box_center_jump(box, state['good_box'])
+            signals['box_jump'] = round(jump, 3)
+            if jump > config['box_jump']:
+                reasons.append('box_jump')
+        return reasons, signals
+
+    def observe(self, result):
+        """更新每個物件的健康狀態，回傳需要重新提示的 [(物件編號, 異常原因, 最後的健康框), ...]
+
+        面積和框由模型解析度的標籤圖計算，換算為原始畫面的像素和座標，不需要上採樣。
+        沿用前一幀mask的結果 (motion_gate) 不計入。
+        """
+        if not getattr(result, 'inferred', True) or not result.obj_ids:
+            return []
+        self.frames += 1
+        frame_idx = result.frame_idx
+        num_objects = len(result.obj_ids)
+        label_map = result.low_res_label_map
+        shape = result.orig_img.shape[:2]
+        pixel_area = shape[0] * shape[1] / label_map.size  # 標籤圖每個像素對應的原始畫面面積
+        areas = np.bincount(label_map.ravel(), minlength=num_objects + 1)[1:num_objects + 1] * pixel_area
+        boxes = label_map_boxes(label_map, num_objects, shape)
+        confidences = mask_confidence(result)
+        alpha = self.config['smoothing']
+
+        degraded = []
+        for i, obj_id in enumerate(result.obj_ids):
+            state = self._state(obj_id)
+            confidence = confidences[i] if confidences is not None else None
+            reasons, signals = self._reasons(state, areas[i], confidence, boxes[i])
+            if not reasons:
+                if state['bad_frames']:
+                    self._log('recovered', frame_idx, obj_id, bad_frames=state['bad_frames'])
+                state['bad_frames'] = 0
+                state['reasons'] = []
+                if areas[i] >= self.config['min_area']:
+                    state['area'] = _smooth(state['area'], float(areas[i]), alpha)
+                    if confidence is not None and not np.isnan(confidence):
+                        state['confidence'] = _smooth(state['confidence'], float(confidence), alpha)
+                    state['good_box'] = boxes[i]
+                    state['good_frame'] = frame_idx
+                continue
+
+            # 異常時不更新健康基準
+            if state['bad_frames'] == 0:
+                self._log('degraded', frame_idx, obj_id, reasons=reasons, signals=signals, box=boxes[i],
+                          last_good_frame=state['good_frame'], last_good_box=state['good_box'])
+            state['bad_frames'] += 1
+            state['reasons'] = sorted(set(state['reasons']) | set(reasons))
+            if (state['bad_frames'] >= self.config['patience'] and frame_idx >= state['cooldown_until']
+                    and state['good_box'] is not None):
+                degraded.append((obj_id, state['reasons'], state['good_box']))
+        return degraded
+
+    def choose_box(self, good_box, class_name, detections):
+        """重新提示的框: 同類別且與最後的健康框重疊最多的YOLOE偵測，沒有時使用最後的健康框"""
+        candidates = [d for d in detections or [] if d['class'] == class_name]
+        if candidates:
+            iou = box_iou_matrix([good_box], [d['bbox'] for d in candidates])[0]
+            best = int(iou.argmax())
+            if iou[best] >= self.config['yoloe_min_iou']:
+                return candidates[best]['bbox'], 'yoloe'
+        return good_box, 'last_good_box'
+
+    def check(self, engine, result, classes=None, detect=None):
+        """觀察一幀並重新提示退化的物件，回傳 (可能已修正的結果, [(舊編號, 新編號, 框, 來源), ...])
+
+        Args:
+            classes: {物件編號: 類別}，使用YOLOE重新提示時比對相同類別
+            detect: frame -> YOLOE偵測列表 (YOLOEAutoPrompter.detect)，只在有物件需要重新提示時呼叫
+        """
+        degraded = self.observe(result)
+        if not degraded or self.config['reseed'] == "off":
+            return result, []
+
+        detections = None
+        if self.config['reseed'] == "yoloe" and detect is not None:
+            try:
+                detections = detect(result.orig_img)
+            except Exception as e:
+                print(f"重新提示的YOLOE偵測失敗: {e}")
+        chosen = [self.choose_box(box, (classes or {}).get(obj_id), detections) for obj_id, _, box in degraded]
+
+        old_ids = [obj_id for obj_id, _, _ in degraded]
+        corrected, new_ids = engine.correct(result, [box for box, _ in chosen], replace_ids=old_ids)
+        reseeds = []
+        for (old_id, reasons, _), (box, source), new_id in zip(degraded, chosen, new_ids):
+            self._log('reseeded', result.frame_idx, old_id, new_obj_id=int(new_id), reasons=reasons,
+                      box=[int(v) for v in box], source=source, bad_frames=self.tracks[old_id]['bad_frames'])
+            old_state = self.tracks.pop(old_id)
+            # 新物件沿用舊物件的健康基準，避免重新提示後立刻被判定為異常
+            self._state(new_id).update(area=old_state['area'], confidence=old_state['confidence'],
+                                       good_box=list(box), good_frame=result.frame_idx, origin=old_state['origin'],
+                                       cooldown_until=result.frame_idx + self.config['cooldown'])
+            reseeds.append((old_id, new_id, box, source))
+        return corrected, reseeds
+
+    def summary(self):
+        counts = {}
+        for event in self.events:
+            counts[event['event']] = counts.get(event['event'], 0) + 1
+        return {'frames': self.frames, 'counts': counts, 'events': self.events, 'config': self.config}
+
+    def format(self):
+        counts = self.summary()['counts']
+        return (f"追蹤健康: 監測 {self.frames} 幀, 退化 {counts.get('degraded', 0)} 次, "
+                f"自行恢復 {counts.get('recovered', 0)} 次, 重新提示 {counts.get('reseeded', 0)} 次")
+
+    def write_log(self, path):
+        """寫入事件記錄 (JSON)，每個事件包含幀編號 (和時間) 供檢視時直接跳到該幀"""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, ensure_ascii=False, indent=2)
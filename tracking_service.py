@@ -0,0 +1,648 @@
+import argparse
+import collections
+import itertools
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import torch
+
+from encoder_lookahead import DEFAULT_ENCODER_LOOKAHEAD_CONFIG, EncoderLookahead, lookahead_track, use_lookahead
+from label_map import blend_label_map, render_label_map
+from machine_profile import apply_machine_profile, load_machine_profile
+from mask_archive import MaskArchiveWriter, label_map_boxes
+from mask_postprocess import DEFAULT_MASK_POSTPROCESS_CONFIG, MaskPostprocessor
+from sam2_engine import SAM2FrameEngine
+from segmented_writer import open_video_writer
+from sharded_tracking import class_luts, load_style, sam2_overrides
+from video_source import DEFAULT_FRAME_SOURCE_CONFIG, PrefetchFrameReader, source_fps, source_frame_count
+
+
+# 追蹤服務的預設配置 (可在sam2_config.json的"service"區段覆寫)
+DEFAULT_SERVICE_CONFIG = {
+    "host": "127.0.0.1",  # 只監聽本機
+    "port": 8765,
+    "max_concurrent": 1,  # 同時執行的追蹤工作數量 (每個工作槽保留一份常駐的模型)
+    "max_queue": 32,  # 排隊中的工作上限，超過時拒絕新工作
+    "event_buffer": 2000,  # 每個工作保留的最近事件數量 (供晚連線的客戶端補讀)
+    "output_dir": "./output"
+}
+
+# 工作狀態
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+class TrackingJob:
+    """一個追蹤工作: 請求內容、進度和依序編號的事件 (狀態變更與逐幀結果)"""
+
+    def __init__(self, job_id, request, event_buffer=DEFAULT_SERVICE_CONFIG["event_buffer"]):
+        self.id = job_id
+        self.request = request
+        self.status = QUEUED
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.frame = 0  # 已處理的幀數
+        self.total = None  # 總幀數 (無法取得時為None)
+        self.fps = 0.0
+        self.outputs = {}
+        self.error = None
+        self.cancel_event = threading.Event()
+        self._events = collections.deque(maxlen=event_buffer)
+        self._next_seq = 0
+        self._condition = threading.Condition()
+
+    @property
+    def finished_state(self):
+        return self.status in FINISHED_STATES
+
+    def emit(self, event_type, **data):
+        """加入一個事件並喚醒等待中的事件串流"""
+        with self._condition:
+            event = {'seq': self._next_seq, 'type': event_type, 'job': self.id, **data}
+            self._next_seq += 1
+            self._events.append(event)
+            self._condition.notify_all()
+
+    def set_status(self, status, **data):
+        self.status = status
+        if status == RUNNING:
+            self.started = time.time()
+        elif status in FINISHED_STATES:
+            self.finished = time.time()
+        self.emit('status', status=status, **data)
+
+    def events_since(self, seq, timeout=1.0):
+        """回傳編號 >= seq 的事件，沒有新事件時最多等待timeout秒"""
+        with self._condition:
+            if self._next_seq <= seq and not self.finished_state:
+                self._condition.wait(timeout)
+            return [event for event in self._events if event['seq'] >= seq]
+
+    def snapshot(self):
+        """可序列化為JSON的工作狀態"""
+        return {
+            'id': self.id,
+            'status': self.status,
+            'video': self.request['video'],
+            'objects': len(self.request['prompts']),
+            'frame': self.frame,
+            'total': self.total,
+            'fps': round(self.fps, 3),
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'outputs': self.outputs,
+            'error': self.error
+        }
+
+
+def validate_request(request, frame_source_config):
+    """檢查並補齊追蹤工作請求，格式錯誤時拋出ValueError"""
+    if not isinstance(request, dict):
+        raise ValueError("請求必須是JSON物件")
+    video = request.get('video')
+    if not video or not os.path.exists(video):
+        raise ValueError(f"找不到視頻或影像序列: {video}")
+    prompts = []
+    for prompt in request.get('prompts') or []:
+        bbox = prompt.get('bbox') if isinstance(prompt, dict) else None
+        if not isinstance(bbox, (list, tuple)) or len(bbox) != 4:
+            raise ValueError(f"框提示格式錯誤: {prompt}")
+        prompts.append({'bbox': [int(float(v)) for v in bbox], 'class': prompt.get('class') or "Unknown"})
+    if not prompts:
+        raise ValueError("至少需要一個框提示")
+    max_side = request.get('max_side')
+    return {
+        'video': os.path.abspath(video),
+        'prompts': prompts,
+        'save_video': bool(request.get('save_video')),
+        'save_masks_only': bool(request.get('save_masks_only')),
+        'frame_events': bool(request.get('frame_events', True)),  # 是否串流逐幀的物件框
+        'max_side': int(max_side if max_side is not None else frame_source_config['max_side'])
+    }
+
+
+class TrackingService:
+    """保持SAM2模型常駐的追蹤服務
+
+    工作依提交順序排隊，由max_concurrent個工作槽執行緒處理。每個工作槽在服務啟動時
+    載入一份模型並在之後的所有工作中重複使用 (SAM2FrameEngine.reset)，客戶端不需要
+    各自載入模型，也沒有冷啟動。
+    """
+
+    def __init__(self, overrides, config=None, optimization=None, frame_source_config=None,
+                 config_path="./sam2_config.json", segmented_output_config=None, encoder_lookahead_config=None,
+                 mask_postprocess_config=None):
+        self.overrides = dict(overrides)
+        self.config = dict(DEFAULT_SERVICE_CONFIG)
+        self.config.update(config or {})
+        self.optimization = optimization
+        self.frame_source_config = dict(DEFAULT_FRAME_SOURCE_CONFIG)
+        self.frame_source_config.update(frame_source_config or {})
+        self.config_path = config_path  # 類別顏色在每個工作開始時讀取
+        self.segmented_output_config = segmented_output_config  # 輸出視頻的分段寫入配置
+        self.encoder_lookahead_config = dict(DEFAULT_ENCODER_LOOKAHEAD_CONFIG)  # 圖像編碼器批次預讀配置
+        self.encoder_lookahead_config.update(encoder_lookahead_config or {})
+        self.mask_postprocess_config = dict(DEFAULT_MASK_POSTPROCESS_CONFIG)  # 輸出mask後處理配置
+        self.mask_postprocess_config.update(mask_postprocess_config or {})
+
+        self.jobs = {}
+        self._order = []
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._workers = []
+        self.warm_slots = 0
+        self.slot_errors = {}  # 工作槽 -> 模型載入失敗的錯誤訊息
+
+    @property
+    def dead(self):
+        """已啟動但沒有任何工作槽成功載入模型 (排隊的工作不會被執行)"""
+        return bool(self._workers) and self.warm_slots == 0
+
+    def start(self):
+        """啟動工作槽執行緒，並等待模型全部載入完成；沒有任何工作槽載入成功時拋出RuntimeError"""
+        ready = threading.Barrier(self.config['max_concurrent'] + 1)
+        for slot in range(self.config['max_concurrent']):
+            worker = threading.Thread(target=self._worker, args=(slot, ready), daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        ready.wait()
+        if self.dead:
+            error = self.load_error()
+            with self._lock:
+                queued = [job for job in self.jobs.values() if job.status == QUEUED]
+            for job in queued:
+                self._fail(job, error)
+            raise RuntimeError(error)
+
+    def load_error(self):
+        """模型載入失敗的說明 (沒有失敗時為None)"""
+        if not self.slot_errors:
+            return None
+        details = "; ".join(f"工作槽 {slot}: {error}" for slot, error in sorted(self.slot_errors.items()))
+        return f"{len(self.slot_errors)}/{self.config['max_concurrent']} 個工作槽模型載入失敗 ({details})"
+
+    def _fail(self, job, error):
+        job.error = error
+        job.set_status(FAILED, error=error)
+
+    def stop(self):
+        """取消所有未完成的工作並結束工作槽"""
+        for job in list(self.jobs.values()):
+            job.cancel_event.set()
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def submit(self, request):
+        """加入工作佇列，回傳TrackingJob；請求無效時拋出ValueError，佇列已滿時拋出OverflowError"""
+        request = validate_request(request, self.frame_source_config)
+        with self._lock:
+            queued = sum(1 for job in self.jobs.values() if job.status == QUEUED)
+            if queued >= self.config['max_queue']:
+                raise OverflowError(f"工作佇列已滿 ({queued} 個工作排隊中)")
+            job = TrackingJob(f"job{next(self._ids)}", request, self.config['event_buffer'])
+            self.jobs[job.id] = job
+            self._order.append(job.id)
+        if self.dead:
+            # 沒有可執行工作的工作槽，直接標記為失敗而不是永遠排隊
+            self._fail(job, self.load_error())
+            return job
+        job.set_status(QUEUED, position=self.queue_position(job.id))
+        self._queue.put(job.id)
+        return job
+
+    def queue_position(self, job_id):
+        """排隊中的工作前面還有幾個排隊中的工作 (非排隊狀態回傳None)"""
+        with self._lock:
+            if self.jobs[job_id].status != QUEUED:
+                return None
+            queued = [jid for jid in self._order if self.jobs[jid].status == QUEUED]
+        return queued.index(job_id)
+
+    def cancel(self, job_id):
+        """取消工作 (排隊中的工作直接取消，執行中的工作在下一幀停止)"""
+        job = self.jobs[job_id]
+        job.cancel_event.set()
+        with self._lock:
+            if job.status == QUEUED:
+                job.set_status(CANCELLED)
+        return job
+
+    def list_jobs(self):
+        with self._lock:
+            jobs = [self.jobs[jid] for jid in self._order]
+        snapshots = []
+        for job in jobs:
+            snapshot = job.snapshot()
+            snapshot['position'] = self.queue_position(job.id)
+            snapshots.append(snapshot)
+        return snapshots
+
+    def health(self):
+        with self._lock:
+            counts = collections.Counter(job.status for job in self.jobs.values())
+        if self.dead:
+            status = 'error'
+        elif self.slot_errors:
+            status = 'degraded'
+        else:
+            status = 'ok'
+        health = {
+            'status': status,
+            'warm_slots': self.warm_slots,
+            'max_concurrent': self.config['max_concurrent'],
+            'jobs': dict(counts),
+            'device': str(self.overrides.get('device'))
+        }
+        if self.slot_errors:
+            health['error'] = self.load_error()
+        return health
+
+    def _worker(self, slot, ready):
+        try:
+            engine = SAM2FrameEngine(self.overrides, optimization=self.optimization)
+            engine.load_model()
+        except Exception as e:
+            # 記錄錯誤後結束這個工作槽，由start和health回報
+            with self._lock:
+                self.slot_errors[slot] = str(e) or type(e).__name__
+            print(f"工作槽 {slot}: 模型載入失敗: {e}")
+            ready.wait()
+            return
+        with self._lock:
+            self.warm_slots += 1
+        print(f"工作槽 {slot}: 模型已載入")
+        ready.wait()
+        while True:
+            job_id = self._queue.get()
+            if job_id is None:
+                break
+            job = self.jobs[job_id]
+            with self._lock:
+                if job.status != QUEUED:
+                    continue
+                job.status = RUNNING
+            job.set_status(RUNNING, slot=slot)
+            try:
+                self._run_job(engine, job)
+            except Exception as e:
+                job.error = str(e)
+                job.set_status(FAILED, error=job.error)
+                print(f"工作 {job.id} 失敗: {e}")
+            finally:
+                engine.reset()
+
+    def _run_job(self, engine, job):
+        """以常駐的引擎執行一個追蹤工作，輸出mask存檔和 (可選的) 視頻"""
+        request = job.request
+        video_path = request['video']
+        prompts = request['prompts']
+        classes = [prompt['class'] for prompt in prompts]
+        color_map, alpha_map = load_style(self.config_path)
+        colors, alphas = class_luts(classes, color_map, alpha_map)
+
+        output_dir = self.config['output_dir']
+        os.makedirs(output_dir, exist_ok=True)
+        timestamp = time.strftime("%Y%m%d_%H%M%S")
+        fps = source_fps(video_path, self.frame_source_config['sequence_fps'])
+        job.total = source_frame_count(video_path)
+
+        engine.reset(num_frames=job.total, source_name=video_path)
+        obj_ids = engine.add_objects([prompt['bbox'] for prompt in prompts], frame_idx=0)
+        frame_reader = PrefetchFrameReader(
+            video_path,
+            prefetch=self.frame_source_config['prefetch'],
+            workers=self.frame_source_config['decode_workers'],
+            max_side=request['max_side']
+        )
+
+        writer = video_writer = mask_video_writer = None
+        composite = None  # 混合結果的緩衝區 (解碼的幀為唯讀，不原地修改)
+        if use_lookahead(self.encoder_lookahead_config, engine):
+            lookahead = EncoderLookahead(self.encoder_lookahead_config['batch_size'],
+                                         self.encoder_lookahead_config['buffer'])
+            results = lookahead_track(engine, frame_reader, lookahead)
+        else:
+            results = engine.track(frame_reader)
+        # 輸出mask後處理在工作執行緒池中與追蹤並行，依幀順序寫入
+        postprocessor = None
+        if self.mask_postprocess_config['enabled']:
+            postprocessor = MaskPostprocessor(self.mask_postprocess_config)
+
+        def write_outputs(result, label_map):
+            nonlocal composite
+            writer.write(result.frame_idx, label_map)
+            if mask_video_writer is not None:
+                background_color = (35, 142, 107)  # 與GUI的Mask視頻相同的背景色 (BGR)
+                mask_video_writer.write(render_label_map(label_map, colors, alphas, background_color))
+            if video_writer is not None:
+                if composite is None:
+                    composite = np.empty_like(result.orig_img)
+                video_writer.write(blend_label_map(result.orig_img, label_map, colors, alphas, out=composite))
+
+            job.frame = result.frame_idx + 1
+            job.fps = job.frame / max(time.perf_counter() - start_time, 1e-6)
+            if request['frame_events']:
+                boxes = label_map_boxes(label_map, len(obj_ids))
+                job.emit('frame', frame=result.frame_idx, total=job.total, fps=round(job.fps, 3),
+                         objects=[{'id': obj_id, 'class': cls, 'box': box}
+                                  for obj_id, cls, box in zip(obj_ids, classes, boxes)])
+
+        start_time = time.perf_counter()
+        try:
+            for result in results:
+                if job.cancel_event.is_set():
+                    break
+                label_map = result.label_map
+                if writer is None:
+                    height, width = label_map.shape
+                    job.outputs['archive'] = os.path.join(output_dir, f"masks_{job.id}_{timestamp}")
+                    writer = MaskArchiveWriter(job.outputs['archive'], height, width, obj_ids=obj_ids,
+                                               dtype=label_map.dtype,
+                                               meta={'video': video_path, 'fps': fps,
+                                                     'classes': {str(i): cls for i, cls in zip(obj_ids, classes)}})
+                    if request['save_video']:
+                        job.outputs['video'] = os.path.join(output_dir, f"tracking_result_{job.id}_{timestamp}.mp4")
+                        video_writer = open_video_writer(job.outputs['video'], fps, (width, height),
+                                                         self.segmented_output_config)
+                    if request['save_masks_only']:
+                        job.outputs['mask_video'] = os.path.join(output_dir, f"mask_result_{job.id}_{timestamp}.mp4")
+                        mask_video_writer = open_video_writer(job.outputs['mask_video'], fps, (width, height),
+                                                              self.segmented_output_config)
+
+                if postprocessor is None:
+                    write_outputs(result, label_map)
+                else:
+                    for done, done_map in postprocessor.submit(result, label_map, classes):
+                        write_outputs(done, done_map)
+            if postprocessor is not None:
+                for done, done_map in postprocessor.drain():
+                    write_outputs(done, done_map)
+                print(f"工作 {job.id} {postprocessor.format()}")
+        finally:
+            results.close()  # 取消時停止預讀的執行緒
+            if postprocessor is not None:
+                postprocessor.close()
+            if writer is not None:
+                writer.close()
+            # 分段合併後的實際路徑 (沒有ffmpeg時為.ts)
+            if video_writer is not None:
+                video_writer.release()
+                job.outputs['video'] = getattr(video_writer, 'path', job.outputs['video'])
+            if mask_video_writer is not None:
+                mask_video_writer.release()
+                job.outputs['mask_video'] = getattr(mask_video_writer, 'path', job.outputs['mask_video'])
+
+        if job.cancel_event.is_set():
+            job.set_status(CANCELLED, frame=job.frame)
+        else:
+            job.set_status(DONE, frame=job.frame, fps=round(job.fps, 3), outputs=job.outputs)
+        print(f"工作 {job.id} {job.status}: {job.frame} 幀, {job.fps:.2f} FPS")
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """追蹤服務的HTTP介面
+
+    GET    /health              服務狀態 (沒有工作槽成功載入模型時回傳503)
+    GET    /jobs                所有工作
+    POST   /jobs                提交工作 (JSON: video, prompts, save_video, save_masks_only, max_side)
+    GET    /jobs/<id>           工作狀態
+    GET    /jobs/<id>/events    以NDJSON串流事件直到工作結束 (?since=<seq> 從指定事件開始)
+    DELETE /jobs/<id>           取消工作
+    """
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def log_message(self, format, *args):
+        pass  # 事件串流和輪詢很頻繁，不逐一輸出存取紀錄
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self):
+        """解析路徑，回傳 (工作, 子路徑)；找不到工作時回傳 (None, None) 並已送出404"""
+        parts = [part for part in urlparse(self.path).path.split('/') if part]
+        if len(parts) < 2 or parts[0] != 'jobs':
+            self._send_json({'error': '找不到路徑'}, 404)
+            return None, None
+        job = self.service.jobs.get(parts[1])
+        if job is None:
+            self._send_json({'error': f"找不到工作: {parts[1]}"}, 404)
+            return None, None
+        return job, parts[2] if len(parts) > 2 else None
+
+    def do_GET(self):
+        path = urlparse(self.path).path.rstrip('/')
+        if path == '/health':
+            health = self.service.health()
+            self._send_json(health, 503 if health['status'] == 'error' else 200)
+            return
+        if path == '/jobs':
+            self._send_json({'jobs': self.service.list_jobs()})
+            return
+        job, sub = self._route()
+        if job is None:
+            return
+        if sub is None:
+            snapshot = job.snapshot()
+            snapshot['position'] = self.service.queue_position(job.id)
+            self._send_json(snapshot)
+        elif sub == 'events':
+            since = int(parse_qs(urlparse(self.path).query).get('since', ['0'])[0])
+            self._stream_events(job, since)
+        else:
+            self._send_json({'error': '找不到路徑'}, 404)
+
+    def _stream_events(self, job, since):
+        """以NDJSON逐行送出事件，工作結束後關閉連線"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        try:
+            while True:
+                finished = job.finished_state
+                events = job.events_since(since)
+                for event in events:
+                    self.wfile.write((json.dumps(event, ensure_ascii=False) + "\n").encode('utf-8'))
+                if events:
+                    since = events[-1]['seq'] + 1
+                    self.wfile.flush()
+                elif finished:
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # 客戶端已中斷，工作本身不受影響
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip('/') != '/jobs':
+            self._send_json({'error': '找不到路徑'}, 404)
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+            job = self.service.submit(request)
+        except (ValueError, json.JSONDecodeError) as e:
+            self._send_json({'error': str(e)}, 400)
+            return
+        except OverflowError as e:
+            self._send_json({'error': str(e)}, 503)
+            return
+        snapshot = job.snapshot()
+        snapshot['position'] = self.service.queue_position(job.id)
+        self._send_json(snapshot, 201)
+
+    def do_DELETE(self):
+        job, sub = self._route()
+        if job is None:
+            return
+        self._send_json(self.service.cancel(job.id).snapshot())
+
+
+def make_server(service, host=DEFAULT_SERVICE_CONFIG["host"], port=DEFAULT_SERVICE_CONFIG["port"]):
+    """建立綁定到追蹤服務的多執行緒HTTP伺服器 (port為0時自動選擇可用埠)"""
+    server = ThreadingHTTPServer((host, port), ServiceRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def service_url(config):
+    """由服務配置組成客戶端使用的URL"""
+    return f"http://{config.get('host', DEFAULT_SERVICE_CONFIG['host'])}:{config.get('port', DEFAULT_SERVICE_CONFIG['port'])}"
+
+
+class TrackingClient:
+    """追蹤服務的客戶端 (GUI以此提交工作)，只使用標準函式庫"""
+
+    def __init__(self, url, timeout=10.0):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, method, path, data=None):
+        body = json.dumps(data).encode('utf-8') if data is not None else None
+        request = urllib.request.Request(self.url + path, data=body, method=method,
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except urllib.error.HTTPError as e:
+            # 服務端的錯誤訊息放在JSON的error欄位
+            try:
+                message = json.loads(e.read().decode('utf-8')).get('error')
+            except ValueError:
+                message = None
+            raise RuntimeError(message or f"HTTP {e.code}") from None
+
+    def health(self):
+        return self._request('GET', '/health')
+
+    def submit(self, video, prompts, save_video=False, save_masks_only=False, max_side=None, frame_events=True):
+        """提交追蹤工作，回傳工作狀態 (含id和排隊位置)"""
+        return self._request('POST', '/jobs', {
+            'video': video,
+            'prompts': prompts,
+            'save_video': save_video,
+            'save_masks_only': save_masks_only,
+            'max_side': max_side,
+            'frame_events': frame_events
+        })
+
+    def jobs(self):
+        return self._request('GET', '/jobs')['jobs']
+
+    def status(self, job_id):
+        return self._request('GET', f'/jobs/{job_id}')
+
+    def cancel(self, job_id):
+        return self._request('DELETE', f'/jobs/{job_id}')
+
+    def events(self, job_id, since=0):
+        """逐一產生工作事件直到工作結束"""
+        request = urllib.request.Request(f"{self.url}/jobs/{job_id}/events?since={since}")
+        with urllib.request.urlopen(request, timeout=None) as response:
+            for line in response:
+                if line.strip():
+                    yield json.loads(line.decode('utf-8'))
+
+
+def main():
+    """啟動本機追蹤服務 (模型常駐，工作排隊執行)"""
+    parser = argparse.ArgumentParser(description="SAM2本機追蹤服務")
+    parser.add_argument("--config", default="./sam2_config.json", help="配置檔案 (service區段、類別顏色和最佳化)")
+    parser.add_argument("--host", help="監聽位址")
+    parser.add_argument("--port", type=int, help="監聽埠")
+    parser.add_argument("--max-concurrent", type=int, help="同時執行的工作數量")
+    parser.add_argument("--max-queue", type=int, help="排隊中的工作上限")
+    parser.add_argument("--output", help="輸出目錄")
+    parser.add_argument("--model", default="./models/sam2.1_t.pt", help="SAM2模型路徑")
+    parser.add_argument("--device", help="裝置 (預設使用machine_profile，未校準時有CUDA則使用cuda)")
+    parser.add_argument("--imgsz", type=int, help="輸入尺寸 (預設使用machine_profile，未校準時為1024)")
+    args = parser.parse_args()
+
+    config = dict(DEFAULT_SERVICE_CONFIG)
+    optimization = frame_source_config = segmented_output_config = encoder_lookahead_config = None
+    mask_postprocess_config = None
+    if os.path.exists(args.config):
+        with open(args.config, 'r', encoding='utf-8') as f:
+            full_config = json.load(f)
+        config.update(full_config.get('service', {}))
+        optimization = full_config.get('optimization')
+        frame_source_config = full_config.get('frame_source')
+        segmented_output_config = full_config.get('segmented_output')
+        encoder_lookahead_config = full_config.get('encoder_lookahead')
+        mask_postprocess_config = full_config.get('mask_postprocess')
+    for key, value in (('host', args.host), ('port', args.port), ('max_concurrent', args.max_concurrent),
+                       ('max_queue', args.max_queue), ('output_dir', args.output)):
+        if value is not None:
+            config[key] = value
+
+    overrides = apply_machine_profile(sam2_overrides(args.model, "cuda" if torch.cuda.is_available() else "cpu"),
+                                      load_machine_profile(args.config))
+    for key, value in (('device', args.device), ('imgsz', args.imgsz)):
+        if value is not None:
+            overrides[key] = value
+    service = TrackingService(overrides, config, optimization, frame_source_config, config_path=args.config,
+                              segmented_output_config=segmented_output_config,
+                              encoder_lookahead_config=encoder_lookahead_config,
+                              mask_postprocess_config=mask_postprocess_config)
+    print(f"載入 {config['max_concurrent']} 份SAM2模型...")
+    try:
+        service.start()
+    except RuntimeError as e:
+        print(f"追蹤服務無法啟動: {e}")
+        return 1
+    server = make_server(service, config['host'], config['port'])
+    print(f"追蹤服務已啟動: {service_url(config)}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("正在停止追蹤服務...")
+    finally:
+        server.server_close()
+        service.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,559 @@
+import collections
+import concurrent.futures
+import fractions
+import os
+import queue
+import re
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from sam2_engine import read_video_frames
+
+
+# 即時模式的預設配置 (可在sam2_config.json的"realtime"區段覆寫)
+DEFAULT_REALTIME_CONFIG = {
+    "max_latency_ms": 250,  # 端到端延遲上限，超過時丟棄過舊的幀
+    "replay_realtime": True  # 檔案來源以實際時間 (原始FPS) 重播，模擬即時影像
+}
+
+
+# 幀來源的預設配置 (可在sam2_config.json的"frame_source"區段覆寫)
+DEFAULT_FRAME_SOURCE_CONFIG = {
+    "prefetch": 8,  # 解碼領先推論的幀數
+    "decode_workers": 4,  # 影像序列的解碼執行緒數量
+    "max_side": 0,  # 載入時把長邊縮小到此尺寸，0表示不縮放
+    "sequence_fps": 30  # 影像序列沒有FPS資訊，輸出視頻使用此FPS
+}
+
+# 影像序列支援的副檔名
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+
+def natural_sort_key(path):
+    """自然排序鍵 (frame_2.jpg 排在 frame_10.jpg 之前)"""
+    parts = re.split(r'(\d+)', os.path.basename(path).lower())
+    return [int(part) if part.isdigit() else part for part in parts]
+
+
+def is_image_file(path):
+    return os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+
+def resolve_frame_source(path):
+    """選到影像檔案時改用其所在目錄作為影像序列來源"""
+    if path and os.path.isfile(path) and is_image_file(path):
+        return os.path.dirname(path)
+    return path
+
+
+def is_frame_sequence(source):
+    return isinstance(source, str) and os.path.isdir(source)
+
+
+def list_sequence_frames(directory):
+    """列出目錄中的影像幀 (自然排序)"""
+    names = [name for name in os.listdir(directory) if is_image_file(name)]
+    return [os.path.join(directory, name) for name in sorted(names, key=natural_sort_key)]
+
+
+def downscale_frame(frame, max_side):
+    """把長邊縮小到max_side (不放大)"""
+    if not max_side:
+        return frame
+    h, w = frame.shape[:2]
+    scale = max_side / max(h, w)
+    if scale >= 1:
+        return frame
+    return cv2.resize(frame, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+
+
+def load_image_frame(path, max_side=0):
+    """讀取單張影像幀 (BGR)，讀取失敗時拋出IOError"""
+    frame = cv2.imread(path, cv2.IMREAD_COLOR)
+    if frame is None:
+        raise IOError(f"無法讀取影像: {path}")
+    return downscale_frame(frame, max_side)
+
+
+def rational_fps(fps):
+    """把容器回報的浮點FPS轉為精確的分數 (29.97... -> 30000/1001)
+
+    NTSC系列的幀率 (N*1000/1001) 優先比對，其他幀率取分母不超過1001的最接近分數。
+    """
+    if not fps or fps <= 0:
+        return None
+    ntsc = round(fps * 1.001)
+    if ntsc and abs(fps - ntsc * 1000 / 1001) < 1e-3 and abs(fps - ntsc) > 1e-3:
+        return fractions.Fraction(ntsc * 1000, 1001)
+    return fractions.Fraction(fps).limit_denominator(1001)
+
+
+class SourceInfo:
+    """來源的中繼資料 (只探測一次) 和已解碼的第一幀
+
+    視頻探測時讀取第一幀後保留開啟中的VideoCapture，第一個從第0幀開始讀取的
+    PrefetchFrameReader接手繼續解碼，第一幀不會被解碼兩次。完整讀完視頻後幀數更新為
+    實際解碼的幀數 (容器回報的幀數可能只是估計)。
+    """
+
+    def __init__(self, source, fps, frame_count, first_frame, capture=None, exact_count=False):
+        self.source = source
+        self.fps = fps  # fractions.Fraction，影像序列和沒有FPS資訊的視頻為None
+        self.frame_count = frame_count
+        self.exact_count = exact_count  # 影像序列和完整解碼過的視頻為True
+        self._first_frame = first_frame
+        if first_frame is not None:
+            first_frame.flags.writeable = False
+        self.height, self.width = first_frame.shape[:2] if first_frame is not None else (0, 0)
+        self._capture = capture
+        self._lock = threading.Lock()
+
+    def first_frame(self, max_side=0):
+        """唯讀的第一幀 (max_side縮放後為新的陣列)"""
+        if self._first_frame is None or not max_side:
+            return self._first_frame
+        frame = downscale_frame(self._first_frame, max_side)
+        frame.flags.writeable = False
+        return frame
+
+    def take_capture(self):
+        """取得已讀過第一幀的VideoCapture (只能取得一次，之後回傳None)"""
+        with self._lock:
+            capture, self._capture = self._capture, None
+        return capture
+
+    def output_fps(self, sequence_fps=DEFAULT_FRAME_SOURCE_CONFIG["sequence_fps"]):
+        """輸出視頻使用的精確FPS (沒有FPS資訊時使用sequence_fps)"""
+        return self.fps or rational_fps(sequence_fps)
+
+    def set_frame_count(self, count):
+        self.frame_count = count
+        self.exact_count = True
+
+    def release(self):
+        capture = self.take_capture()
+        if capture is not None:
+            capture.release()
+
+    def format(self):
+        count = f"{self.frame_count}" if self.exact_count else f"約 {self.frame_count}"
+        fps = f"{self.fps} FPS ({float(self.fps):.3f})" if self.fps else "無FPS資訊"
+        return f"來源: {self.width}x{self.height}, {fps}, {count} 幀"
+
+
+_PROBE_CACHE = collections.OrderedDict()
+_PROBE_CACHE_SIZE = 4
+_probe_lock = threading.Lock()
+
+
+def _probe_key(source):
+    path = os.path.abspath(source)
+    stat = os.stat(path)
+    # 影像序列以目錄的修改時間判斷是否有增減檔案
+    return path, stat.st_mtime_ns, stat.st_size
+
+
+def probe_source(source):
+    """探測視頻或影像序列的FPS、幀數、尺寸和第一幀，結果依路徑和修改時間快取
+
+    同一來源重複探測 (框選、輸出視頻的FPS、引擎的幀數) 時不再開啟檔案。無法讀取時回傳None。
+    """
+    if not source or not os.path.exists(source):
+        return None
+    key = _probe_key(source)
+    with _probe_lock:
+        info = _PROBE_CACHE.get(key)
+        if info is not None:
+            _PROBE_CACHE.move_to_end(key)
+            return info
+
+    if is_frame_sequence(source):
+        paths = list_sequence_frames(source)
+        if not paths:
+            return None
+        info = SourceInfo(source, None, len(paths), load_image_frame(paths[0]), exact_count=True)
+    else:
+        cap = cv2.VideoCapture(source)
+        success, frame = cap.read()
+        if not success:
+            cap.release()
+            return None
+        count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        info = SourceInfo(source, rational_fps(cap.get(cv2.CAP_PROP_FPS)), count if count > 0 else None, frame,
+                          capture=cap)
+
+    with _probe_lock:
+        _PROBE_CACHE[key] = info
+        while len(_PROBE_CACHE) > _PROBE_CACHE_SIZE:
+            _PROBE_CACHE.popitem(last=False)[1].release()
+    return info
+
+
+def read_first_frame(source, max_side=0):
+    """讀取視頻或影像序列的第一幀 (唯讀，由probe_source快取)，失敗時回傳None"""
+    info = probe_source(source)
+    return info.first_frame(max_side) if info is not None else None
+
+
+def source_frame_count(source):
+    """視頻或影像序列的總幀數 (無法取得時回傳None)"""
+    info = probe_source(source)
+    return info.frame_count if info is not None else None
+
+
+def source_fps(source, sequence_fps=DEFAULT_FRAME_SOURCE_CONFIG["sequence_fps"]):
+    """視頻的FPS (浮點數)，影像序列使用sequence_fps；精確的分數見probe_source(...).output_fps()"""
+    info = probe_source(source)
+    return float(info.output_fps(sequence_fps)) if info is not None else float(sequence_fps)
+
+
+class PrefetchFrameReader:
+    """預先解碼的幀讀取器，產生 (frame_idx, frame)
+
+    影像序列由執行緒池平行解碼，視頻由單一背景執行緒依序解碼，兩者都最多領先
+    消費端prefetch幀，讓解碼與推論重疊進行。同時統計解碼耗時和消費端等待解碼的時間。
+
+    每幀只解碼一次，產生的幀標記為唯讀，推論、顯示、混合和寫入器共用同一個緩衝區
+    (需要修改畫面的一方自行寫入另外的緩衝區)。從第0幀讀取視頻時接手probe_source已讀過
+    第一幀的VideoCapture。
+    """
+
+    def __init__(self, source, prefetch=DEFAULT_FRAME_SOURCE_CONFIG["prefetch"],
+                 workers=DEFAULT_FRAME_SOURCE_CONFIG["decode_workers"], max_side=0, start=0, end=None, stride=1):
+        self.source = source
+        self.prefetch = max(1, prefetch)
+        self.workers = max(1, workers) if is_frame_sequence(source) else 1
+        self.max_side = max_side
+        self.start = start
+        self.end = end
+        self.stride = stride
+
+        # 統計
+        self.frames = 0
+        self.decode_seconds = 0.0  # 所有解碼執行緒的累計解碼時間
+        self.stall_seconds = 0.0  # 消費端等待解碼的時間
+        self._lock = threading.Lock()
+
+    def _add_decode_time(self, seconds):
+        with self._lock:
+            self.decode_seconds += seconds
+
+    def _load(self, path):
+        start = time.perf_counter()
+        frame = load_image_frame(path, self.max_side)
+        frame.flags.writeable = False
+        self._add_decode_time(time.perf_counter() - start)
+        return frame
+
+    def __iter__(self):
+        if is_frame_sequence(self.source):
+            return self._iter_sequence()
+        return self._iter_video()
+
+    def _iter_sequence(self):
+        paths = list_sequence_frames(self.source)
+        indices = list(range(len(paths)))[self.start:self.end:self.stride]
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        pending = collections.deque()
+        try:
+            position = 0
+            while position < len(indices) or pending:
+                # 保持最多prefetch幀在解碼中或已解碼待取
+                while position < len(indices) and len(pending) < self.prefetch:
+                    frame_idx = indices[position]
+                    pending.append((frame_idx, executor.submit(self._load, paths[frame_idx])))
+                    position += 1
+                frame_idx, future = pending.popleft()
+                wait_start = time.perf_counter()
+                frame = future.result()
+                self.stall_seconds += time.perf_counter() - wait_start
+                self.frames += 1
+                yield frame_idx, frame
+        finally:
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _iter_video(self):
+        frames = queue.Queue(maxsize=self.prefetch)
+        stopped = threading.Event()
+
+        # 從頭讀取時沿用探測時已開啟並讀過第一幀的VideoCapture
+        info = probe_source(self.source) if self.start == 0 else None
+        capture = info.take_capture() if info is not None else None
+        first_frame = info.first_frame() if capture is not None else None
+
+        def decode():
+            try:
+                iterator = read_video_frames(self.source, self.start, self.end, self.stride,
+                                             capture=capture, first_frame=first_frame)
+                last_idx = -1
+                while not stopped.is_set():
+                    start = time.perf_counter()
+                    item = next(iterator, None)
+                    if item is not None:
+                        last_idx = item[0]
+                        frame = downscale_frame(item[1], self.max_side)
+                        frame.flags.writeable = False
+                        item = (item[0], frame)
+                    elif info is not None and self.end is None and self.stride == 1:
+                        # 完整讀完視頻，以實際解碼的幀數取代容器回報的估計值
+                        info.set_frame_count(last_idx + 1)
+                    self._add_decode_time(time.perf_counter() - start)
+                    # 消費端提前停止時不要永久阻塞
+                    while not stopped.is_set():
+                        try:
+                            frames.put(item, timeout=0.1)
+                            break
+                        except queue.Full:
+                            continue
+                    if item is None:
+                        break
+            except Exception as e:
+                print(f"解碼視頻時出錯: {e}")
+                frames.put(None)
+
+        thread = threading.Thread(target=decode, daemon=True)
+        thread.start()
+        try:
+            while True:
+                wait_start = time.perf_counter()
+                item = frames.get()
+                self.stall_seconds += time.perf_counter() - wait_start
+                if item is None:
+                    return
+                self.frames += 1
+                yield item
+        finally:
+            stopped.set()
+            thread.join(timeout=2)
+
+    def decode_ms(self):
+        """每幀平均解碼時間 (ms)"""
+        return self.decode_seconds * 1e3 / self.frames if self.frames else 0.0
+
+    def decode_fps(self):
+        """所有解碼執行緒合計可達的解碼吞吐量 (FPS)"""
+        return self.frames * self.workers / self.decode_seconds if self.decode_seconds > 0 else 0.0
+
+    def format(self, busy_seconds=None):
+        """解碼吞吐量和推論吞吐量的摘要，busy_seconds為消費端取幀加處理的總時間"""
+        text = (f"解碼: {self.decode_ms():.1f} ms/幀 ({self.workers} 執行緒, 約 {self.decode_fps():.1f} FPS), "
+                f"等待解碼 {self.stall_seconds * 1e3 / max(1, self.frames):.1f} ms/幀")
+        if busy_seconds is not None and self.frames:
+            inference_seconds = max(busy_seconds - self.stall_seconds, 1e-9)
+            text += f"; 推論: {self.frames / inference_seconds:.1f} FPS"
+        return text
+
+
+def parse_source_spec(spec):
+    """把使用者輸入的來源轉為cv2.VideoCapture的參數 (數字視為攝影機編號)"""
+    spec = str(spec).strip()
+    return int(spec) if spec.isdigit() else spec
+
+
+class LiveFrameSource:
+    """即時影像來源 (攝影機、RTSP等串流，或以實際時間重播的視頻檔案)
+
+    擷取執行緒持續讀取並只保留最新的一幀；消費端來不及取走而被覆蓋的幀計為丟棄。
+    """
+
+    def __init__(self, spec, replay_realtime=True):
+        self.spec = spec
+        self.source = parse_source_spec(spec)
+        self.is_file = isinstance(self.source, str) and os.path.isfile(self.source)
+        # 只有檔案需要依FPS控制重播速度，攝影機和串流本身就是即時的
+        self.replay_realtime = replay_realtime and self.is_file
+
+        self.cap = None
+        self.fps = 30.0
+        self.width = 0
+        self.height = 0
+
+        self._cond = threading.Condition()
+        self._latest = None  # (capture_idx, frame, capture_time)
+        self._thread = None
+        self._stopped = False
+        self.ended = False
+
+        # 統計
+        self.captured = 0
+        self.overwritten = 0
+
+    def open(self):
+        """開啟來源並讀取基本資訊"""
+        self.cap = cv2.VideoCapture(self.source)
+        if not self.cap.isOpened():
+            raise IOError(f"無法開啟影像來源: {self.spec}")
+        if not self.is_file:
+            # 盡量減少驅動程式端的緩衝，避免讀到舊幀
+            self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.fps = fps if fps and fps > 0 else 30.0
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    def start(self):
+        """啟動擷取執行緒"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        if self.cap is None or not self.cap.isOpened():
+            self.open()
+        self._stopped = False
+        self.ended = False
+        self._thread = threading.Thread(target=self._capture, daemon=True)
+        self._thread.start()
+
+    def _capture(self):
+        start = time.perf_counter()
+        capture_idx = 0
+        while not self._stopped:
+            if self.replay_realtime:
+                # 依原始FPS等待到該幀的播放時間
+                delay = start + capture_idx / self.fps - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+            success, frame = self.cap.read()
+            if not success:
+                break
+            capture_time = time.perf_counter()
+
+            with self._cond:
+                if self._latest is not None:
+                    self.overwritten += 1
+                self._latest = (capture_idx, frame, capture_time)
+                self.captured += 1
+                self._cond.notify_all()
+            capture_idx += 1
+
+        self.cap.release()
+        with self._cond:
+            self.ended = True
+            self._cond.notify_all()
+
+    def read(self, timeout=5.0):
+        """取出最新的一幀 (capture_idx, frame, capture_time)，來源結束時回傳None"""
+        deadline = time.perf_counter() + timeout
+        with self._cond:
+            while self._latest is None:
+                if self.ended:
+                    return None
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            item = self._latest
+            self._latest = None
+            return item
+
+    def snapshot(self):
+        """讀取一幀作為框選用的畫面，之後停止擷取"""
+        self.start()
+        item = self.read()
+        self.stop()
+        return None if item is None else item[1]
+
+    def stop(self):
+        """停止擷取執行緒"""
+        self._stopped = True
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+        self._thread = None
+        with self._cond:
+            self._latest = None
+
+
+class LatencyTracker:
+    """記錄端到端延遲 (擷取到輸出完成) 和丟棄的幀數"""
+
+    def __init__(self, max_latency_ms=DEFAULT_REALTIME_CONFIG["max_latency_ms"], window=1000):
+        self.max_latency = max_latency_ms / 1000.0
+        self.latencies = collections.deque(maxlen=window)
+        self.processed = 0
+        self.dropped_stale = 0
+        self.processing_ema = 0.0  # 單幀處理時間的指數移動平均
+        self._dequeue_time = None
+
+    def expected_processing(self):
+        return self.processing_ema
+
+    def should_drop(self, capture_time):
+        """判斷幀在處理完成時是否會超出延遲上限"""
+        age = time.perf_counter() - capture_time
+        if age > self.max_latency:
+            return True
+        # 處理時間本身超出上限時不做預測性丟棄，否則所有幀都會被丟棄
+        expected = self.expected_processing()
+        return expected < self.max_latency and age + expected > self.max_latency
+
+    def mark_dequeue(self):
+        self._dequeue_time = time.perf_counter()
+
+    def drop(self):
+        self.dropped_stale += 1
+
+    def record(self, capture_time):
+        """記錄一幀輸出完成"""
+        now = time.perf_counter()
+        self.latencies.append(now - capture_time)
+        if self._dequeue_time is not None:
+            processing = now - self._dequeue_time
+            self.processing_ema = processing if self.processed == 0 else 0.8 * self.processing_ema + 0.2 * processing
+        self.processed += 1
+
+    def percentiles(self):
+        """回傳延遲的 p50/p90/p99 (ms)"""
+        if not self.latencies:
+            return 0.0, 0.0, 0.0
+        p50, p90, p99 = np.percentile(np.asarray(self.latencies) * 1e3, [50, 90, 99])
+        return float(p50), float(p90), float(p99)
+
+    def summary(self, source=None):
+        p50, p90, p99 = self.percentiles()
+        return {
+            'processed': self.processed,
+            'dropped_stale': self.dropped_stale,
+            'dropped_source': source.overwritten if source is not None else 0,
+            'latency_p50_ms': round(p50, 2),
+            'latency_p90_ms': round(p90, 2),
+            'latency_p99_ms': round(p99, 2),
+            'max_latency_ms': self.max_latency * 1e3
+        }
+
+    def format(self, source=None):
+        s = self.summary(source)
+        return (f"延遲 p50/p90/p99: {s['latency_p50_ms']:.0f}/{s['latency_p90_ms']:.0f}/{s['latency_p99_ms']:.0f} ms  "
+                f"已處理: {s['processed']}  丟棄: {s['dropped_source'] + s['dropped_stale']}")
+
+
+def realtime_frames(source, latency_tracker, first_frame=None):
+    """從即時來源產生 (幀編號, 幀, 擷取時間)
+
+    幀編號為連續的處理序號 (SAM2的記憶依賴連續的幀編號)，預計無法在延遲上限內
+    完成的幀會直接丟棄。first_frame為框選時的畫面，作為第0幀以確保提示位置正確。
+    """
+    processed = 0
+    if first_frame is not None:
+        latency_tracker.mark_dequeue()
+        yield processed, first_frame, time.perf_counter()
+        processed += 1
+
+    source.start()
+    try:
+        while True:
+            item = source.read()
+            if item is None:
+                return
+            _, frame, capture_time = item
+            if latency_tracker.should_drop(capture_time):
+                latency_tracker.drop()
+                continue
+            latency_tracker.mark_dequeue()
+            yield processed, frame, capture_time
+            processed += 1
+    finally:
+        source.stop()
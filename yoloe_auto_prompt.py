@@ -0,0 +1,170 @@
+import queue
+import threading
+
+import numpy as np
+
+from text_embedding_cache import TextEmbeddingCache
+
+
+# 自動框選的預設配置 (可在sam2_config.json的"auto_prompt"區段覆寫)
+DEFAULT_AUTO_PROMPT_CONFIG = {
+    "model": "./models/yoloe-26n-seg.pt",
+    "conf": 0.25,
+    "device": None,  # None表示跟隨SAM2的device設定
+    "redetect_interval": 0,  # 每N幀重新偵測一次新出現的物件，0表示只在首幀偵測
+    "iou_threshold": 0.5  # 與已追蹤物件IoU低於此值的偵測框才視為新物件
+}
+
+
+def box_iou_matrix(boxes_a, boxes_b):
+    """計算兩組xyxy框的IoU矩陣"""
+    boxes_a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    if len(boxes_a) == 0 or len(boxes_b) == 0:
+        return np.zeros((len(boxes_a), len(boxes_b)), dtype=np.float32)
+
+    x1 = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    y1 = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    x2 = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    y2 = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return inter / np.maximum(union, 1e-6)
+
+
+def filter_new_prompts(prompts, tracked_boxes, iou_threshold=0.5):
+    """過濾出與已追蹤物件都不重疊的偵測結果"""
+    if not prompts or len(tracked_boxes) == 0:
+        return list(prompts)
+    iou = box_iou_matrix([p['bbox'] for p in prompts], tracked_boxes)
+    return [p for p, row in zip(prompts, iou) if row.max() < iou_threshold]
+
+
+class YOLOEAutoPrompter:
+    """以YOLOE文字提示自動產生SAM2的類別框提示
+
+    detect() 同步偵測單幀；submit()/poll() 將偵測交給背景執行緒，
+    讓重新偵測與SAM2的傳播並行執行，不會阻塞逐幀處理。每次追蹤開始時呼叫
+    new_session()，上一次追蹤提交但晚完成的結果不會被poll()取出。
+    """
+
+    def __init__(self, classes, model_path=DEFAULT_AUTO_PROMPT_CONFIG["model"],
+                 conf=DEFAULT_AUTO_PROMPT_CONFIG["conf"], device=None):
+        from ultralytics import YOLO
+
+        self.conf = conf
+        self.device = device
+
+        self.model = YOLO(model_path)
+        self.text_cache = TextEmbeddingCache(model_path)
+        # ultralytics的predictor不是執行緒安全的: 背景重新偵測、追蹤健康的重新提示 (Tk執行緒)
+        # 和set_classes共用同一個模型，依序使用
+        self._model_lock = threading.Lock()
+        self.set_classes(classes)
+
+        # 背景偵測執行緒 (只保留一個待處理請求，忙碌時新的請求會被略過)
+        self._requests = queue.Queue(maxsize=1)
+        self._results = queue.Queue()
+        self._thread = None
+        self.session = 0  # 目前追蹤的編號，請求和結果都帶有提交時的編號
+
+    def set_classes(self, classes):
+        """設定偵測的類別 (文字嵌入從快取讀取)"""
+        with self._model_lock:
+            self.classes = list(classes)
+            self.model.set_classes(self.classes, self.text_cache.get_text_pe(self.model, self.classes))
+
+    def detect(self, frame):
+        """偵測單幀，回傳 [{'bbox': [x1, y1, x2, y2], 'class': 類別名稱, 'conf': 置信度}, ...]"""
+        with self._model_lock:
+            result = self.model.predict(frame, conf=self.conf, device=self.device, verbose=False)[0]
+            classes = self.classes
+        if result.boxes is None or len(result.boxes) == 0:
+            return []
+
+        xyxy = result.boxes.xyxy.cpu().numpy()
+        cls = result.boxes.cls.cpu().numpy().astype(int)
+        conf = result.boxes.conf.cpu().numpy()
+        prompts = []
+        for box, cls_id, score in zip(xyxy, cls, conf):
+            x1, y1, x2, y2 = [int(round(v)) for v in box]
+            if x2 <= x1 or y2 <= y1:
+                continue
+            prompts.append({
+                'bbox': [x1, y1, x2, y2],
+                'class': classes[cls_id] if cls_id < len(classes) else "Unknown",
+                'conf': float(score)
+            })
+        # 依置信度排序，讓高分物件獲得較小的物件編號
+        prompts.sort(key=lambda p: p['conf'], reverse=True)
+        return prompts
+
+    def start(self):
+        """啟動背景偵測執行緒"""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._worker, daemon=True)
+            self._thread.start()
+
+    def _worker(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                break
+            session, frame_idx, frame, context = request
+            if session != self.session:
+                continue  # 已結束的追蹤提交的請求
+            try:
+                prompts = self.detect(frame)
+            except Exception as e:
+                print(f"YOLOE偵測第 {frame_idx} 幀時出錯: {e}")
+                prompts = []
+            self._results.put((session, frame_idx, prompts, context))
+
+    def new_session(self):
+        """開始新的追蹤: 之前提交的請求和結果全部作廢，回傳新的編號"""
+        self.session += 1
+        self._drain()
+        return self.session
+
+    def _drain(self):
+        while True:
+            try:
+                self._results.get_nowait()
+            except queue.Empty:
+                return
+
+    def submit(self, frame_idx, frame, context=None):
+        """非阻塞地提交一幀給背景執行緒偵測，忙碌時回傳False"""
+        self.start()
+        try:
+            self._requests.put_nowait((self.session, frame_idx, frame, context))
+            return True
+        except queue.Full:
+            return False
+
+    def poll(self):
+        """取出目前追蹤已完成的偵測結果 [(frame_idx, prompts, context), ...]"""
+        finished = []
+        while True:
+            try:
+                session, frame_idx, prompts, context = self._results.get_nowait()
+            except queue.Empty:
+                return finished
+            if session == self.session:
+                finished.append((frame_idx, prompts, context))
+
+    def close(self):
+        """停止背景偵測執行緒，並作廢尚未取出的結果"""
+        self.session += 1
+        if self._thread is not None and self._thread.is_alive():
+            # 清掉尚未處理的請求，確保停止訊號能放入佇列
+            try:
+                self._requests.get_nowait()
+            except queue.Empty:
+                pass
+            self._requests.put(None)
+            self._thread.join(timeout=5)
+        self._thread = None
+        self._drain()
@@ -2,6 +2,7 @@ import cv2
 import numpy as np
 from ultralytics import YOLO
 from ultralytics.models.yolo.yoloe import YOLOEVPSegPredictor
+from machine_profile import load_machine_profile
 
 # 1. 初始化模型與讀取影片首幀
 model = YOLO("./models/yoloe-26n-seg.pt")
@@ -59,7 +60,7 @@ if clicked_bboxes:
         source=video_path,
         visual_prompts=visual_prompts,
         predictor=YOLOEVPSegPredictor,
-        device="cuda",
+        device=load_machine_profile()['device'] or "cuda",
         stream=True
     )
 
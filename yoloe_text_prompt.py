@@ -1,7 +1,9 @@
 from ultralytics import YOLO
+from text_embedding_cache import TextEmbeddingCache
 
 # 1. 載入預訓練的 YOLOE-26n-seg 模型
-model = YOLO("./models/yoloe-26x-seg.pt")
+model_path = "./models/yoloe-26x-seg.pt"
+model = YOLO(model_path)
 #model = YOLO("./models/yoloe-26n-seg-pf.pt")
 
 # 2. 定義想要偵測的類別（Text Prompts）
@@ -10,7 +12,9 @@ names = ["person"]
 
 # 3. 設置類別與文字嵌入（Text Embeddings）
 # 這一點至關重要，用於將文字提示轉換為模型可理解的特徵
-model.set_classes(names, model.get_text_pe(names))
+# 文字嵌入會依模型檔案雜湊和類別字串快取，只有新的類別才需要重新編碼
+text_cache = TextEmbeddingCache(model_path)
+model.set_classes(names, text_cache.get_text_pe(model, names))
 
 # 4. 執行推論
 results = model.track("./test_data/ex4.avi", show=True, save=True, conf=0.6)